@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+"""Compare per-call latency of a fresh GitLab client per call against the shared client.
+
+Requires network access to ``GITLAB_HOST_URL`` and a valid ``GITLAB_AUTH_TOKEN``.
+"""
+
+import statistics
+import time
+from typing import Callable, List
+
+import gitlab
+
+from elaspic2_rest_api import config
+from elaspic2_rest_api import gitlab as el2_gitlab
+
+
+def get_pipeline_per_call_client(pipeline_id: int) -> None:
+    """Reproduce the old access pattern: new client, new TLS handshake, project fetch."""
+    with gitlab.Gitlab(config.GITLAB_HOST_URL, config.GITLAB_AUTH_TOKEN) as gl:
+        project = gl.projects.get(config.GITLAB_PROJECT_ID)
+        project.pipelines.get(pipeline_id)
+
+
+def get_pipeline_shared_client(pipeline_id: int) -> None:
+    project = el2_gitlab.get_project()
+    project.pipelines.get(pipeline_id)
+
+
+def time_calls(fn: Callable[[int], None], pipeline_id: int, num_calls: int) -> List[float]:
+    timings = []
+    for _ in range(num_calls):
+        start = time.perf_counter()
+        fn(pipeline_id)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def main(pipeline_id: int, num_calls: int) -> None:
+    el2_gitlab.open_client()
+    try:
+        for name, fn in [
+            ("per-call client", get_pipeline_per_call_client),
+            ("shared client", get_pipeline_shared_client),
+        ]:
+            timings = time_calls(fn, pipeline_id, num_calls)
+            print(
+                "{:20}mean: {:7.1f} ms    median: {:7.1f} ms    max: {:7.1f} ms".format(
+                    name,
+                    statistics.mean(timings) * 1000,
+                    statistics.median(timings) * 1000,
+                    max(timings) * 1000,
+                )
+            )
+    finally:
+        el2_gitlab.close_client()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-p", "--pipeline-id", type=int, help="Id of an existing pipeline.")
+    parser.add_argument("-n", "--num-calls", type=int, default=20, help="Number of calls to time.")
+    args = parser.parse_args()
+
+    main(args.pipeline_id, args.num_calls)
@@ -16,9 +16,10 @@ setup(
     url="https://gitlab.com/elaspic/elaspic2-rest-api",
     packages=find_packages(where="src"),
     package_dir={"": "src"},
-    package_data={},
+    package_data={"elaspic2_rest_api": ["templates/.gitlab-ci.yml.j2"]},
     include_package_data=True,
-    zip_safe=True,
+    # Templates are loaded from the file system
+    zip_safe=False,
     keywords="elaspic2_rest_api",
     classifiers=[
         "Development Status :: 2 - Pre-Alpha",
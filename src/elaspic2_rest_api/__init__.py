@@ -1,5 +1,24 @@
 __version__ = "0.1.12"
-__all__ = ["config", "types", "state", "utils", "bin_utils", "ci_utils", "gitlab", "db", "jobs"]
+__all__ = [
+    "config",
+    "types",
+    "state",
+    "cache",
+    "utils",
+    "bin_utils",
+    "ci_utils",
+    "middleware",
+    "gitlab",
+    "gitlab_async",
+    "results_store",
+    "structure_store",
+    "db",
+    "job_store",
+    "executors",
+    "scheduler",
+    "jobs",
+    "webhooks",
+]
 
 from . import *
 from .main import app
@@ -0,0 +1,254 @@
+"""Decide when submitted jobs may start their pipelines, sharing runners fairly between clients.
+
+Each client may have at most ``MAX_PIPELINES_PER_CLIENT`` pipelines in flight, and there may be
+at most ``MAX_PIPELINES_IN_FLIGHT`` pipelines in flight overall. Jobs which cannot start right
+away wait in a queue ordered by start-time fair queueing: each job is tagged with the virtual
+time at which it would finish if every client got an equal share of runners, and jobs with the
+earliest tags go first. Clients which submit a lot of work therefore wait behind those which do
+not, and small jobs overtake large scans, which still progress at their fair share. Jobs which
+have waited for longer than ``ADMISSION_MAX_WAIT`` go first instead, and runners which free up
+are kept for them, so that large jobs are not overtaken forever by a steady stream of small ones.
+
+The queue itself is bounded: once the mutations waiting in it exceed ``MAX_QUEUED_MUTATIONS``,
+or ``MAX_QUEUED_MUTATIONS_PER_CLIENT`` for a single client, further jobs are rejected along with
+an estimate of when there will be room for them, based on the recent throughput of pipelines.
+"""
+
+import heapq
+import itertools
+import time
+from collections import deque
+from typing import Deque, Dict, List, NamedTuple, Optional, Set, Tuple
+
+
+class AdmissionRejected(Exception):
+    """Raised when a job cannot be queued because too much work is waiting already."""
+
+    def __init__(self, message: str, retry_after: int) -> None:
+        super().__init__(message)
+        #: Number of seconds after which the job is expected to be accepted
+        self.retry_after = retry_after
+
+
+class QueueEntry(NamedTuple):
+    job_id: str
+    client_id: str
+    #: Number of mutations which the job will evaluate
+    size: int
+    #: Number of pipelines which the job will create
+    num_pipelines: int
+    #: Virtual time at which the job would start and finish given its fair share of runners
+    start_tag: float
+    finish_tag: float
+    #: Time at which the job was queued, as given by `time.monotonic`
+    queued_at: float
+
+
+class AdmissionQueue:
+    def __init__(
+        self,
+        max_in_flight: int,
+        max_per_client: int,
+        max_queued_work: Optional[int] = None,
+        max_queued_work_per_client: Optional[int] = None,
+        throughput_window: float = 900,
+        max_wait: Optional[float] = None,
+    ) -> None:
+        self.max_in_flight = max_in_flight
+        self.max_per_client = max_per_client
+        self.max_queued_work = max_queued_work
+        self.max_queued_work_per_client = max_queued_work_per_client
+        #: Number of seconds over which throughput is measured
+        self.throughput_window = throughput_window
+        #: Number of seconds after which a job stops being overtaken by jobs queued after it
+        self.max_wait = max_wait
+        self._heap: List[Tuple[float, int, QueueEntry]] = []
+        self._counter = itertools.count()
+        self._entries: Dict[str, QueueEntry] = {}
+        self._virtual_time = 0.0
+        #: Finish tag of the last job queued by each client
+        self._finish_tags: Dict[str, float] = {}
+        #: Number of pipelines in flight for each client, including those being created
+        self._in_flight: Dict[str, int] = {}
+        #: Client owning each pipeline in flight, and the number of mutations it evaluates
+        self._pipelines: Dict[int, Tuple[str, int]] = {}
+        #: Number of mutations waiting in the queue, overall and for each client
+        self.queued_work = 0
+        self._client_queued_work: Dict[str, int] = {}
+        #: Times at which pipelines finished, and the number of mutations they evaluated
+        self._completions: Deque[Tuple[float, int]] = deque()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, job_id: object) -> bool:
+        return job_id in self._entries
+
+    @property
+    def num_in_flight(self) -> int:
+        return sum(self._in_flight.values())
+
+    def push(self, job_id: str, client_id: str, size: int, num_pipelines: int) -> None:
+        """Add a job of `size` mutations, which will run as `num_pipelines` pipelines."""
+        start_tag = max(self._virtual_time, self._finish_tags.get(client_id, 0.0))
+        finish_tag = start_tag + size
+        self._finish_tags[client_id] = finish_tag
+        entry = QueueEntry(
+            job_id, client_id, size, num_pipelines, start_tag, finish_tag, time.monotonic()
+        )
+        self._entries[job_id] = entry
+        self._add_queued_work(client_id, size)
+        heapq.heappush(self._heap, (finish_tag, next(self._counter), entry))
+
+    def remove(self, job_id: str) -> bool:
+        """Remove a job from the queue, returning `False` if it was not queued."""
+        entry = self._entries.pop(job_id, None)
+        if entry is None:
+            return False
+        self._add_queued_work(entry.client_id, -entry.size)
+        return True
+
+    def position(self, job_id: str) -> Optional[int]:
+        """Return the number of jobs which will be admitted before `job_id`, if it is queued."""
+        entry = self._entries.get(job_id)
+        if entry is None:
+            return None
+        keys = {
+            other.job_id: (finish_tag, count)
+            for (finish_tag, count, other) in self._heap
+            if self._entries.get(other.job_id) is other
+        }
+        return sum(1 for key in keys.values() if key < keys[job_id])
+
+    def pop_admissible(self) -> List[QueueEntry]:
+        """Remove and return the jobs which can start now, in the order in which they should.
+
+        Pipelines of the returned jobs count as in flight until they are released.
+        """
+        admitted: List[QueueEntry] = []
+        #: Clients whose later jobs wait for an overdue job which is over the client's cap
+        blocked_clients: Set[str] = set()
+        # Jobs which waited for too long go first, oldest first
+        if self.max_wait is not None:
+            cutoff = time.monotonic() - self.max_wait
+            overdue = sorted(
+                (entry for entry in self._entries.values() if entry.queued_at < cutoff),
+                key=lambda entry: entry.queued_at,
+            )
+            for entry in overdue:
+                if entry.client_id in blocked_clients:
+                    continue
+                if not self._has_client_capacity(entry.client_id, entry.num_pipelines):
+                    blocked_clients.add(entry.client_id)
+                elif not self._has_total_capacity(entry.num_pipelines):
+                    # Runners which free up are kept for this job rather than given to others
+                    return admitted
+                else:
+                    self._admit(entry)
+                    admitted.append(entry)
+
+        remaining: List[Tuple[float, int, QueueEntry]] = []
+        while self._heap:
+            item = heapq.heappop(self._heap)
+            entry = item[2]
+            if self._entries.get(entry.job_id) is not entry:
+                continue
+            if entry.client_id in blocked_clients:
+                remaining.append(item)
+            elif self.has_capacity(entry.client_id, entry.num_pipelines):
+                self._admit(entry)
+                admitted.append(entry)
+            else:
+                remaining.append(item)
+        self._heap = remaining
+        heapq.heapify(self._heap)
+        # Clients whose jobs would start now anyway need not be remembered
+        self._finish_tags = {
+            client_id: finish_tag
+            for client_id, finish_tag in self._finish_tags.items()
+            if finish_tag > self._virtual_time
+        }
+        return admitted
+
+    def add_pipelines(
+        self, client_id: str, pipeline_sizes: Dict[int, int], num_reserved: int
+    ) -> None:
+        """Record the pipelines created in place of `num_reserved` admitted pipelines.
+
+        `pipeline_sizes` maps the id of each pipeline to the number of mutations it evaluates.
+        """
+        for pipeline_id, size in pipeline_sizes.items():
+            self._pipelines[pipeline_id] = (client_id, size)
+        self._reserve(client_id, len(pipeline_sizes) - num_reserved)
+
+    def release(self, pipeline_id: int) -> bool:
+        """Stop counting a pipeline as in flight, returning `True` if it was."""
+        pipeline = self._pipelines.pop(pipeline_id, None)
+        if pipeline is None:
+            return False
+        client_id, size = pipeline
+        self._reserve(client_id, -1)
+        self._completions.append((time.monotonic(), size))
+        return True
+
+    def get_pipeline_ids(self) -> List[int]:
+        """Return the ids of all pipelines in flight."""
+        return list(self._pipelines)
+
+    def has_capacity(self, client_id: str, num_pipelines: int) -> bool:
+        """Return `True` if a job of `client_id` with `num_pipelines` pipelines may start now."""
+        return self._has_client_capacity(client_id, num_pipelines) and self._has_total_capacity(
+            num_pipelines
+        )
+
+    def _has_client_capacity(self, client_id: str, num_pipelines: int) -> bool:
+        # Jobs with more pipelines than allowed may still start once nothing else is running
+        in_flight = self._in_flight.get(client_id, 0)
+        return not in_flight or in_flight + num_pipelines <= self.max_per_client
+
+    def _has_total_capacity(self, num_pipelines: int) -> bool:
+        total_in_flight = self.num_in_flight
+        return not total_in_flight or total_in_flight + num_pipelines <= self.max_in_flight
+
+    def _admit(self, entry: QueueEntry) -> None:
+        del self._entries[entry.job_id]
+        self._add_queued_work(entry.client_id, -entry.size)
+        self._reserve(entry.client_id, entry.num_pipelines)
+        self._virtual_time = max(self._virtual_time, entry.start_tag)
+
+    def get_throughput(self) -> float:
+        """Return the number of mutations evaluated per second over the throughput window."""
+        cutoff = time.monotonic() - self.throughput_window
+        while self._completions and self._completions[0][0] < cutoff:
+            self._completions.popleft()
+        return sum(size for _, size in self._completions) / self.throughput_window
+
+    def get_excess_work(self, client_id: str, size: int) -> int:
+        """Return by how many mutations queueing `size` more would go over budget, if at all."""
+        excess = 0
+        if self.max_queued_work is not None:
+            excess = max(excess, self.queued_work + size - self.max_queued_work)
+        if self.max_queued_work_per_client is not None:
+            client_queued_work = self._client_queued_work.get(client_id, 0)
+            excess = max(excess, client_queued_work + size - self.max_queued_work_per_client)
+        return excess
+
+    def estimate_wait(self, work: int) -> Optional[float]:
+        """Estimate how many seconds it takes to get through `work` mutations, if known."""
+        throughput = self.get_throughput()
+        return work / throughput if throughput else None
+
+    def _add_queued_work(self, client_id: str, size: int) -> None:
+        self.queued_work += size
+        client_queued_work = self._client_queued_work.get(client_id, 0) + size
+        if client_queued_work > 0:
+            self._client_queued_work[client_id] = client_queued_work
+        else:
+            self._client_queued_work.pop(client_id, None)
+
+    def _reserve(self, client_id: str, num_pipelines: int) -> None:
+        in_flight = self._in_flight.get(client_id, 0) + num_pipelines
+        if in_flight > 0:
+            self._in_flight[client_id] = in_flight
+        else:
+            self._in_flight.pop(client_id, None)
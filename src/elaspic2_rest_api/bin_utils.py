@@ -1,6 +1,89 @@
+import base64
 import binascii
+import re
+import zlib
+from typing import Iterator, Optional
+
+#: First two bytes of every gzip-compressed file
+GZIP_MAGIC_NUMBER = b"1f8b"
+
+_WHITESPACE = re.compile(rb"\s+")
+
+
+def is_gz_data(data: bytes) -> bool:
+    return binascii.hexlify(data[:2]) == GZIP_MAGIC_NUMBER
 
 
 def is_gz_file(filepath):
     with open(filepath, "rb") as test_f:
-        return binascii.hexlify(test_f.read(2)) == b"1f8b"
+        return is_gz_data(test_f.read(2))
+
+
+class GzipStreamDecoder:
+    """Decompress gzip data, which may be base64-encoded, one chunk at a time.
+
+    Data is taken to be base64-encoded unless it starts with the gzip magic number, and
+    whitespace in base64-encoded data (e.g. line breaks) is ignored. Raises `ValueError` if
+    data is malformed. Decompressed data is returned in chunks of at most `max_chunk_size`
+    bytes, so that highly compressed data never has to be held in memory at once.
+    """
+
+    def __init__(self, max_chunk_size: int = 64 * 1024) -> None:
+        self.max_chunk_size = max_chunk_size
+        self.is_base64: Optional[bool] = None
+        self._buffer = b""
+        self._decompressor = zlib.decompressobj(wbits=16 + zlib.MAX_WBITS)
+
+    def decode(self, data: bytes) -> Iterator[bytes]:
+        """Yield the decompressed data which can be decoded so far."""
+        if self.is_base64 is None:
+            self._buffer += data
+            # Four base64 characters are needed to decode the gzip magic number
+            if len(_WHITESPACE.sub(b"", self._buffer)) < 4:
+                return
+            self.is_base64 = not is_gz_data(self._buffer)
+            data, self._buffer = self._buffer, b""
+            if self.is_base64:
+                data = self._decode_base64(data)
+            if not is_gz_data(data):
+                raise ValueError("Data is not gzip-compressed")
+        elif self.is_base64:
+            data = self._decode_base64(data)
+        yield from self._decompress(data)
+
+    def flush(self) -> bytes:
+        """Return the rest of the decompressed data, once all data has been passed in."""
+        if self.is_base64 is None:
+            raise ValueError("Data is not gzip-compressed")
+        if self._buffer:
+            raise ValueError("Base64-encoded data is truncated")
+        try:
+            data = self._decompressor.flush()
+        except zlib.error as e:
+            raise ValueError(f"Data could not be decompressed ({e})")
+        if not self._decompressor.eof:
+            raise ValueError("Gzip-compressed data is truncated")
+        return data
+
+    def _decode_base64(self, data: bytes) -> bytes:
+        # Only whole groups of four characters can be decoded
+        self._buffer += _WHITESPACE.sub(b"", data)
+        length = len(self._buffer) - len(self._buffer) % 4
+        data, self._buffer = self._buffer[:length], self._buffer[length:]
+        try:
+            return base64.b64decode(data, validate=True)
+        except binascii.Error as e:
+            raise ValueError(f"Data is not valid base64 ({e})")
+
+    def _decompress(self, data: bytes) -> Iterator[bytes]:
+        while True:
+            try:
+                chunk = self._decompressor.decompress(data, self.max_chunk_size)
+            except zlib.error as e:
+                raise ValueError(f"Data could not be decompressed ({e})")
+            if chunk:
+                yield chunk
+            data = self._decompressor.unconsumed_tail
+            # Output may be left over even once all input has been consumed
+            if not data and len(chunk) < self.max_chunk_size:
+                break
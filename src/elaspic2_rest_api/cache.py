@@ -0,0 +1,73 @@
+import time
+from collections import OrderedDict
+from typing import Any, Generic, Hashable, NamedTuple, Optional, Tuple, TypeVar
+
+T = TypeVar("T")
+
+
+class CacheInfo(NamedTuple):
+    hits: int
+    misses: int
+    maxsize: int
+    currsize: int
+
+
+class TTLCache(Generic[T]):
+    """Size-bounded LRU cache where each entry can have its own time-to-live.
+
+    Entries set with ``ttl=None`` never expire, but are still subject to LRU eviction.
+    """
+
+    def __init__(self, maxsize: int, ttl: Optional[float]) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data: "OrderedDict[Hashable, Tuple[Optional[float], T]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self._lookup(key) is not None
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._lookup(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self._data.move_to_end(key)
+        return entry[1]
+
+    def set(self, key: Hashable, value: T, ttl: Any = ...) -> None:
+        """Add `value` to the cache, expiring after `ttl` seconds (the cache default if omitted)."""
+        if ttl is ...:
+            ttl = self.ttl
+        expires_at = None if ttl is None else time.monotonic() + ttl
+        self._data[key] = (expires_at, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._data.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def clear(self) -> None:
+        self._data.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def info(self) -> CacheInfo:
+        return CacheInfo(self.hits, self.misses, self.maxsize, len(self._data))
+
+    def _lookup(self, key: Hashable) -> Optional[Tuple[Optional[float], T]]:
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        expires_at = entry[0]
+        if expires_at is not None and expires_at <= time.monotonic():
+            del self._data[key]
+            return None
+        return entry
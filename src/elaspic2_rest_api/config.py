@@ -1,5 +1,6 @@
 import os
-from typing import Optional
+import tempfile
+from typing import List, Optional
 
 ROOT_PATH = os.getenv("ROOT_PATH", "")
 
@@ -10,3 +11,200 @@ GITLAB_PROJECT_ID: int = int(os.getenv("GITLAB_PROJECT_ID", "21481523"))
 GITLAB_AUTH_TOKEN: Optional[str] = os.getenv("GITLAB_AUTH_TOKEN")
 
 SENTRY_DSN: Optional[str] = os.getenv("SENTRY_DSN")
+
+#: Maximum number of keep-alive connections kept open to the GitLab host
+GITLAB_POOL_MAXSIZE: int = int(os.getenv("GITLAB_POOL_MAXSIZE", "16"))
+
+#: Timeout (in seconds) for individual requests to the GitLab API
+GITLAB_TIMEOUT: float = float(os.getenv("GITLAB_TIMEOUT", "30"))
+
+#: Maximum number of simultaneous connections opened by the asyncio GitLab client
+GITLAB_MAX_CONNECTIONS: int = int(os.getenv("GITLAB_MAX_CONNECTIONS", "100"))
+
+#: Number of seconds for which the state of a running or pending job is cached
+JOB_STATE_CACHE_TTL: float = float(os.getenv("JOB_STATE_CACHE_TTL", "10"))
+
+#: Maximum number of job states kept in the cache
+JOB_STATE_CACHE_MAXSIZE: int = int(os.getenv("JOB_STATE_CACHE_MAXSIZE", "10000"))
+
+#: Directory where the service keeps its local data
+DATA_DIR: str = os.getenv("DATA_DIR", os.path.join(tempfile.gettempdir(), "elaspic2_rest_api"))
+
+#: Directory holding compressed results of finished jobs
+RESULTS_STORE_DIR: str = os.getenv("RESULTS_STORE_DIR", os.path.join(DATA_DIR, "results"))
+
+#: Maximum total size (in bytes) of compressed results, beyond which old results are evicted
+RESULTS_STORE_MAX_BYTES: int = int(os.getenv("RESULTS_STORE_MAX_BYTES", str(1024**3)))
+
+#: Maximum number of result rows indexed for queries, beyond which the results of the least
+#: recently queried jobs are dropped from the index (and indexed again when next queried)
+RESULTS_INDEX_MAX_ROWS: int = int(os.getenv("RESULTS_INDEX_MAX_ROWS", "1000000"))
+
+#: SQLite database of the service, which may only be used by a single worker at a time, since
+#: jobs are admitted by the process which queued them
+DB_PATH: str = os.getenv("DB_PATH", os.path.join(DATA_DIR, "elaspic2_rest_api.sqlite"))
+
+#: Jobs with more mutations than this are split into several pipelines running in parallel
+FANOUT_MUTATIONS_PER_PIPELINE: int = int(os.getenv("FANOUT_MUTATIONS_PER_PIPELINE", "200"))
+
+#: Maximum number of pipelines created for a single job
+FANOUT_MAX_PIPELINES: int = int(os.getenv("FANOUT_MAX_PIPELINES", "10"))
+
+#: Number of mutations evaluated by each parallel job of the child pipelines rendered for GitLab
+#: pipelines, or 0 if pipelines should evaluate all of their mutations in a single job
+CHILD_PIPELINE_MUTATIONS_PER_WORKER: int = int(
+    os.getenv("CHILD_PIPELINE_MUTATIONS_PER_WORKER", "0")
+)
+
+#: Responses smaller than this (in bytes) are sent uncompressed
+COMPRESSION_MINIMUM_SIZE: int = int(os.getenv("COMPRESSION_MINIMUM_SIZE", "1024"))
+
+#: Maximum size (in bytes) of a compressed request body once it has been decompressed
+MAX_DECOMPRESSED_BODY_SIZE: int = int(os.getenv("MAX_DECOMPRESSED_BODY_SIZE", str(256 * 1024**2)))
+
+#: Secret token which GitLab sends with pipeline webhooks; webhooks are rejected if unset
+GITLAB_WEBHOOK_TOKEN: Optional[str] = os.getenv("GITLAB_WEBHOOK_TOKEN")
+
+#: Number of seconds for which a running or pending state received by webhook is trusted
+WEBHOOK_STATE_MAX_AGE: float = float(os.getenv("WEBHOOK_STATE_MAX_AGE", "3600"))
+
+#: Number of seconds between checks of a job which clients are waiting on
+JOB_WATCH_INTERVAL: float = float(os.getenv("JOB_WATCH_INTERVAL", "10"))
+
+#: Maximum number of seconds for which a long-polling request is held open
+MAX_LONG_POLL_WAIT: float = float(os.getenv("MAX_LONG_POLL_WAIT", "60"))
+
+#: Maximum number of jobs whose state can be requested at once
+MAX_BULK_JOB_IDS: int = int(os.getenv("MAX_BULK_JOB_IDS", "500"))
+
+#: Maximum number of jobs checked concurrently when serving a bulk status request
+BULK_STATUS_CONCURRENCY: int = int(os.getenv("BULK_STATUS_CONCURRENCY", "20"))
+
+#: Maximum number of jobs which can be submitted in a single batch
+MAX_BATCH_JOBS: int = int(os.getenv("MAX_BATCH_JOBS", "100"))
+
+#: Maximum number of jobs from a batch which are created concurrently
+BATCH_SUBMIT_CONCURRENCY: int = int(os.getenv("BATCH_SUBMIT_CONCURRENCY", "10"))
+
+#: Maximum number of failed pipelines checked concurrently by the monitor
+FAILURE_CHECK_CONCURRENCY: int = int(os.getenv("FAILURE_CHECK_CONCURRENCY", "10"))
+
+#: Maximum number of failed pipelines checked by the monitor per cycle, with the rest being
+#: checked in later cycles
+MAX_FAILURE_CHECKS: int = int(os.getenv("MAX_FAILURE_CHECKS", "100"))
+
+#: Number of seconds after which a pipeline known to have really failed is forgotten
+KNOWN_FAILURES_MAX_AGE: float = float(os.getenv("KNOWN_FAILURES_MAX_AGE", str(30 * 24 * 3600)))
+
+#: Maximum number of pipelines remembered as having really failed
+KNOWN_FAILURES_MAXSIZE: int = int(os.getenv("KNOWN_FAILURES_MAXSIZE", "100000"))
+
+#: Number of GitLab API requests per minute made before GitLab reports its own rate limit
+GITLAB_RATE_LIMIT: float = float(os.getenv("GITLAB_RATE_LIMIT", "600"))
+
+#: Number of GitLab API requests which can be made at once without waiting for the rate limit
+GITLAB_RATE_LIMIT_BURST: int = int(os.getenv("GITLAB_RATE_LIMIT_BURST", "20"))
+
+#: Maximum number of times a rate-limited or failed GitLab API request is retried
+GITLAB_MAX_RETRIES: int = int(os.getenv("GITLAB_MAX_RETRIES", "5"))
+
+#: Number of seconds before the first retry of a GitLab API request, doubled with every retry
+GITLAB_BACKOFF_BASE: float = float(os.getenv("GITLAB_BACKOFF_BASE", "0.5"))
+
+#: Maximum number of seconds between retries of a GitLab API request
+GITLAB_BACKOFF_MAX: float = float(os.getenv("GITLAB_BACKOFF_MAX", "60"))
+
+#: Where job records are kept: "sqlite" (the local database) or "firestore"
+JOB_STORE: str = os.getenv("JOB_STORE", "sqlite")
+
+#: Where predictions are run: "gitlab" (CI pipelines), "local" (subprocesses) or "slurm"
+EXECUTOR_BACKEND: str = os.getenv("EXECUTOR_BACKEND", "gitlab")
+
+#: Directory holding the inputs and results of jobs run by the local and Slurm backends,
+#: which must be on a shared file system when using Slurm
+EXECUTOR_WORK_DIR: str = os.getenv("EXECUTOR_WORK_DIR", os.path.join(DATA_DIR, "runs"))
+
+#: Command run by the local backend, which should evaluate the mutations given by the same
+#: environment variables as GitLab pipelines and write ``results/results.jsonl``
+LOCAL_EXECUTOR_COMMAND: Optional[str] = os.getenv("LOCAL_EXECUTOR_COMMAND")
+
+#: Maximum number of jobs run by the local backend at the same time
+LOCAL_EXECUTOR_WORKERS: int = int(os.getenv("LOCAL_EXECUTOR_WORKERS", str(os.cpu_count() or 1)))
+
+#: Batch script submitted with ``sbatch`` by the Slurm backend, with the same contract as
+#: ``LOCAL_EXECUTOR_COMMAND``
+SLURM_BATCH_SCRIPT: Optional[str] = os.getenv("SLURM_BATCH_SCRIPT")
+
+#: Additional arguments passed to ``sbatch`` (e.g. "--partition=gpu --time=2:00:00")
+SLURM_SBATCH_ARGS: str = os.getenv("SLURM_SBATCH_ARGS", "")
+
+#: Maximum number of pipelines running at the same time; further jobs wait in a queue
+MAX_PIPELINES_IN_FLIGHT: int = int(os.getenv("MAX_PIPELINES_IN_FLIGHT", "100"))
+
+#: Maximum number of pipelines running at the same time on behalf of a single client
+MAX_PIPELINES_PER_CLIENT: int = int(os.getenv("MAX_PIPELINES_PER_CLIENT", "20"))
+
+#: Request header identifying clients for fair sharing; clients are told apart by their IP
+#: address if it is missing
+CLIENT_ID_HEADER: str = os.getenv("CLIENT_ID_HEADER", "X-Client-Id")
+
+#: Comma-separated addresses or networks (e.g. "10.0.0.0/8") of the proxies trusted to set
+#: ``CLIENT_ID_HEADER``; the header is ignored in requests coming from anywhere else
+TRUSTED_PROXIES: List[str] = [
+    proxy.strip() for proxy in os.getenv("TRUSTED_PROXIES", "").split(",") if proxy.strip()
+]
+
+#: Number of seconds after which a queued job stops being overtaken by jobs queued after it
+ADMISSION_MAX_WAIT: float = float(os.getenv("ADMISSION_MAX_WAIT", "600"))
+
+#: Number of seconds between checks for finished pipelines, which make room for queued jobs
+ADMISSION_CHECK_INTERVAL: float = float(os.getenv("ADMISSION_CHECK_INTERVAL", "30"))
+
+#: Maximum number of mutations waiting in the queue; further jobs are rejected with 429
+MAX_QUEUED_MUTATIONS: int = int(os.getenv("MAX_QUEUED_MUTATIONS", "100000"))
+
+#: Maximum number of mutations waiting in the queue on behalf of a single client
+MAX_QUEUED_MUTATIONS_PER_CLIENT: int = int(os.getenv("MAX_QUEUED_MUTATIONS_PER_CLIENT", "20000"))
+
+#: Number of seconds over which the throughput of pipelines is measured
+THROUGHPUT_WINDOW: float = float(os.getenv("THROUGHPUT_WINDOW", "900"))
+
+#: Number of seconds after which rejected clients should retry, if throughput is not known yet
+DEFAULT_RETRY_AFTER: int = int(os.getenv("DEFAULT_RETRY_AFTER", "60"))
+
+#: Maximum number of seconds after which rejected clients are told to retry
+MAX_RETRY_AFTER: int = int(os.getenv("MAX_RETRY_AFTER", "3600"))
+
+#: URL at which pipelines can reach this service to download stored structures; structures
+#: are downloaded by pipelines themselves if it is not set
+STRUCTURE_STORE_URL: Optional[str] = os.getenv("STRUCTURE_STORE_URL")
+
+#: Directory holding the structure store
+STRUCTURE_STORE_DIR: str = os.getenv("STRUCTURE_STORE_DIR", os.path.join(DATA_DIR, "structures"))
+
+#: Maximum total size (in bytes) of stored structures, beyond which old structures are evicted
+STRUCTURE_STORE_MAX_BYTES: int = int(os.getenv("STRUCTURE_STORE_MAX_BYTES", str(1024**3)))
+
+#: Number of seconds after their last use during which structures are never evicted, so that
+#: pipelines can still download them; the store may go over its size limit as a result
+STRUCTURE_EVICT_MIN_AGE: float = float(os.getenv("STRUCTURE_EVICT_MIN_AGE", str(24 * 60 * 60)))
+
+#: Number of seconds for which the structure downloaded from a URL is assumed not to change
+STRUCTURE_URL_MAX_AGE: float = float(os.getenv("STRUCTURE_URL_MAX_AGE", str(7 * 24 * 60 * 60)))
+
+#: Maximum number of structures downloaded at the same time
+STRUCTURE_FETCH_CONCURRENCY: int = int(os.getenv("STRUCTURE_FETCH_CONCURRENCY", "4"))
+
+#: Number of seconds after which downloading a structure is abandoned
+STRUCTURE_FETCH_TIMEOUT: float = float(os.getenv("STRUCTURE_FETCH_TIMEOUT", "60"))
+
+#: Comma-separated hosts from which the structure store downloads structures, or "*" for any
+#: host; structures are never downloaded from loopback, link-local or private addresses
+STRUCTURE_FETCH_ALLOWED_HOSTS: List[str] = [
+    host.strip()
+    for host in os.getenv("STRUCTURE_FETCH_ALLOWED_HOSTS", "files.rcsb.org").split(",")
+    if host.strip()
+]
+
+#: Maximum size (in bytes) of a structure file
+MAX_STRUCTURE_SIZE: int = int(os.getenv("MAX_STRUCTURE_SIZE", str(100 * 1024**2)))
@@ -1,13 +1,795 @@
-def firestore_example():
-    from google.cloud import firestore
+import fcntl
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import (
+    IO,
+    Any,
+    Collection,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Set,
+    Tuple,
+)
 
-    # Add a new document
-    db = firestore.Client()
-    doc_ref = db.collection("jobs").document("alovelace")
-    doc_ref.set({"first": "Ada", "last": "Lovelace", "born": 1815})
+import orjson
 
-    # Then query for documents
-    users_ref = db.collection("users")
+from elaspic2_rest_api import config
+from elaspic2_rest_api.types import JobRequest, JobState, MutationResult
 
-    for doc in users_ref.stream():
-        print("{} => {}".format(doc.id, doc.to_dict()))
+#: Columns of `MutationResult` by which results can be sorted
+SCORE_COLUMNS = [
+    name for name, field in MutationResult.__fields__.items() if field.outer_type_ is float
+]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS submissions (
+    request_hash TEXT PRIMARY KEY,
+    job_id TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS submissions_job_id ON submissions (job_id);
+
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id TEXT PRIMARY KEY,
+    context_hash TEXT NOT NULL,
+    mutations TEXT NOT NULL,
+    created_at TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS job_requests (
+    job_id TEXT PRIMARY KEY,
+    request TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS job_state_transitions (
+    job_id TEXT NOT NULL,
+    status TEXT NOT NULL,
+    changed_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS job_state_transitions_job_id ON job_state_transitions (job_id);
+
+CREATE TABLE IF NOT EXISTS result_locations (
+    pipeline_id INTEGER PRIMARY KEY,
+    pipeline_job_id INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS job_pipelines (
+    job_id TEXT NOT NULL,
+    batch INTEGER NOT NULL,
+    pipeline_id INTEGER NOT NULL,
+    mutations TEXT NOT NULL,
+    PRIMARY KEY (job_id, batch)
+);
+CREATE INDEX IF NOT EXISTS job_pipelines_pipeline_id ON job_pipelines (pipeline_id);
+
+CREATE TABLE IF NOT EXISTS mutation_results (
+    context_hash TEXT NOT NULL,
+    mutation TEXT NOT NULL,
+    result TEXT NOT NULL,
+    PRIMARY KEY (context_hash, mutation)
+);
+
+CREATE TABLE IF NOT EXISTS pipeline_states (
+    pipeline_id INTEGER PRIMARY KEY,
+    pipeline_status TEXT NOT NULL,
+    status TEXT NOT NULL,
+    state TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS pipeline_states_status ON pipeline_states (pipeline_status, status);
+
+CREATE TABLE IF NOT EXISTS queued_jobs (
+    job_id TEXT PRIMARY KEY,
+    client_id TEXT NOT NULL,
+    request TEXT NOT NULL,
+    context_hash TEXT NOT NULL,
+    mutations TEXT NOT NULL,
+    mutation_batches TEXT NOT NULL,
+    created_at TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS pipelines_in_flight (
+    pipeline_id INTEGER PRIMARY KEY,
+    client_id TEXT NOT NULL,
+    size INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS executor_runs (
+    run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    backend TEXT NOT NULL,
+    status TEXT NOT NULL,
+    work_dir TEXT NOT NULL,
+    created_at TEXT NOT NULL,
+    started_at TEXT,
+    finished_at TEXT
+);
+
+CREATE TABLE IF NOT EXISTS known_failures (
+    pipeline_id INTEGER PRIMARY KEY,
+    added_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS known_failures_added_at ON known_failures (added_at);
+
+CREATE TABLE IF NOT EXISTS watermarks (
+    name TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS indexed_jobs (
+    job_id TEXT PRIMARY KEY,
+    num_results INTEGER NOT NULL,
+    used_at REAL NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS job_results (
+    job_id TEXT NOT NULL,
+    idx INTEGER NOT NULL,
+    mutation TEXT,
+    position INTEGER,
+    {score_columns},
+    result TEXT NOT NULL,
+    PRIMARY KEY (job_id, idx)
+);
+CREATE INDEX IF NOT EXISTS job_results_mutation ON job_results (job_id, mutation);
+CREATE INDEX IF NOT EXISTS job_results_position ON job_results (job_id, position);
+{score_indexes}
+""".format(
+    score_columns=",\n    ".join(f"{column} REAL" for column in SCORE_COLUMNS),
+    score_indexes="\n".join(
+        f"CREATE INDEX IF NOT EXISTS job_results_{column} ON job_results (job_id, {column});"
+        for column in SCORE_COLUMNS
+    ),
+)
+
+
+class ExecutorRun(NamedTuple):
+    run_id: int
+    #: Name of the executor backend running the job
+    backend: str
+    status: str
+    #: Directory holding the inputs and results of the run
+    work_dir: str
+    created_at: str
+    started_at: Optional[str]
+    finished_at: Optional[str]
+
+
+class JobRecord(NamedTuple):
+    job_id: str
+    #: GitLab pipelines computing the mutations which were not already cached, one per batch
+    pipeline_ids: List[int]
+    #: Mutations evaluated by each pipeline
+    pipeline_mutations: List[List[str]]
+    #: Digest of the protein, ligand and structure, as returned by `utils.get_context_hash`
+    context_hash: Optional[str]
+    #: All mutations requested by the user
+    mutations: List[str]
+    created_at: Optional[str]
+
+
+class QueuedJob(NamedTuple):
+    job_id: str
+    client_id: str
+    request: JobRequest
+    context_hash: str
+    #: All mutations of the job, including those with cached results
+    mutations: List[str]
+    #: Mutations to be evaluated by each pipeline, comma-separated
+    mutation_batches: List[str]
+    created_at: str
+
+
+#: Connections of all threads, which are replaced once the database is closed
+_connections: List[sqlite3.Connection] = []
+_connection_lock = threading.Lock()
+_local = threading.local()
+
+
+def get_connection() -> sqlite3.Connection:
+    """Return a connection to the SQLite database, creating the database if necessary.
+
+    The connection is in autocommit mode. Each thread gets a connection of its own, so that
+    statements of one thread never become part of a transaction opened by another.
+    """
+    connection = getattr(_local, "connection", None)
+    if connection is not None and connection in _connections:
+        return connection
+
+    with _connection_lock:
+        Path(config.DB_PATH).parent.mkdir(parents=True, exist_ok=True)
+        # Connections are closed by whichever thread closes the database
+        connection = sqlite3.connect(
+            config.DB_PATH, timeout=30, isolation_level=None, check_same_thread=False
+        )
+        connection.execute("PRAGMA journal_mode=WAL")
+        if not _connections:
+            connection.executescript(SCHEMA)
+        _connections.append(connection)
+    _local.connection = connection
+    return connection
+
+
+@contextmanager
+def _transaction(connection: sqlite3.Connection) -> Iterator[None]:
+    # Take the write lock right away, rather than failing to upgrade a read lock later on
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        yield
+    except BaseException:
+        connection.execute("ROLLBACK")
+        raise
+    else:
+        connection.execute("COMMIT")
+
+
+def close_connection() -> None:
+    """Close the connections of all threads."""
+    with _connection_lock:
+        for connection in _connections:
+            connection.close()
+        _connections.clear()
+
+
+_lock_file: Optional[IO[str]] = None
+
+
+def acquire_lock() -> None:
+    """Make sure that no other process of the service uses the database.
+
+    Queued jobs and pipelines in flight are admitted by a single process, which would not
+    know about those of other workers sharing the database.
+    """
+    global _lock_file
+
+    Path(config.DB_PATH).parent.mkdir(parents=True, exist_ok=True)
+    lock_file = open(config.DB_PATH + ".lock", "w")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock_file.close()
+        raise RuntimeError(
+            f"Database {config.DB_PATH} is in use by another process; "
+            "the service must run with a single worker"
+        )
+    _lock_file = lock_file
+
+
+def release_lock() -> None:
+    global _lock_file
+
+    if _lock_file is not None:
+        _lock_file.close()
+    _lock_file = None
+
+
+def get_submission(request_hash: str) -> Optional[str]:
+    """Return the id of the job created for the request with digest `request_hash`."""
+    row = (
+        get_connection()
+        .execute("SELECT job_id FROM submissions WHERE request_hash = ?", (request_hash,))
+        .fetchone()
+    )
+    return row[0] if row is not None else None
+
+
+def add_submission(request_hash: str, job_id: str) -> None:
+    get_connection().execute(
+        "INSERT OR REPLACE INTO submissions (request_hash, job_id, created_at) VALUES (?, ?, ?)",
+        (request_hash, job_id, time.time()),
+    )
+
+
+def delete_submissions(job_id: str) -> None:
+    get_connection().execute("DELETE FROM submissions WHERE job_id = ?", (job_id,))
+
+
+def add_job(job_record: JobRecord) -> None:
+    connection = get_connection()
+    with _transaction(connection):
+        connection.execute(
+            "INSERT OR REPLACE INTO jobs (job_id, context_hash, mutations, created_at) "
+            "VALUES (?, ?, ?, ?)",
+            (
+                job_record.job_id,
+                job_record.context_hash,
+                ",".join(job_record.mutations),
+                job_record.created_at,
+            ),
+        )
+        connection.execute("DELETE FROM job_pipelines WHERE job_id = ?", (job_record.job_id,))
+        connection.executemany(
+            "INSERT INTO job_pipelines (job_id, batch, pipeline_id, mutations) "
+            "VALUES (?, ?, ?, ?)",
+            [
+                (job_record.job_id, batch, pipeline_id, ",".join(mutations))
+                for batch, (pipeline_id, mutations) in enumerate(
+                    zip(job_record.pipeline_ids, job_record.pipeline_mutations)
+                )
+            ],
+        )
+
+
+def get_job(job_id: str) -> Optional[JobRecord]:
+    connection = get_connection()
+    row = connection.execute(
+        "SELECT job_id, context_hash, mutations, created_at FROM jobs WHERE job_id = ?",
+        (job_id,),
+    ).fetchone()
+    if row is None:
+        return None
+    pipeline_rows = connection.execute(
+        "SELECT pipeline_id, mutations FROM job_pipelines WHERE job_id = ? ORDER BY batch",
+        (job_id,),
+    ).fetchall()
+    job_id, context_hash, mutations, created_at = row
+    return JobRecord(
+        job_id,
+        [pipeline_id for pipeline_id, _ in pipeline_rows],
+        [pipeline_mutations.split(",") for _, pipeline_mutations in pipeline_rows],
+        context_hash,
+        mutations.split(","),
+        created_at,
+    )
+
+
+def get_jobs_by_pipeline(pipeline_id: int) -> List[JobRecord]:
+    rows = get_connection().execute(
+        "SELECT DISTINCT job_id FROM job_pipelines WHERE pipeline_id = ?", (pipeline_id,)
+    )
+    job_records = [get_job(job_id) for (job_id,) in rows.fetchall()]
+    return [job_record for job_record in job_records if job_record is not None]
+
+
+def delete_job(job_id: str) -> None:
+    connection = get_connection()
+    with _transaction(connection):
+        connection.execute("DELETE FROM jobs WHERE job_id = ?", (job_id,))
+        connection.execute("DELETE FROM job_pipelines WHERE job_id = ?", (job_id,))
+        connection.execute("DELETE FROM job_requests WHERE job_id = ?", (job_id,))
+        connection.execute("DELETE FROM job_state_transitions WHERE job_id = ?", (job_id,))
+
+
+def add_job_request(job_id: str, request: str) -> None:
+    get_connection().execute(
+        "INSERT OR REPLACE INTO job_requests (job_id, request) VALUES (?, ?)", (job_id, request)
+    )
+
+
+def get_job_request(job_id: str) -> Optional[str]:
+    row = (
+        get_connection()
+        .execute("SELECT request FROM job_requests WHERE job_id = ?", (job_id,))
+        .fetchone()
+    )
+    return row[0] if row is not None else None
+
+
+def add_state_transition(job_id: str, status: str, changed_at: str) -> bool:
+    """Record that job `job_id` reached `status`, unless that is already its last status.
+
+    Returns `True` if a transition was recorded.
+    """
+    connection = get_connection()
+    with _transaction(connection):
+        row = connection.execute(
+            "SELECT status FROM job_state_transitions WHERE job_id = ? "
+            "ORDER BY rowid DESC LIMIT 1",
+            (job_id,),
+        ).fetchone()
+        if row is not None and row[0] == status:
+            return False
+        connection.execute(
+            "INSERT INTO job_state_transitions (job_id, status, changed_at) VALUES (?, ?, ?)",
+            (job_id, status, changed_at),
+        )
+    return True
+
+
+def get_state_transitions(job_id: str) -> List[Tuple[str, str]]:
+    """Return the statuses reached by job `job_id`, and when, in chronological order."""
+    rows = get_connection().execute(
+        "SELECT status, changed_at FROM job_state_transitions WHERE job_id = ? ORDER BY rowid",
+        (job_id,),
+    )
+    return rows.fetchall()
+
+
+def set_result_location(pipeline_id: int, pipeline_job_id: int) -> None:
+    get_connection().execute(
+        "INSERT OR REPLACE INTO result_locations (pipeline_id, pipeline_job_id) VALUES (?, ?)",
+        (pipeline_id, pipeline_job_id),
+    )
+
+
+def get_result_location(pipeline_id: int) -> Optional[int]:
+    """Return the id of the GitLab job holding the results artifacts of a pipeline."""
+    row = (
+        get_connection()
+        .execute(
+            "SELECT pipeline_job_id FROM result_locations WHERE pipeline_id = ?", (pipeline_id,)
+        )
+        .fetchone()
+    )
+    return row[0] if row is not None else None
+
+
+def add_mutation_results(context_hash: str, results: Iterable[Dict[str, Any]]) -> None:
+    """Cache scores of mutations, skipping mutations which could not be evaluated."""
+    get_connection().executemany(
+        "INSERT OR REPLACE INTO mutation_results (context_hash, mutation, result) VALUES (?, ?, ?)",
+        (
+            (context_hash, result["mutation"], orjson.dumps(result).decode())
+            for result in results
+            if result.get("mutation") and not result.get("error_message")
+        ),
+    )
+
+
+def get_mutation_results(context_hash: str, mutations: List[str]) -> Dict[str, Dict[str, Any]]:
+    """Return cached scores for those `mutations` which have been evaluated before."""
+    mutation_results: Dict[str, Dict[str, Any]] = {}
+    connection = get_connection()
+    # Stay well below SQLite's limit on the number of query parameters
+    for start in range(0, len(mutations), 500):
+        chunk = mutations[start : start + 500]
+        rows = connection.execute(
+            "SELECT mutation, result FROM mutation_results "
+            f"WHERE context_hash = ? AND mutation IN ({', '.join('?' * len(chunk))})",
+            (context_hash, *chunk),
+        )
+        for mutation, result in rows:
+            mutation_results[mutation] = orjson.loads(result)
+    return mutation_results
+
+
+def set_pipeline_state(
+    pipeline_id: int,
+    pipeline_status: str,
+    job_state: JobState,
+    final_statuses: Collection[str] = (),
+) -> bool:
+    """Record the state of a pipeline, as well as the raw status reported by GitLab.
+
+    Pipelines whose recorded status is one of `final_statuses` keep it, unless the new status
+    is one of them as well. Returns `True` if the state was recorded.
+    """
+    placeholders = ", ".join("?" * len(final_statuses))
+    cursor = get_connection().execute(
+        "INSERT INTO pipeline_states "
+        "(pipeline_id, pipeline_status, status, state, updated_at) VALUES (?, ?, ?, ?, ?) "
+        "ON CONFLICT (pipeline_id) DO UPDATE SET pipeline_status = excluded.pipeline_status, "
+        "status = excluded.status, state = excluded.state, updated_at = excluded.updated_at "
+        f"WHERE pipeline_states.status NOT IN ({placeholders}) "
+        f"OR excluded.status IN ({placeholders})",
+        (
+            pipeline_id,
+            pipeline_status,
+            job_state.status,
+            job_state.json(),
+            time.time(),
+            *final_statuses,
+            *final_statuses,
+        ),
+    )
+    return cursor.rowcount > 0
+
+
+def delete_pipeline_states(pipeline_ids: Iterable[int]) -> None:
+    connection = get_connection()
+    with _transaction(connection):
+        connection.executemany(
+            "DELETE FROM pipeline_states WHERE pipeline_id = ?",
+            ((pipeline_id,) for pipeline_id in pipeline_ids),
+        )
+
+
+def get_pipeline_state(pipeline_id: int) -> Optional[Tuple[JobState, float]]:
+    """Return the recorded state of a pipeline and the time at which it was recorded."""
+    row = (
+        get_connection()
+        .execute(
+            "SELECT state, updated_at FROM pipeline_states WHERE pipeline_id = ?", (pipeline_id,)
+        )
+        .fetchone()
+    )
+    if row is None:
+        return None
+    return JobState.parse_raw(row[0]), row[1]
+
+
+def get_premature_failures(limit: Optional[int] = None) -> List[int]:
+    """Return ids of pipelines which failed before the job could produce any output."""
+    rows = get_connection().execute(
+        "SELECT pipeline_id FROM pipeline_states "
+        "WHERE pipeline_status = 'failed' AND status != 'failed' "
+        "ORDER BY updated_at LIMIT ?",
+        (-1 if limit is None else limit,),
+    )
+    return [pipeline_id for (pipeline_id,) in rows]
+
+
+def add_queued_job(queued_job: QueuedJob) -> None:
+    get_connection().execute(
+        "INSERT OR REPLACE INTO queued_jobs (job_id, client_id, request, context_hash, "
+        "mutations, mutation_batches, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (
+            queued_job.job_id,
+            queued_job.client_id,
+            queued_job.request.json(),
+            queued_job.context_hash,
+            ",".join(queued_job.mutations),
+            orjson.dumps(queued_job.mutation_batches).decode(),
+            queued_job.created_at,
+        ),
+    )
+
+
+def delete_queued_job(job_id: str) -> None:
+    get_connection().execute("DELETE FROM queued_jobs WHERE job_id = ?", (job_id,))
+
+
+def get_queued_jobs() -> List[QueuedJob]:
+    """Return jobs which have not created their pipelines yet, in the order they were queued."""
+    rows = get_connection().execute(
+        "SELECT job_id, client_id, request, context_hash, mutations, mutation_batches, "
+        "created_at FROM queued_jobs ORDER BY rowid"
+    )
+    return [
+        QueuedJob(
+            job_id,
+            client_id,
+            JobRequest.parse_raw(request),
+            context_hash,
+            mutations.split(","),
+            orjson.loads(batches),
+            created_at,
+        )
+        for job_id, client_id, request, context_hash, mutations, batches, created_at in rows
+    ]
+
+
+def add_pipelines_in_flight(client_id: str, pipeline_sizes: Dict[int, int]) -> None:
+    """Record pipelines of `client_id` in flight, along with the number of their mutations."""
+    get_connection().executemany(
+        "INSERT OR REPLACE INTO pipelines_in_flight (pipeline_id, client_id, size) "
+        "VALUES (?, ?, ?)",
+        ((pipeline_id, client_id, size) for pipeline_id, size in pipeline_sizes.items()),
+    )
+
+
+def delete_pipeline_in_flight(pipeline_id: int) -> None:
+    get_connection().execute(
+        "DELETE FROM pipelines_in_flight WHERE pipeline_id = ?", (pipeline_id,)
+    )
+
+
+def get_pipelines_in_flight() -> Dict[int, Tuple[str, int]]:
+    """Return the client owning each pipeline in flight, and the number of its mutations."""
+    rows = get_connection().execute("SELECT pipeline_id, client_id, size FROM pipelines_in_flight")
+    return {pipeline_id: (client_id, size) for pipeline_id, client_id, size in rows}
+
+
+def add_executor_run(
+    backend: str, work_dir: str, created_at: str, run_id: Optional[int] = None
+) -> int:
+    """Record a new run of an executor backend and return its id.
+
+    Backends which assign their own ids pass them as `run_id`.
+    """
+    cursor = get_connection().execute(
+        "INSERT INTO executor_runs (run_id, backend, status, work_dir, created_at) "
+        "VALUES (?, ?, 'pending', ?, ?)",
+        (run_id, backend, work_dir, created_at),
+    )
+    return cursor.lastrowid if run_id is None else run_id
+
+
+def get_executor_run(run_id: int) -> Optional[ExecutorRun]:
+    row = (
+        get_connection()
+        .execute(
+            "SELECT run_id, backend, status, work_dir, created_at, started_at, finished_at "
+            "FROM executor_runs WHERE run_id = ?",
+            (run_id,),
+        )
+        .fetchone()
+    )
+    return ExecutorRun(*row) if row is not None else None
+
+
+def get_executor_runs(backend: str, statuses: Collection[str]) -> List[ExecutorRun]:
+    """Return the runs of `backend` which have one of `statuses`, oldest first."""
+    rows = get_connection().execute(
+        "SELECT run_id, backend, status, work_dir, created_at, started_at, finished_at "
+        "FROM executor_runs WHERE backend = ? AND status IN ({}) ORDER BY run_id".format(
+            ", ".join("?" * len(statuses))
+        ),
+        (backend, *statuses),
+    )
+    return [ExecutorRun(*row) for row in rows]
+
+
+def update_executor_run(
+    run_id: int,
+    status: str,
+    started_at: Optional[str] = None,
+    finished_at: Optional[str] = None,
+    from_statuses: Optional[Collection[str]] = None,
+) -> bool:
+    """Set the status of a run, as well as its start and finish times unless already set.
+
+    If `from_statuses` is given, the run is only updated if its current status is one of them.
+    Returns `True` if the run was updated.
+    """
+    query = (
+        "UPDATE executor_runs SET status = ?, started_at = COALESCE(started_at, ?), "
+        "finished_at = COALESCE(finished_at, ?) WHERE run_id = ?"
+    )
+    params: List[Any] = [status, started_at, finished_at, run_id]
+    if from_statuses is not None:
+        query += " AND status IN ({})".format(", ".join("?" * len(from_statuses)))
+        params.extend(from_statuses)
+    cursor = get_connection().execute(query, params)
+    return cursor.rowcount > 0
+
+
+def add_known_failures(pipeline_ids: Iterable[int]) -> None:
+    """Remember pipelines which really failed, so that they are not checked again."""
+    now = time.time()
+    connection = get_connection()
+    with _transaction(connection):
+        connection.executemany(
+            "INSERT OR REPLACE INTO known_failures (pipeline_id, added_at) VALUES (?, ?)",
+            ((pipeline_id, now) for pipeline_id in pipeline_ids),
+        )
+        # Forget the oldest failures, which are the least likely to come up again
+        connection.execute(
+            "DELETE FROM known_failures WHERE added_at < ? OR pipeline_id IN ("
+            "SELECT pipeline_id FROM known_failures ORDER BY added_at DESC LIMIT -1 OFFSET ?)",
+            (now - config.KNOWN_FAILURES_MAX_AGE, config.KNOWN_FAILURES_MAXSIZE),
+        )
+
+
+def get_known_failures(pipeline_ids: List[int]) -> Set[int]:
+    """Return those `pipeline_ids` which are known to have really failed."""
+    known_failures: Set[int] = set()
+    connection = get_connection()
+    min_added_at = time.time() - config.KNOWN_FAILURES_MAX_AGE
+    for start in range(0, len(pipeline_ids), 500):
+        chunk = pipeline_ids[start : start + 500]
+        rows = connection.execute(
+            "SELECT pipeline_id FROM known_failures "
+            f"WHERE added_at >= ? AND pipeline_id IN ({', '.join('?' * len(chunk))})",
+            (min_added_at, *chunk),
+        )
+        known_failures.update(pipeline_id for (pipeline_id,) in rows)
+    return known_failures
+
+
+def get_watermark(name: str) -> Optional[str]:
+    row = (
+        get_connection().execute("SELECT value FROM watermarks WHERE name = ?", (name,)).fetchone()
+    )
+    return row[0] if row is not None else None
+
+
+def set_watermark(name: str, value: str) -> None:
+    get_connection().execute(
+        "INSERT OR REPLACE INTO watermarks (name, value) VALUES (?, ?)", (name, value)
+    )
+
+
+def add_job_results(job_id: str, results: List[Dict[str, Any]]) -> None:
+    """Index results of a finished job, so that they can be filtered and sorted efficiently.
+
+    Results of the least recently queried jobs are dropped from the index once it holds more
+    than `config.RESULTS_INDEX_MAX_ROWS` results.
+    """
+    columns = ["job_id", "idx", "mutation", "position", *SCORE_COLUMNS, "result"]
+    connection = get_connection()
+    with _transaction(connection):
+        connection.execute("DELETE FROM job_results WHERE job_id = ?", (job_id,))
+        connection.executemany(
+            f"INSERT INTO job_results ({', '.join(columns)}) "
+            f"VALUES ({', '.join('?' * len(columns))})",
+            (
+                (
+                    job_id,
+                    idx,
+                    result.get("mutation"),
+                    _get_position(result.get("mutation")),
+                    *(result.get(column) for column in SCORE_COLUMNS),
+                    orjson.dumps(result).decode(),
+                )
+                for idx, result in enumerate(results)
+            ),
+        )
+        connection.execute(
+            "INSERT OR REPLACE INTO indexed_jobs (job_id, num_results, used_at) VALUES (?, ?, ?)",
+            (job_id, len(results), time.time()),
+        )
+        rows = connection.execute(
+            "SELECT job_id, num_results FROM indexed_jobs ORDER BY used_at DESC, job_id = ? DESC",
+            (job_id,),
+        ).fetchall()
+        num_rows = 0
+        evicted_job_ids = []
+        for indexed_job_id, num_results in rows:
+            num_rows += num_results
+            # Results which were just indexed are kept, even if they do not fit
+            if num_rows > config.RESULTS_INDEX_MAX_ROWS and indexed_job_id != job_id:
+                evicted_job_ids.append((indexed_job_id,))
+        connection.executemany("DELETE FROM indexed_jobs WHERE job_id = ?", evicted_job_ids)
+        connection.executemany("DELETE FROM job_results WHERE job_id = ?", evicted_job_ids)
+
+
+def has_job_results(job_id: str) -> bool:
+    row = (
+        get_connection()
+        .execute("SELECT 1 FROM indexed_jobs WHERE job_id = ?", (job_id,))
+        .fetchone()
+    )
+    return row is not None
+
+
+def query_job_results(
+    job_id: str,
+    mutations: Optional[List[str]] = None,
+    positions: Optional[List[int]] = None,
+    sort_by: Optional[str] = None,
+    descending: bool = True,
+    offset: int = 0,
+    limit: Optional[int] = None,
+) -> List[str]:
+    """Return JSON-encoded results of job `job_id` matching the given criteria.
+
+    Results are returned in submission order unless `sort_by` is specified, in which case
+    results without a value in the `sort_by` column are omitted.
+    """
+    where = ["job_id = ?"]
+    params: List[Any] = [job_id]
+    if mutations is not None:
+        where.append(f"mutation IN ({', '.join('?' * len(mutations))})")
+        params.extend(mutations)
+    if positions is not None:
+        where.append(f"position IN ({', '.join('?' * len(positions))})")
+        params.extend(positions)
+    if sort_by is not None:
+        if sort_by not in SCORE_COLUMNS:
+            raise ValueError(f"Cannot sort results by {sort_by!r}")
+        where.append(f"{sort_by} IS NOT NULL")
+        order_by = f"{sort_by} {'DESC' if descending else 'ASC'}, idx"
+    else:
+        order_by = "idx"
+    connection = get_connection()
+    # Recently queried results are the last to be dropped from the index
+    connection.execute(
+        "UPDATE indexed_jobs SET used_at = ? WHERE job_id = ?", (time.time(), job_id)
+    )
+    rows = connection.execute(
+        f"SELECT result FROM job_results WHERE {' AND '.join(where)} "
+        f"ORDER BY {order_by} LIMIT ? OFFSET ?",
+        (*params, -1 if limit is None else limit, offset),
+    )
+    return [result for (result,) in rows]
+
+
+def delete_job_results(job_id: str) -> None:
+    connection = get_connection()
+    with _transaction(connection):
+        connection.execute("DELETE FROM indexed_jobs WHERE job_id = ?", (job_id,))
+        connection.execute("DELETE FROM job_results WHERE job_id = ?", (job_id,))
+
+
+def _get_position(mutation: Optional[str]) -> Optional[int]:
+    try:
+        return int(mutation[1:-1])  # type: ignore
+    except (TypeError, ValueError):
+        return None
@@ -0,0 +1,436 @@
+"""Backends running the pipelines which evaluate mutations.
+
+Pipelines run as GitLab CI pipelines by default. Set ``EXECUTOR_BACKEND=local`` to run them as
+subprocesses of the service, or ``EXECUTOR_BACKEND=slurm`` to submit them to a Slurm cluster.
+
+The local and Slurm backends run a command in a fresh work directory, with the mutations to
+evaluate given by the same environment variables as GitLab pipelines. The command must write
+``results/results.jsonl`` into the work directory, just like the pipeline job does.
+"""
+
+import abc
+import asyncio
+import functools
+import logging
+import os
+import shlex
+import shutil
+import uuid
+from pathlib import Path
+from typing import Dict, List, Optional, Set, Tuple
+
+from elaspic2_rest_api import config, db, gitlab_async, state, utils
+from elaspic2_rest_api.db import ExecutorRun
+from elaspic2_rest_api.gitlab import GitlabDeleteError, GitlabHttpError, get_pipeline_variables
+from elaspic2_rest_api.types import JobRequest, JobState
+
+logger = logging.getLogger(__name__)
+
+#: Path of the results file, relative to the work directory
+RESULTS_PATH = "results/results.jsonl"
+
+#: Statuses of runs which have finished
+FINISHED_STATUSES = {"success", "failed", "canceled"}
+
+#: Statuses of runs which have not finished yet
+UNFINISHED_STATUSES = {"pending", "running"}
+
+#: Number of finished runs kept in `state.queues["finished"]`
+MAX_FINISHED_RUNS = 1000
+
+#: File in the work directory holding the process id of the worker running the command
+WORKER_PID_PATH = "worker.pid"
+
+_backend: Optional["ExecutorBackend"] = None
+
+
+class ExecutorBackend(abc.ABC):
+    @abc.abstractmethod
+    async def create_job(self, request: JobRequest) -> int:
+        """Start evaluating the mutations in `request` and return the id of the new pipeline."""
+
+    @abc.abstractmethod
+    async def delete_job(self, job_id: int) -> None:
+        """Stop pipeline `job_id`, if it is still running, and remove it."""
+
+    @abc.abstractmethod
+    async def get_job_state(self, job_id: int) -> JobState:
+        """Get the state of pipeline `job_id`."""
+
+    @abc.abstractmethod
+    async def get_job_data(
+        self, job_id: int, collect_results: bool = False
+    ) -> Tuple[JobState, Optional[bytes]]:
+        """Get the state of a pipeline and, optionally, the contents of its results file."""
+
+    async def recover(self) -> None:
+        """Take over the pipelines left behind when the service was last stopped."""
+
+
+class GitLabBackend(ExecutorBackend):
+    async def create_job(self, request: JobRequest) -> int:
+        return await gitlab_async.create_job(request)
+
+    async def delete_job(self, job_id: int) -> None:
+        await gitlab_async.delete_job(job_id)
+
+    async def get_job_state(self, job_id: int) -> JobState:
+        job_state, _ = await gitlab_async.get_job_state(job_id, False)
+        return job_state
+
+    async def get_job_data(
+        self, job_id: int, collect_results: bool = False
+    ) -> Tuple[JobState, Optional[bytes]]:
+        return await gitlab_async.get_job_data(job_id, collect_results)
+
+
+class WorkDirBackend(ExecutorBackend):
+    """Base class for backends which keep runs in `config.EXECUTOR_WORK_DIR`."""
+
+    name: str
+
+    async def get_job_state(self, job_id: int) -> JobState:
+        return _make_job_state(await self._get_run(job_id))
+
+    async def get_job_data(
+        self, job_id: int, collect_results: bool = False
+    ) -> Tuple[JobState, Optional[bytes]]:
+        job_state = await self.get_job_state(job_id)
+        if not collect_results:
+            return job_state, None
+        run = await self._get_run(job_id)
+        loop = asyncio.get_running_loop()
+        try:
+            data = await loop.run_in_executor(None, Path(run.work_dir, RESULTS_PATH).read_bytes)
+        except FileNotFoundError:
+            raise GitlabHttpError(f"Results of job {job_id} not found", 404)
+        return job_state, data
+
+    async def _get_run(self, job_id: int) -> ExecutorRun:
+        loop = asyncio.get_running_loop()
+        run = await loop.run_in_executor(None, db.get_executor_run, job_id)
+        if run is None or run.backend != self.name:
+            raise GitlabHttpError(f"Job {job_id} not found", 404)
+        return run
+
+    async def _make_work_dir(self, request: JobRequest) -> Path:
+        work_dir = Path(config.EXECUTOR_WORK_DIR).joinpath(uuid.uuid4().hex)
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(
+            None, lambda: work_dir.joinpath("results").mkdir(parents=True, exist_ok=True)
+        )
+        await loop.run_in_executor(
+            None, work_dir.joinpath("request.json").write_text, request.json()
+        )
+        return work_dir
+
+    async def _finish(self, job_id: int, work_dir: str, status: Optional[str] = None) -> None:
+        """Mark a run as finished; it succeeded if it wrote its results, unless told otherwise.
+
+        Runs which have already finished, e.g. because they were canceled, are left alone.
+        """
+        loop = asyncio.get_running_loop()
+        if status is None:
+            has_results = await loop.run_in_executor(None, Path(work_dir, RESULTS_PATH).is_file)
+            status = "success" if has_results else "failed"
+        update = functools.partial(
+            db.update_executor_run,
+            job_id,
+            status,
+            finished_at=utils.utc_now(),
+            from_statuses=UNFINISHED_STATUSES,
+        )
+        await loop.run_in_executor(None, update)
+
+    async def _delete_run(self, job_id: int) -> ExecutorRun:
+        try:
+            run = await self._get_run(job_id)
+        except GitlabHttpError:
+            raise GitlabDeleteError(f"Job {job_id} not found", 404)
+        if run.status not in FINISHED_STATUSES:
+            await self._finish(job_id, run.work_dir, "canceled")
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, shutil.rmtree, run.work_dir, True)
+        return run
+
+
+class LocalBackend(WorkDirBackend):
+    """Run pipelines as subprocesses, at most `config.LOCAL_EXECUTOR_WORKERS` at a time.
+
+    Runs wait in ``state.queues["pending"]``, move to ``state.queues["working"]`` while their
+    command runs, and end up in ``state.queues["finished"]``. Queues are not shared between
+    processes, so each worker of the service runs the jobs which it created, and runs left
+    behind by stopped workers are taken over by `recover`.
+    """
+
+    name = "local"
+
+    def __init__(self) -> None:
+        self._environments: Dict[str, Dict[str, str]] = {}
+        self._processes: Dict[str, asyncio.subprocess.Process] = {}
+        self._tasks: Set["asyncio.Task[None]"] = set()
+
+    async def create_job(self, request: JobRequest) -> int:
+        if not config.LOCAL_EXECUTOR_COMMAND:
+            raise RuntimeError("LOCAL_EXECUTOR_COMMAND must be set to run jobs locally")
+        work_dir = await self._make_work_dir(request)
+        loop = asyncio.get_running_loop()
+        job_id = await loop.run_in_executor(
+            None, db.add_executor_run, self.name, str(work_dir), utils.utc_now()
+        )
+        self._environments[str(job_id)] = _get_environment(request)
+        state.queues["pending"].append(str(job_id))
+        self._dispatch()
+        return job_id
+
+    async def recover(self) -> None:
+        """Queue pending runs again, and fail runs whose worker is no longer running.
+
+        Runs are only ever started once, so runs queued by several workers are harmless.
+        """
+        loop = asyncio.get_running_loop()
+        runs = await loop.run_in_executor(
+            None, db.get_executor_runs, self.name, UNFINISHED_STATUSES
+        )
+        for run in runs:
+            job_id = str(run.run_id)
+            if run.status == "running":
+                if not await loop.run_in_executor(None, _is_worker_alive, job_id, run.work_dir):
+                    logger.warning("Run %s was interrupted by a restart", job_id)
+                    await self._finish(run.run_id, run.work_dir, "failed")
+            elif job_id not in state.queues["pending"] and job_id not in state.queues["working"]:
+                try:
+                    request = await loop.run_in_executor(
+                        None, JobRequest.parse_file, Path(run.work_dir, "request.json")
+                    )
+                except (OSError, ValueError) as e:
+                    logger.warning("Could not queue run %s again: %r", job_id, e)
+                    await self._finish(run.run_id, run.work_dir, "failed")
+                    continue
+                self._environments[job_id] = _get_environment(request)
+                state.queues["pending"].append(job_id)
+        self._dispatch()
+
+    async def delete_job(self, job_id: int) -> None:
+        run = await self._delete_run(job_id)
+        try:
+            state.queues["pending"].remove(str(run.run_id))
+        except ValueError:
+            pass
+        self._environments.pop(str(run.run_id), None)
+        process = self._processes.get(str(run.run_id))
+        if process is not None and process.returncode is None:
+            process.kill()
+
+    def _dispatch(self) -> None:
+        queues = state.queues
+        while queues["pending"] and len(queues["working"]) < config.LOCAL_EXECUTOR_WORKERS:
+            job_id = queues["pending"].popleft()
+            queues["working"].append(job_id)
+            task = asyncio.create_task(self._run(job_id))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, job_id: str) -> None:
+        loop = asyncio.get_running_loop()
+        try:
+            run = await loop.run_in_executor(None, db.get_executor_run, int(job_id))
+            # Runs which were deleted while pending have already been marked as canceled
+            if run is None or not await loop.run_in_executor(
+                None,
+                lambda: db.update_executor_run(
+                    run.run_id, "running", started_at=utils.utc_now(), from_statuses=["pending"]
+                ),
+            ):
+                return
+            await loop.run_in_executor(
+                None, Path(run.work_dir, WORKER_PID_PATH).write_text, str(os.getpid())
+            )
+            with open(os.path.join(run.work_dir, "log.txt"), "wb") as log_file:
+                process = await asyncio.create_subprocess_exec(
+                    *shlex.split(config.LOCAL_EXECUTOR_COMMAND or ""),
+                    cwd=run.work_dir,
+                    env={**os.environ, **self._environments.pop(job_id, {})},
+                    stdout=log_file,
+                    stderr=asyncio.subprocess.STDOUT,
+                )
+                self._processes[job_id] = process
+                if (await self._get_run(run.run_id)).status != "running":
+                    process.kill()
+                returncode = await process.wait()
+            await self._finish(run.run_id, run.work_dir, None if returncode == 0 else "failed")
+        except Exception:
+            logger.exception("Could not run job %s", job_id)
+            await loop.run_in_executor(
+                None,
+                lambda: db.update_executor_run(
+                    int(job_id), "failed", finished_at=utils.utc_now(), from_statuses=["running"]
+                ),
+            )
+        finally:
+            self._processes.pop(job_id, None)
+            state.queues["working"].remove(job_id)
+            state.queues["finished"].append(job_id)
+            while len(state.queues["finished"]) > MAX_FINISHED_RUNS:
+                state.queues["finished"].popleft()
+            self._dispatch()
+
+
+class SlurmBackend(WorkDirBackend):
+    """Submit pipelines to a Slurm cluster with ``sbatch`` and follow them with ``squeue``.
+
+    Runs are identified by their Slurm job ids. Once jobs have left the queue, ``sacct`` tells
+    how they ended, if accounting is enabled; jobs which completed succeeded if they wrote their
+    results and failed otherwise.
+    """
+
+    name = "slurm"
+
+    #: Slurm job states corresponding to each job status, for jobs which are still queued
+    SLURM_STATUSES = {
+        "PENDING": "pending",
+        "CONFIGURING": "running",
+        "RUNNING": "running",
+        "COMPLETING": "running",
+        "SUSPENDED": "running",
+    }
+
+    #: Statuses of jobs which ended in each Slurm job state, or `None` if their results decide
+    SLURM_FINAL_STATUSES = {
+        "COMPLETED": None,
+        "CANCELLED": "canceled",
+        "FAILED": "failed",
+        "TIMEOUT": "failed",
+        "OUT_OF_MEMORY": "failed",
+        "NODE_FAIL": "failed",
+        "BOOT_FAIL": "failed",
+        "DEADLINE": "failed",
+    }
+
+    async def create_job(self, request: JobRequest) -> int:
+        if not config.SLURM_BATCH_SCRIPT:
+            raise RuntimeError("SLURM_BATCH_SCRIPT must be set to run jobs on Slurm")
+        work_dir = await self._make_work_dir(request)
+        output = await _run_command(
+            [
+                "sbatch",
+                "--parsable",
+                f"--chdir={work_dir}",
+                f"--output={work_dir.joinpath('log.txt')}",
+                "--export=ALL",
+                *shlex.split(config.SLURM_SBATCH_ARGS),
+                config.SLURM_BATCH_SCRIPT,
+            ],
+            env={**os.environ, **_get_environment(request)},
+        )
+        # Output is "<job_id>" or "<job_id>;<cluster>"
+        job_id = int(output.strip().split(";")[0])
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(
+            None, db.add_executor_run, self.name, str(work_dir), utils.utc_now(), job_id
+        )
+        return job_id
+
+    async def delete_job(self, job_id: int) -> None:
+        await self._delete_run(job_id)
+        try:
+            await _run_command(["scancel", str(job_id)])
+        except RuntimeError as e:
+            logger.warning("Could not cancel Slurm job %s: %s", job_id, e)
+
+    async def get_job_state(self, job_id: int) -> JobState:
+        run = await self._get_run(job_id)
+        if run.status in FINISHED_STATUSES:
+            return _make_job_state(run)
+
+        try:
+            slurm_state = await _run_command(["squeue", "-h", "-j", str(job_id), "-o", "%T"])
+        except RuntimeError as e:
+            # Slurm no longer knows about jobs which finished a while ago
+            if "Invalid job id" not in str(e):
+                logger.warning("Could not get the state of Slurm job %s: %s", job_id, e)
+                return _make_job_state(run)
+            slurm_state = ""
+        slurm_state = slurm_state.strip()
+
+        if not slurm_state or slurm_state in self.SLURM_FINAL_STATUSES:
+            if not slurm_state:
+                slurm_state = await self._get_final_state(job_id)
+            await self._finish(job_id, run.work_dir, self.SLURM_FINAL_STATUSES.get(slurm_state))
+        elif slurm_state in self.SLURM_STATUSES:
+            status = self.SLURM_STATUSES[slurm_state]
+            if status != run.status:
+                started_at = utils.utc_now() if status == "running" else None
+                loop = asyncio.get_running_loop()
+                await loop.run_in_executor(None, db.update_executor_run, job_id, status, started_at)
+        else:
+            # Jobs which are e.g. requeued or preempted keep their last known status
+            logger.info("Slurm job %s is %s", job_id, slurm_state)
+        return _make_job_state(await self._get_run(job_id))
+
+    async def _get_final_state(self, job_id: int) -> str:
+        """Return the state in which a job left the queue, or "" if it is not known."""
+        try:
+            output = await _run_command(
+                ["sacct", "-n", "-X", "-P", "-j", str(job_id), "-o", "State"]
+            )
+        except RuntimeError as e:
+            logger.warning("Could not get the final state of Slurm job %s: %s", job_id, e)
+            return ""
+        # States such as "CANCELLED by 1000" say who did it
+        lines = output.strip().splitlines()
+        return lines[-1].split(" ")[0] if lines else ""
+
+
+def get_backend() -> ExecutorBackend:
+    """Return the backend selected by ``config.EXECUTOR_BACKEND``, creating it on first use."""
+    global _backend
+
+    if _backend is None:
+        backends = {"gitlab": GitLabBackend, "local": LocalBackend, "slurm": SlurmBackend}
+        try:
+            _backend = backends[config.EXECUTOR_BACKEND]()
+        except KeyError:
+            raise ValueError(f"Unsupported executor backend: {config.EXECUTOR_BACKEND!r}")
+    return _backend
+
+
+def _get_environment(request: JobRequest) -> Dict[str, str]:
+    return {v["key"]: v["value"] or "" for v in get_pipeline_variables(request)}  # type: ignore
+
+
+def _is_worker_alive(job_id: str, work_dir: str) -> bool:
+    """Return `True` if the worker which started running `job_id` is still running it."""
+    try:
+        pid = int(Path(work_dir, WORKER_PID_PATH).read_text())
+    except (OSError, ValueError):
+        return False
+    if pid == os.getpid():
+        return job_id in state.queues["working"]
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _make_job_state(run: ExecutorRun) -> JobState:
+    return JobState(
+        id=run.run_id,
+        status=run.status,
+        created_at=run.created_at,
+        started_at=run.started_at,
+        finished_at=run.finished_at,
+    )
+
+
+async def _run_command(args: List[str], env: Optional[Dict[str, str]] = None) -> str:
+    process = await asyncio.create_subprocess_exec(
+        *args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE, env=env
+    )
+    stdout, stderr = await process.communicate()
+    if process.returncode:
+        raise RuntimeError(f"{args[0]} failed: {stderr.decode(errors='replace').strip()}")
+    return stdout.decode()
@@ -1,15 +1,76 @@
-import json
 import math
-from typing import List, Optional, Tuple
+import threading
+from typing import Any, Dict, List, Mapping, Optional, Tuple
 
 import gitlab
+import orjson
+import requests
 from gitlab import GitlabDeleteError, GitlabHttpError  # noqa
 from gitlab.exceptions import GitlabGetError
+from gitlab.v4.objects import Project
+from requests.adapters import HTTPAdapter
 from requests.exceptions import ChunkedEncodingError
 
-from elaspic2_rest_api import config
+from elaspic2_rest_api import config, structure_store
 from elaspic2_rest_api.types import JobRequest, JobState, MutationResult
 
+#: Name of the pipeline job which evaluates mutations and uploads `results/` artifacts
+PIPELINE_JOB_NAME = "predict-mutation-effect"
+
+_client: Optional[gitlab.Gitlab] = None
+_project: Optional[Project] = None
+#: Guards both the client and the project, and is re-entrant so that the project can be
+#: created along with the client
+_client_lock = threading.RLock()
+
+
+def open_client() -> gitlab.Gitlab:
+    """Create the process-wide GitLab client, backed by a pooled keep-alive HTTP session."""
+    global _client, _project
+
+    with _client_lock:
+        if _client is not None:
+            return _client
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=config.GITLAB_POOL_MAXSIZE)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        _client = gitlab.Gitlab(
+            config.GITLAB_HOST_URL,
+            config.GITLAB_AUTH_TOKEN,
+            timeout=config.GITLAB_TIMEOUT,
+            session=session,
+        )
+        _project = None
+        return _client
+
+
+def close_client() -> None:
+    """Close the process-wide GitLab client and release pooled connections."""
+    global _client, _project
+
+    with _client_lock:
+        if _client is not None:
+            _client.session.close()
+        _client = None
+        _project = None
+
+
+def get_project() -> Project:
+    """Return a lazy handle to the ELASPIC2 jobs project.
+
+    The project is never fetched from the server; its managers only need the project id.
+    """
+    global _project
+
+    project = _project
+    if project is not None:
+        return project
+    with _client_lock:
+        if _project is None:
+            _project = open_client().projects.get(config.GITLAB_PROJECT_ID, lazy=True)
+        return _project
+
 
 def batch_mutations(mutations: str, batch_size: int = 4, max_chunks: int = 50) -> List[str]:
     mutation_list = mutations.split(",")
@@ -24,7 +85,7 @@ def batch_mutations(mutations: str, batch_size: int = 4, max_chunks: int = 50) -
     return mutation_batches
 
 
-def create_job(request: JobRequest) -> int:
+def get_pipeline_variables(request: JobRequest) -> List[Dict[str, Optional[str]]]:
     # mutation_batches = batch_mutations(request.mutations)
     # mutation_variables = [
     #     {"key": f"MUTATIONS_{i}", "value": request.mutations}
@@ -35,61 +96,82 @@ def create_job(request: JobRequest) -> int:
         {"key": "PROTEIN_SEQUENCE", "value": request.protein_sequence},
         {"key": "MUTATIONS", "value": request.mutations},
         {"key": "LIGAND_SEQUENCE", "value": request.ligand_sequence},
+        {
+            "key": "STRUCTURAL_TEMPLATE_URL",
+            "value": (
+                structure_store.get_url(request.structural_template)
+                if request.structural_template is not None
+                else None
+            ),
+        },
     ]
-    with gitlab.Gitlab(config.GITLAB_HOST_URL, config.GITLAB_AUTH_TOKEN) as gl:
-        project = gl.projects.get(config.GITLAB_PROJECT_ID)
-        pipeline = project.pipelines.create({"ref": "master", "variables": variables})
+    return variables
+
+
+def make_job_state(pipeline: Mapping[str, Any], input_data: Optional[bytes]) -> JobState:
+    """Convert a GitLab pipeline into a job state.
+
+    Pipelines that failed before the input file was written are reported as pending
+    because they are retried by the monitor.
+    """
+    return JobState(
+        id=pipeline["id"],
+        status=(
+            "pending" if pipeline["status"] == "failed" and not input_data else pipeline["status"]
+        ),
+        created_at=pipeline["created_at"],
+        started_at=pipeline["started_at"],
+        finished_at=pipeline["finished_at"],
+    )
+
+
+def parse_results(output_data: bytes) -> List[MutationResult]:
+    return [orjson.loads(line) for line in output_data.strip().split(b"\n") if line.strip()]
+
+
+def create_job(request: JobRequest) -> int:
+    variables = get_pipeline_variables(request)
+    project = get_project()
+    pipeline = project.pipelines.create({"ref": "master", "variables": variables})
     return pipeline.id
 
 
 def delete_job(job_id: int) -> None:
-    with gitlab.Gitlab(config.GITLAB_HOST_URL, config.GITLAB_AUTH_TOKEN) as gl:
-        project = gl.projects.get(config.GITLAB_PROJECT_ID)
-        project.pipelines.delete(job_id)
+    project = get_project()
+    project.pipelines.delete(job_id)
 
 
 def get_job_state(
     job_id: int, collect_results: bool = False
 ) -> Tuple[JobState, Optional[List[MutationResult]]]:
-    with gitlab.Gitlab(config.GITLAB_HOST_URL, config.GITLAB_AUTH_TOKEN) as gl:
-        project = gl.projects.get(config.GITLAB_PROJECT_ID)
-        pipeline = project.pipelines.get(job_id)
-
-        try:
-            pipeline_job = next(
-                (
-                    j
-                    for j in pipeline.jobs.list()
-                    if j.name == "predict-mutation-effect" and j.status == pipeline.status
-                )
+    project = get_project()
+    pipeline = project.pipelines.get(job_id)
+
+    try:
+        pipeline_job = next(
+            (
+                j
+                for j in pipeline.jobs.list()
+                if j.name == PIPELINE_JOB_NAME and j.status == pipeline.status
             )
-        except StopIteration:
-            raise GitlabHttpError
+        )
+    except StopIteration:
+        raise GitlabHttpError
+
+    job = project.jobs.get(pipeline_job.id, lazy=True)
 
-        job = project.jobs.get(pipeline_job.id, lazy=True)
+    try:
+        input_data = job.artifact("results/input.json")
+    except (GitlabGetError, ChunkedEncodingError):
+        input_data = None
 
+    if collect_results:
         try:
-            input_data = job.artifact("results/input.json")
+            output_data = job.artifact("results/results.jsonl")
         except (GitlabGetError, ChunkedEncodingError):
-            input_data = None
-
-        if collect_results:
-            try:
-                output_data = job.artifact("results/results.jsonl")
-            except (GitlabGetError, ChunkedEncodingError):
-                raise GitlabHttpError
-
-    job_state = JobState(
-        id=pipeline.id,
-        status="pending" if pipeline.status == "failed" and not input_data else pipeline.status,
-        created_at=pipeline.created_at,
-        started_at=pipeline.started_at,
-        finished_at=pipeline.finished_at,
-    )
-    job_result = (
-        [json.loads(line) for line in output_data.strip().split(b"\n") if line.strip()]
-        if collect_results
-        else None
-    )
+            raise GitlabHttpError
+
+    job_state = make_job_state(pipeline.attributes, input_data)
+    job_result = parse_results(output_data) if collect_results else None
 
     return job_state, job_result
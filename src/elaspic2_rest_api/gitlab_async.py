@@ -0,0 +1,172 @@
+"""Asyncio implementation of the GitLab job backend, built on a shared aiohttp session."""
+
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+import aiohttp
+from gitlab import GitlabCreateError, GitlabDeleteError, GitlabGetError, GitlabHttpError
+
+from elaspic2_rest_api import config, gitlab_ci, scheduler
+from elaspic2_rest_api.gitlab import (
+    PIPELINE_JOB_NAME,
+    get_pipeline_variables,
+    make_job_state,
+    parse_results,
+)
+from elaspic2_rest_api.types import JobRequest, JobState, MutationResult
+
+GITLAB_PROJECT_ENDPOINT = f"{config.GITLAB_HOST_URL}/api/v4/projects/{config.GITLAB_PROJECT_ID}"
+
+_session: Optional[aiohttp.ClientSession] = None
+
+
+def get_session() -> aiohttp.ClientSession:
+    """Return the process-wide aiohttp session, creating it on first use.
+
+    Must be called from within a running event loop.
+    """
+    global _session
+
+    if _session is None or _session.closed:
+        headers = {"PRIVATE-TOKEN": config.GITLAB_AUTH_TOKEN} if config.GITLAB_AUTH_TOKEN else {}
+        _session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=config.GITLAB_MAX_CONNECTIONS),
+            headers=headers,
+            timeout=aiohttp.ClientTimeout(total=config.GITLAB_TIMEOUT),
+        )
+    return _session
+
+
+async def close_session() -> None:
+    global _session
+
+    if _session is not None:
+        await _session.close()
+    _session = None
+
+
+async def create_job(request: JobRequest) -> int:
+    url = f"{GITLAB_PROJECT_ENDPOINT}/pipeline"
+    variables = get_pipeline_variables(request)
+    if config.CHILD_PIPELINE_MUTATIONS_PER_WORKER:
+        child_pipeline_config = gitlab_ci.render_template(
+            request, config.CHILD_PIPELINE_MUTATIONS_PER_WORKER
+        )
+        variables.append({"key": "CHILD_PIPELINE_CONFIG", "value": child_pipeline_config})
+    data = {"ref": "master", "variables": variables}
+    async with scheduler.request(
+        lambda: get_session().post(url, json=data), idempotent=False
+    ) as response:
+        if not response.ok:
+            raise GitlabCreateError(await response.text(), response.status)
+        pipeline = await response.json()
+    return pipeline["id"]
+
+
+async def delete_job(job_id: int) -> None:
+    url = f"{GITLAB_PROJECT_ENDPOINT}/pipelines/{job_id}"
+    async with scheduler.request(lambda: get_session().delete(url)) as response:
+        if not response.ok:
+            raise GitlabDeleteError(await response.text(), response.status)
+
+
+async def get_pipeline(job_id: int) -> Dict[str, Any]:
+    url = f"{GITLAB_PROJECT_ENDPOINT}/pipelines/{job_id}"
+    async with scheduler.request(lambda: get_session().get(url)) as response:
+        if not response.ok:
+            raise GitlabHttpError(await response.text(), response.status)
+        return await response.json()
+
+
+async def get_pipeline_job(pipeline: Dict[str, Any]) -> Dict[str, Any]:
+    """Return the pipeline job which evaluates mutations and holds the results artifacts.
+
+    The job is looked for in child pipelines, if the pipeline does not have it itself.
+    """
+    pipeline_jobs = await _list_pipeline_items(pipeline["id"], "jobs")
+    try:
+        return next(
+            (
+                j
+                for j in pipeline_jobs
+                if j["name"] == PIPELINE_JOB_NAME and j["status"] == pipeline["status"]
+            )
+        )
+    except StopIteration:
+        pass
+
+    bridges = await _list_pipeline_items(pipeline["id"], "bridges")
+    child_pipelines = [b["downstream_pipeline"] for b in bridges if b.get("downstream_pipeline")]
+    for child_pipeline in child_pipelines:
+        try:
+            return await get_pipeline_job(child_pipeline)
+        except GitlabHttpError:
+            continue
+    raise GitlabHttpError
+
+
+async def _list_pipeline_items(pipeline_id: int, kind: str) -> List[Dict[str, Any]]:
+    url = f"{GITLAB_PROJECT_ENDPOINT}/pipelines/{pipeline_id}/{kind}"
+    async with scheduler.request(
+        lambda: get_session().get(url, params={"per_page": "100"})
+    ) as response:
+        if not response.ok:
+            raise GitlabHttpError(await response.text(), response.status)
+        return await response.json()
+
+
+async def get_job_artifact(pipeline_job_id: int, artifact_path: str) -> bytes:
+    url = f"{GITLAB_PROJECT_ENDPOINT}/jobs/{pipeline_job_id}/artifacts/{artifact_path}"
+    try:
+        async with scheduler.request(lambda: get_session().get(url)) as response:
+            if not response.ok:
+                raise GitlabGetError(await response.text(), response.status)
+            return await response.read()
+    except aiohttp.ClientPayloadError as e:
+        raise GitlabGetError(str(e))
+
+
+@asynccontextmanager
+async def open_job_artifact(
+    pipeline_job_id: int, artifact_path: str
+) -> AsyncIterator[aiohttp.StreamReader]:
+    """Open an artifact for streaming, without loading it into memory."""
+    url = f"{GITLAB_PROJECT_ENDPOINT}/jobs/{pipeline_job_id}/artifacts/{artifact_path}"
+    # Large artifacts may take longer to download than the default timeout allows
+    timeout = aiohttp.ClientTimeout(total=None, sock_read=config.GITLAB_TIMEOUT)
+    async with scheduler.request(lambda: get_session().get(url, timeout=timeout)) as response:
+        if not response.ok:
+            raise GitlabGetError(await response.text(), response.status)
+        yield response.content
+
+
+async def get_job_data(
+    job_id: int, collect_results: bool = False
+) -> Tuple[JobState, Optional[bytes]]:
+    """Get the state of a job and, optionally, the raw contents of its `results.jsonl` file."""
+    pipeline = await get_pipeline(job_id)
+    pipeline_job = await get_pipeline_job(pipeline)
+
+    try:
+        input_data: Optional[bytes] = await get_job_artifact(
+            pipeline_job["id"], "results/input.json"
+        )
+    except GitlabGetError:
+        input_data = None
+
+    output_data: Optional[bytes] = None
+    if collect_results:
+        try:
+            output_data = await get_job_artifact(pipeline_job["id"], "results/results.jsonl")
+        except GitlabGetError:
+            raise GitlabHttpError
+
+    return make_job_state(pipeline, input_data), output_data
+
+
+async def get_job_state(
+    job_id: int, collect_results: bool = False
+) -> Tuple[JobState, Optional[List[MutationResult]]]:
+    job_state, output_data = await get_job_data(job_id, collect_results)
+    job_result = parse_results(output_data) if output_data is not None else None
+    return job_state, job_result
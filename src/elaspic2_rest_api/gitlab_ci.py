@@ -1,10 +1,24 @@
+"""Render the child pipelines which evaluate the mutations of a job in parallel.
+
+If ``CHILD_PIPELINE_MUTATIONS_PER_WORKER`` is set, the pipeline of each job is given the
+configuration of a child pipeline, rendered from ``templates/.gitlab-ci.yml.j2``, in the
+``CHILD_PIPELINE_CONFIG`` variable, and triggers it. The child pipeline evaluates batches of
+mutations in parallel jobs, so that a single job can use all available runners, and then merges
+their results into the ``results/`` artifacts of the job named ``PIPELINE_JOB_NAME``.
+"""
+
 from pathlib import Path
 from typing import Optional
 
 import jinja2
 
+from elaspic2_rest_api import structure_store
+from elaspic2_rest_api.gitlab import PIPELINE_JOB_NAME, batch_mutations
 from elaspic2_rest_api.types import JobRequest
 
+#: Maximum number of jobs which GitLab creates for a single `parallel:matrix` entry
+MAX_PARALLEL_JOBS = 200
+
 _templates_env: Optional[jinja2.Environment] = None
 
 
@@ -14,19 +28,37 @@ def get_templates_env() -> jinja2.Environment:
     if _templates_env is None:
         templates_dir = Path(__file__).resolve(strict=True).parent.joinpath("templates")
         templates_loader = jinja2.FileSystemLoader(templates_dir)
+        # Values are quoted with the `tojson` filter, since HTML escaping does not apply to YAML
         _templates_env = jinja2.Environment(
-            loader=templates_loader, autoescape=jinja2.select_autoescape(["yaml"])
+            loader=templates_loader,
+            autoescape=False,
+            trim_blocks=True,
+            lstrip_blocks=True,
+            undefined=jinja2.StrictUndefined,
         )
     return _templates_env
 
 
-def render_template(job_id: str, request: JobRequest, mutations_per_worker: int = 4) -> str:
+def render_template(request: JobRequest, mutations_per_worker: int = 4) -> str:
+    """Return the configuration of a child pipeline evaluating the mutations in `request`.
+
+    Mutations are evaluated by parallel jobs, each receiving a batch of `mutations_per_worker`
+    mutations (or more, for jobs with too many mutations for the number of parallel jobs).
+    """
     templates_env = get_templates_env()
     gitlab_ci_template = templates_env.get_template(".gitlab-ci.yml.j2")
     gitlab_ci_data = gitlab_ci_template.render(
-        job_id=job_id,
+        protein_structure_url=request.protein_structure_url,
         protein_sequence=request.protein_sequence,
-        ligand_sequence=request.protein_sequence,
-        structural_template=request.structural_template,
+        ligand_sequence=request.ligand_sequence or "",
+        structural_template_url=(
+            structure_store.get_url(request.structural_template)
+            if request.structural_template is not None
+            else ""
+        ),
+        mutation_batches=batch_mutations(
+            request.mutations, batch_size=mutations_per_worker, max_chunks=MAX_PARALLEL_JOBS
+        ),
+        results_job_name=PIPELINE_JOB_NAME,
     )
     return gitlab_ci_data
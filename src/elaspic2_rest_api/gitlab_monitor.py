@@ -1,13 +1,15 @@
 import asyncio
 import logging
-from typing import Any, Dict, List
+import time
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple
 from urllib.parse import urlencode
 
-import aiohttp
 from gitlab import GitlabHttpError
 
-from elaspic2_rest_api import config
-from elaspic2_rest_api.gitlab import get_job_state
+from elaspic2_rest_api import config, db, scheduler
+from elaspic2_rest_api.gitlab_async import get_job_state, get_session
+from elaspic2_rest_api.jobs import prefetch_job_results
 
 logger = logging.getLogger(__name__)
 
@@ -16,28 +18,150 @@ GITLAB_PIPELINES_ENDPOINT = (
     f"{config.GITLAB_HOST_URL}/api/v4/projects/{config.GITLAB_PROJECT_ID}/pipelines"
 )
 
-KNOWN_REAL_FAILURES = set()
+#: Number of seconds by which listings overlap, to allow for pipelines updated while listing
+WATERMARK_OVERLAP = 60
+
+
+#: Number of seconds for which succeeded pipelines are looked back on when first listed
+PREFETCH_MAX_AGE = 24 * 60 * 60
+
+
+class PipelineLister:
+    """List pipelines incrementally, fetching only those updated since the previous listing.
+
+    Pipelines are listed oldest first, and the last update time of the pipelines handled by the
+    caller is kept in the database as a watermark, so that listing resumes where it left off
+    after a restart or an error. The first page is requested conditionally, so that GitLab can
+    respond with ``304 Not Modified`` when nothing has changed.
+    """
+
+    def __init__(
+        self, name: str, params: List[Tuple[str, str]], max_age: Optional[float] = None
+    ) -> None:
+        self.name = name
+        self.params = params
+        #: Number of seconds to look back on if there is no watermark yet, or `None` for all
+        self.max_age = max_age
+        #: Number of pages fetched during the last listing
+        self.num_pages = 0
+        self._etag: Optional[str] = None
+        self._etag_url: Optional[str] = None
+
+    async def list_updated(self, session, max_pages: Optional[int] = None):
+        """List pipelines updated since the watermark, up to `max_pages` pages of them.
+
+        The watermark is only moved past the listed pipelines by `advance`.
+        """
+        loop = asyncio.get_running_loop()
+        watermark = await loop.run_in_executor(None, db.get_watermark, self.name)
+        params = [*self.params, ("order_by", "updated_at"), ("sort", "asc")]
+        if watermark is not None:
+            params.append(("updated_after", _subtract_seconds(watermark, WATERMARK_OVERLAP)))
+        elif self.max_age is not None:
+            params.append(("updated_after", _format_timestamp(time.time() - self.max_age)))
+        next_url = f"{GITLAB_PIPELINES_ENDPOINT}?{urlencode(params)}"
+
+        pipeline_infos: List[Dict[str, Any]] = []
+        self.num_pages = 0
+        while next_url is not None and (
+            max_pages is None
+            or self.num_pages < max_pages
+            # Pages holding only pipelines seen before would not move the watermark
+            or not _is_past_watermark(pipeline_infos, watermark)
+        ):
+            headers = _get_headers()
+            is_first_page = not self.num_pages
+            if is_first_page and self._etag is not None and self._etag_url == next_url:
+                headers.append(("If-None-Match", self._etag))
+            async with scheduler.request(
+                lambda: session.get(next_url, headers=headers)
+            ) as response:
+                if response.status == 304:
+                    break
+                if not response.ok:
+                    raise GitlabHttpError(await response.text(), response.status)
+                self.num_pages += 1
+                if is_first_page:
+                    self._etag, self._etag_url = response.headers.get("ETag"), next_url
+                pipeline_infos += await response.json()
+                try:
+                    next_url = response.links["next"]["url"]
+                except KeyError:
+                    next_url = None
+        logger.info("Fetched %s page(s) of %s", self.num_pages, self.name)
+        return pipeline_infos
+
+    async def advance(self, pipeline_infos) -> None:
+        """Move the watermark past `pipeline_infos`, once the caller has handled them."""
+        loop = asyncio.get_running_loop()
+        watermark = await loop.run_in_executor(None, db.get_watermark, self.name)
+        if _is_past_watermark(pipeline_infos, watermark):
+            updated_at = max(p["updated_at"] for p in pipeline_infos if p.get("updated_at"))
+            await loop.run_in_executor(None, db.set_watermark, self.name, updated_at)
+
+
+failed_pipelines = PipelineLister("failed_pipelines", [("per_page", "100"), ("status", "failed")])
+
+succeeded_pipelines = PipelineLister(
+    "succeeded_pipelines", [("per_page", "100"), ("status", "success")], PREFETCH_MAX_AGE
+)
 
 
 async def retry_failed_jobs_task():
     """Retry jobs that were prematurely marked as failed."""
-    async with aiohttp.ClientSession() as session:
-        while True:
-            pipeline_infos = await get_pipeline_infos(session)
-            pipeline_infos = await select_premature_failures(pipeline_infos)
+    scheduler.request_priority.set(scheduler.BACKGROUND_PRIORITY)
+    while True:
+        session = get_session()
+        if config.GITLAB_WEBHOOK_TOKEN:
+            # Premature failures are already known from pipeline events
+            loop = asyncio.get_running_loop()
+            pipeline_ids = await loop.run_in_executor(None, db.get_premature_failures, 100)
+            pipeline_infos = [{"id": pipeline_id} for pipeline_id in pipeline_ids]
             logger.info("Retrying %s pseudo-failed jobs", len(pipeline_infos))
             await retry_pipelines(session, pipeline_infos)
-            await asyncio.sleep(300)
+        else:
+            listed_pipeline_infos = await failed_pipelines.list_updated(session, max_pages=1)
+            # Pipelines are listed oldest first, so those left unchecked are listed again in
+            # the next cycle, as are those which could not be checked or retried
+            checked_pipeline_infos = listed_pipeline_infos[: config.MAX_FAILURE_CHECKS]
+            pipeline_infos = await select_premature_failures(checked_pipeline_infos, limit=None)
+            logger.info("Retrying %s pseudo-failed jobs", len(pipeline_infos))
+            await retry_pipelines(session, pipeline_infos)
+            await failed_pipelines.advance(checked_pipeline_infos)
+        await asyncio.sleep(300)
+
+
+async def prefetch_results_task():
+    """Download results of recently-succeeded jobs into the local results store."""
+    scheduler.request_priority.set(scheduler.BACKGROUND_PRIORITY)
+    while True:
+        session = get_session()
+        pipeline_infos = await succeeded_pipelines.list_updated(session, max_pages=1)
+        num_prefetched = 0
+        for pipeline_info in pipeline_infos:
+            try:
+                num_prefetched += await prefetch_job_results(pipeline_info["id"])
+            except GitlabHttpError:
+                logger.info("Could not find results for pipeline %s", pipeline_info["id"])
+        logger.info("Prefetched results for %s succeeded jobs", num_prefetched)
+        await succeeded_pipelines.advance(pipeline_infos)
+        await asyncio.sleep(120)
 
 
-async def get_pipeline_infos(session, params=[("per_page", "100"), ("status", "failed")]):
+async def get_pipeline_infos(
+    session,
+    params=[("per_page", "100"), ("status", "failed")],
+    max_pages: Optional[int] = None,
+):
     next_url = f"{GITLAB_PIPELINES_ENDPOINT}"
     if params:
         next_url += "?" + urlencode(params)
     pipeline_infos = []
-    while next_url is not None:
-        async with session.get(
-            next_url, headers=[("PRIVATE-TOKEN", config.GITLAB_AUTH_TOKEN)]
+    num_pages = 0
+    while next_url is not None and (max_pages is None or num_pages < max_pages):
+        num_pages += 1
+        async with scheduler.request(
+            lambda: session.get(next_url, headers=_get_headers())
         ) as response:
             pipeline_infos += await response.json()
             try:
@@ -48,46 +172,101 @@ async def get_pipeline_infos(session, params=[("per_page", "100"), ("status", "f
 
 
 async def retry_pipelines(session, pipeline_infos):
-    for pipeline_info in pipeline_infos:
-        url = f"{GITLAB_PIPELINES_ENDPOINT}/{pipeline_info['id']}/retry"
-        async with session.post(
-            url, headers=[("PRIVATE-TOKEN", config.GITLAB_AUTH_TOKEN)]
-        ) as response:
-            assert response.ok
+    statuses = await asyncio.gather(
+        *[
+            _send_pipeline_request(
+                session.post, f"{GITLAB_PIPELINES_ENDPOINT}/{pipeline_info['id']}/retry"
+            )
+            for pipeline_info in pipeline_infos
+        ]
+    )
+    # Pipelines which no longer exist would otherwise be retried again and again
+    missing_pipeline_ids = [
+        pipeline_info["id"]
+        for pipeline_info, status in zip(pipeline_infos, statuses)
+        if status == 404
+    ]
+    if missing_pipeline_ids:
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, db.delete_pipeline_states, missing_pipeline_ids)
 
 
 async def delete_pipelines(session, pipeline_infos):
-    for pipeline_info in pipeline_infos:
-        url = f"{GITLAB_PIPELINES_ENDPOINT}/{pipeline_info['id']}"
-        async with session.delete(
-            url, headers=[("PRIVATE-TOKEN", config.GITLAB_AUTH_TOKEN)]
-        ) as response:
-            assert response.ok
+    await asyncio.gather(
+        *[
+            _send_pipeline_request(
+                session.delete, f"{GITLAB_PIPELINES_ENDPOINT}/{pipeline_info['id']}"
+            )
+            for pipeline_info in pipeline_infos
+        ]
+    )
 
 
-async def select_premature_failures(pipeline_infos, limit: int = 100):
+async def _send_pipeline_request(method, url: str) -> int:
+    """Send a request about a pipeline and return the status of the response."""
+    async with scheduler.request(lambda: method(url, headers=_get_headers())) as response:
+        if not response.ok:
+            logger.warning("Request to %s failed with status %s", url, response.status)
+        return response.status
+
+
+async def select_premature_failures(pipeline_infos, limit: Optional[int] = 100):
+    """Select failed pipelines which failed before producing any output and should be retried.
+
+    Pipelines are checked concurrently, and those which really failed are remembered in
+    the database, so that no worker has to check them again.
+    """
+    pipeline_infos = [p for p in pipeline_infos if p["status"] == "failed"]
     loop = asyncio.get_running_loop()
+    known_failures = await loop.run_in_executor(
+        None, db.get_known_failures, [p["id"] for p in pipeline_infos]
+    )
+    pipeline_infos = [p for p in pipeline_infos if p["id"] not in known_failures]
 
-    select_pipeline_infos: List[Dict[str, Any]] = []
-    for pipeline_info in pipeline_infos:
-        if limit and len(select_pipeline_infos) >= limit:
-            break
+    semaphore = asyncio.Semaphore(config.FAILURE_CHECK_CONCURRENCY)
 
-        if pipeline_info["status"] != "failed":
-            continue
-        if pipeline_info["id"] in KNOWN_REAL_FAILURES:
-            continue
+    async def is_real_failure(pipeline_info) -> bool:
+        async with semaphore:
+            try:
+                job_state, _ = await get_job_state(pipeline_info["id"], False)
+            except GitlabHttpError:
+                logger.info("Could not find jobs associated with pipeline %s", pipeline_info["id"])
+                return False
+        return job_state.status == "failed"
+
+    real_failures = await asyncio.gather(*[is_real_failure(p) for p in pipeline_infos])
+    await loop.run_in_executor(
+        None,
+        db.add_known_failures,
+        [p["id"] for p, real_failure in zip(pipeline_infos, real_failures) if real_failure],
+    )
+
+    select_pipeline_infos: List[Dict[str, Any]] = [
+        p for p, real_failure in zip(pipeline_infos, real_failures) if not real_failure
+    ]
+    return select_pipeline_infos[:limit] if limit else select_pipeline_infos
+
+
+def _get_headers() -> List[Tuple[str, str]]:
+    return [("PRIVATE-TOKEN", config.GITLAB_AUTH_TOKEN)] if config.GITLAB_AUTH_TOKEN else []
+
+
+def _is_past_watermark(pipeline_infos, watermark: Optional[str]) -> bool:
+    """Return `True` if any of `pipeline_infos` was updated after `watermark`."""
+    return any(
+        p.get("updated_at") and (watermark is None or p["updated_at"] > watermark)
+        for p in pipeline_infos
+    )
+
+
+def _format_timestamp(timestamp: float) -> str:
+    value = datetime.utcfromtimestamp(timestamp)
+    return value.isoformat(timespec="milliseconds") + "Z"
 
-        try:
-            job_state, _ = await loop.run_in_executor(
-                None, get_job_state, pipeline_info["id"], False
-            )
-        except GitlabHttpError:
-            logger.info("Could not find jobs associated with pipeline %s", pipeline_info["id"])
-        else:
-            if job_state.status == "failed":
-                KNOWN_REAL_FAILURES.add(pipeline_info["id"])
-                continue
 
-        select_pipeline_infos.append(pipeline_info)
-    return select_pipeline_infos
+def _subtract_seconds(timestamp: str, seconds: float) -> str:
+    try:
+        value = datetime.strptime(timestamp, "%Y-%m-%dT%H:%M:%S.%fZ")
+    except ValueError:
+        return timestamp
+    return (value - timedelta(seconds=seconds)).isoformat(timespec="milliseconds") + "Z"
@@ -0,0 +1,227 @@
+"""Records of the jobs created by the service: their pipelines, requests and state transitions.
+
+Jobs are kept in the local SQLite database by default. Set ``JOB_STORE=firestore`` to keep them
+in Google Cloud Firestore instead, so that they are shared by all hosts running the service;
+this requires the optional ``google-cloud-firestore`` package.
+
+All methods perform blocking I/O and should be run in an executor.
+"""
+
+import abc
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from elaspic2_rest_api import config, db
+from elaspic2_rest_api.db import JobRecord
+from elaspic2_rest_api.types import JobRequest
+
+_job_store: Optional["JobStore"] = None
+_job_store_lock = threading.Lock()
+
+
+class JobStore(abc.ABC):
+    @abc.abstractmethod
+    def add_job(self, job_record: JobRecord, request: Optional[JobRequest] = None) -> None:
+        """Add a job, together with the request for which it was created."""
+
+    @abc.abstractmethod
+    def get_job(self, job_id: str) -> Optional[JobRecord]:
+        """Return the job with id `job_id`, or `None` if there is no such job."""
+
+    @abc.abstractmethod
+    def get_job_request(self, job_id: str) -> Optional[JobRequest]:
+        """Return the request for which job `job_id` was created, if it was stored."""
+
+    @abc.abstractmethod
+    def get_jobs_by_pipeline(self, pipeline_id: int) -> List[JobRecord]:
+        """Return all jobs which include pipeline `pipeline_id`."""
+
+    @abc.abstractmethod
+    def delete_job(self, job_id: str) -> None:
+        """Remove a job, along with its request, state transitions and submissions."""
+
+    @abc.abstractmethod
+    def get_submission(self, request_hash: str) -> Optional[str]:
+        """Return the id of the job created for the request with digest `request_hash`."""
+
+    @abc.abstractmethod
+    def add_submission(self, request_hash: str, job_id: str) -> None:
+        """Record that job `job_id` was created for the request with digest `request_hash`."""
+
+    @abc.abstractmethod
+    def add_state_transition(self, job_id: str, status: str, changed_at: str) -> bool:
+        """Record that a job reached `status`, unless that is already its last status.
+
+        Returns `True` if a transition was recorded.
+        """
+
+    @abc.abstractmethod
+    def get_state_transitions(self, job_id: str) -> List[Tuple[str, str]]:
+        """Return the statuses reached by a job, and when, in chronological order."""
+
+    @abc.abstractmethod
+    def set_result_location(self, pipeline_id: int, pipeline_job_id: int) -> None:
+        """Record the id of the GitLab job holding the results artifacts of a pipeline."""
+
+    @abc.abstractmethod
+    def get_result_location(self, pipeline_id: int) -> Optional[int]:
+        """Return the id of the GitLab job holding the results artifacts of a pipeline."""
+
+
+class SQLiteJobStore(JobStore):
+    def add_job(self, job_record: JobRecord, request: Optional[JobRequest] = None) -> None:
+        db.add_job(job_record)
+        if request is not None:
+            db.add_job_request(job_record.job_id, request.json())
+
+    def get_job(self, job_id: str) -> Optional[JobRecord]:
+        return db.get_job(job_id)
+
+    def get_job_request(self, job_id: str) -> Optional[JobRequest]:
+        request = db.get_job_request(job_id)
+        return JobRequest.parse_raw(request) if request is not None else None
+
+    def get_jobs_by_pipeline(self, pipeline_id: int) -> List[JobRecord]:
+        return db.get_jobs_by_pipeline(pipeline_id)
+
+    def delete_job(self, job_id: str) -> None:
+        db.delete_job(job_id)
+        db.delete_submissions(job_id)
+
+    def get_submission(self, request_hash: str) -> Optional[str]:
+        return db.get_submission(request_hash)
+
+    def add_submission(self, request_hash: str, job_id: str) -> None:
+        db.add_submission(request_hash, job_id)
+
+    def add_state_transition(self, job_id: str, status: str, changed_at: str) -> bool:
+        return db.add_state_transition(job_id, status, changed_at)
+
+    def get_state_transitions(self, job_id: str) -> List[Tuple[str, str]]:
+        return db.get_state_transitions(job_id)
+
+    def set_result_location(self, pipeline_id: int, pipeline_job_id: int) -> None:
+        db.set_result_location(pipeline_id, pipeline_job_id)
+
+    def get_result_location(self, pipeline_id: int) -> Optional[int]:
+        return db.get_result_location(pipeline_id)
+
+
+class FirestoreJobStore(JobStore):
+    """Keep jobs in Google Cloud Firestore.
+
+    Each job is a document in the ``jobs`` collection, holding its pipelines, request and
+    state transitions, so that reading a job takes a single lookup.
+    """
+
+    def __init__(self) -> None:
+        from google.cloud import firestore
+
+        self._firestore = firestore
+        self._client = firestore.Client()
+        self._jobs = self._client.collection("jobs")
+        self._submissions = self._client.collection("submissions")
+        self._result_locations = self._client.collection("result_locations")
+
+    def add_job(self, job_record: JobRecord, request: Optional[JobRequest] = None) -> None:
+        self._jobs.document(job_record.job_id).set(
+            {
+                "context_hash": job_record.context_hash,
+                "mutations": job_record.mutations,
+                "created_at": job_record.created_at,
+                "pipeline_ids": job_record.pipeline_ids,
+                # Firestore does not support nested arrays
+                "pipeline_mutations": [",".join(m) for m in job_record.pipeline_mutations],
+                "request": request.dict() if request is not None else None,
+                "state_transitions": [],
+            }
+        )
+
+    def get_job(self, job_id: str) -> Optional[JobRecord]:
+        data = self._get_job_data(job_id)
+        return self._make_job_record(job_id, data) if data is not None else None
+
+    def get_job_request(self, job_id: str) -> Optional[JobRequest]:
+        data = self._get_job_data(job_id)
+        if data is None or data.get("request") is None:
+            return None
+        return JobRequest(**data["request"])
+
+    def get_jobs_by_pipeline(self, pipeline_id: int) -> List[JobRecord]:
+        query = self._jobs.where("pipeline_ids", "array_contains", pipeline_id)
+        return [self._make_job_record(doc.id, doc.to_dict()) for doc in query.stream()]
+
+    def delete_job(self, job_id: str) -> None:
+        batch = self._client.batch()
+        batch.delete(self._jobs.document(job_id))
+        for doc in self._submissions.where("job_id", "==", job_id).stream():
+            batch.delete(doc.reference)
+        batch.commit()
+
+    def get_submission(self, request_hash: str) -> Optional[str]:
+        doc = self._submissions.document(request_hash).get()
+        return doc.to_dict()["job_id"] if doc.exists else None
+
+    def add_submission(self, request_hash: str, job_id: str) -> None:
+        self._submissions.document(request_hash).set({"job_id": job_id, "created_at": time.time()})
+
+    def add_state_transition(self, job_id: str, status: str, changed_at: str) -> bool:
+        job_ref = self._jobs.document(job_id)
+
+        @self._firestore.transactional
+        def add_state_transition(transaction: Any) -> bool:
+            doc = job_ref.get(transaction=transaction)
+            if not doc.exists:
+                return False
+            state_transitions = doc.to_dict().get("state_transitions", [])
+            if state_transitions and state_transitions[-1]["status"] == status:
+                return False
+            state_transitions.append({"status": status, "changed_at": changed_at})
+            transaction.update(job_ref, {"state_transitions": state_transitions})
+            return True
+
+        return add_state_transition(self._client.transaction())
+
+    def get_state_transitions(self, job_id: str) -> List[Tuple[str, str]]:
+        data = self._get_job_data(job_id)
+        if data is None:
+            return []
+        return [(t["status"], t["changed_at"]) for t in data.get("state_transitions", [])]
+
+    def set_result_location(self, pipeline_id: int, pipeline_job_id: int) -> None:
+        self._result_locations.document(str(pipeline_id)).set({"pipeline_job_id": pipeline_job_id})
+
+    def get_result_location(self, pipeline_id: int) -> Optional[int]:
+        doc = self._result_locations.document(str(pipeline_id)).get()
+        return doc.to_dict()["pipeline_job_id"] if doc.exists else None
+
+    def _get_job_data(self, job_id: str) -> Optional[Dict[str, Any]]:
+        doc = self._jobs.document(job_id).get()
+        return doc.to_dict() if doc.exists else None
+
+    @staticmethod
+    def _make_job_record(job_id: str, data: Dict[str, Any]) -> JobRecord:
+        return JobRecord(
+            job_id,
+            data["pipeline_ids"],
+            [m.split(",") for m in data["pipeline_mutations"]],
+            data["context_hash"],
+            data["mutations"],
+            data["created_at"],
+        )
+
+
+def get_job_store() -> JobStore:
+    """Return the job store selected by ``config.JOB_STORE``, creating it on first use."""
+    global _job_store
+
+    with _job_store_lock:
+        if _job_store is None:
+            if config.JOB_STORE == "firestore":
+                _job_store = FirestoreJobStore()
+            elif config.JOB_STORE == "sqlite":
+                _job_store = SQLiteJobStore()
+            else:
+                raise ValueError(f"Unsupported job store: {config.JOB_STORE!r}")
+        return _job_store
@@ -1,5 +1,937 @@
-def run_job(data: dict) -> None:
-    # 1. Run `sbatch` to submit job and get job id.
-    # 2. Monitor using `squeue` until the job with the obtained job id stops running.
-    # 3. If results are in the database: success. Else: failure.
-    pass
+import asyncio
+import functools
+import logging
+import time
+import uuid
+from typing import Any, AsyncIterator, Dict, List, Optional, Union
+
+import aiohttp
+import orjson
+
+from elaspic2_rest_api import (
+    config,
+    db,
+    gitlab_async,
+    results_store,
+    scheduler,
+    structure_store,
+    utils,
+)
+from elaspic2_rest_api.admission import AdmissionQueue, AdmissionRejected
+from elaspic2_rest_api.cache import TTLCache
+from elaspic2_rest_api.db import JobRecord, QueuedJob
+from elaspic2_rest_api.executors import GitLabBackend, get_backend
+from elaspic2_rest_api.gitlab import GitlabGetError, GitlabHttpError, batch_mutations, parse_results
+from elaspic2_rest_api.job_store import get_job_store
+from elaspic2_rest_api.types import JobRequest, JobState, LoadState
+
+logger = logging.getLogger(__name__)
+
+#: Job statuses which never change once reached
+TERMINAL_STATUSES = {"success", "failed", "canceled", "skipped"}
+
+#: Pipeline states, with running and pending pipelines expiring after
+#: `config.JOB_STATE_CACHE_TTL` seconds
+job_state_cache: TTLCache[JobState] = TTLCache(
+    maxsize=config.JOB_STATE_CACHE_MAXSIZE, ttl=config.JOB_STATE_CACHE_TTL
+)
+
+#: Last status recorded in the job store for each job, to avoid recording it again
+_recorded_statuses: TTLCache[str] = TTLCache(maxsize=config.JOB_STATE_CACHE_MAXSIZE, ttl=None)
+
+#: Statuses of jobs which should not be reused for duplicate submissions
+UNUSABLE_STATUSES = {"failed", "canceled", "skipped"}
+
+#: Number of bytes read at a time when streaming results
+RESULTS_CHUNK_SIZE = 64 * 1024
+
+#: Submissions which are currently being created, keyed by request digest
+_pending_submissions: Dict[str, "asyncio.Task[str]"] = {}
+
+#: Results indexes which are currently being built, keyed by job id
+_pending_indexes: Dict[str, "asyncio.Task[None]"] = {}
+
+#: Watchers of jobs which clients are waiting on, keyed by job id
+_job_watchers: Dict[str, "JobWatcher"] = {}
+
+#: Client to which jobs are attributed when submitted without a client id
+DEFAULT_CLIENT_ID = "anonymous"
+
+#: Jobs waiting for their turn to create pipelines, shared fairly between clients. Queued jobs
+#: and pipelines in flight are also recorded in the database, to be restored after a restart
+admission_queue = AdmissionQueue(
+    config.MAX_PIPELINES_IN_FLIGHT,
+    config.MAX_PIPELINES_PER_CLIENT,
+    max_queued_work=config.MAX_QUEUED_MUTATIONS,
+    max_queued_work_per_client=config.MAX_QUEUED_MUTATIONS_PER_CLIENT,
+    throughput_window=config.THROUGHPUT_WINDOW,
+    max_wait=config.ADMISSION_MAX_WAIT,
+)
+
+
+#: Jobs which have not created their pipelines yet, keyed by job id
+_queued_jobs: Dict[str, QueuedJob] = {}
+
+#: Queued jobs which are creating their pipelines, keyed by job id
+_starting_jobs: Dict[str, "asyncio.Task[str]"] = {}
+
+#: States of queued jobs which could not create their pipelines
+_failed_queued_jobs: TTLCache[JobState] = TTLCache(maxsize=config.JOB_STATE_CACHE_MAXSIZE, ttl=None)
+
+
+async def submit_job(request: JobRequest, client_id: str = DEFAULT_CLIENT_ID) -> str:
+    """Create a job for `request`, or return the job already created for the same work.
+
+    New jobs are queued behind those of other clients if too many pipelines are in flight,
+    and `AdmissionRejected` is raised if too much work is queued already.
+    """
+    request_hash = utils.get_request_hash(request)
+
+    # Identical requests arriving at the same time share a single submission
+    task = _pending_submissions.get(request_hash)
+    if task is None:
+        task = asyncio.create_task(_submit_job(request, request_hash, client_id))
+        _pending_submissions[request_hash] = task
+        task.add_done_callback(lambda _: _pending_submissions.pop(request_hash, None))
+    return await asyncio.shield(task)
+
+
+async def submit_jobs(
+    requests: List[JobRequest], client_id: str = DEFAULT_CLIENT_ID
+) -> List[Union[str, Exception]]:
+    """Create jobs for many requests, up to `config.BATCH_SUBMIT_CONCURRENCY` at a time.
+
+    Identical requests share a single job. Errors are returned in place of the ids of jobs
+    which could not be created, so that they do not affect the rest of the batch.
+    """
+    semaphore = asyncio.Semaphore(config.BATCH_SUBMIT_CONCURRENCY)
+
+    async def submit_job_(request: JobRequest) -> str:
+        async with semaphore:
+            return await submit_job(request, client_id)
+
+    requests_by_hash = {utils.get_request_hash(request): request for request in requests}
+    job_ids = await asyncio.gather(
+        *[submit_job_(request) for request in requests_by_hash.values()],
+        return_exceptions=True,
+    )
+    for job_id in job_ids:
+        if isinstance(job_id, BaseException) and not isinstance(job_id, Exception):
+            raise job_id
+    job_ids_by_hash = dict(zip(requests_by_hash, job_ids))
+    return [job_ids_by_hash[utils.get_request_hash(request)] for request in requests]
+
+
+async def _submit_job(request: JobRequest, request_hash: str, client_id: str) -> str:
+    job_id = await _find_reusable_job(request_hash)
+    if job_id is None:
+        job_id = await _create_job(request, client_id)
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, get_job_store().add_submission, request_hash, job_id)
+    return job_id
+
+
+async def _find_reusable_job(request_hash: str) -> Optional[str]:
+    loop = asyncio.get_running_loop()
+    job_id = await loop.run_in_executor(None, get_job_store().get_submission, request_hash)
+    if job_id is None:
+        return None
+
+    try:
+        job_state = await get_job_state(job_id)
+    except GitlabHttpError:
+        logger.info("Job %s for request %s no longer exists", job_id, request_hash)
+        return None
+    if job_state.status in UNUSABLE_STATUSES:
+        return None
+    return job_id
+
+
+async def _create_job(request: JobRequest, client_id: str) -> str:
+    """Create a job, sending to GitLab only those mutations which have never been evaluated.
+
+    Large jobs are split into batches which run as separate pipelines in parallel.
+    Jobs which start right away and need a single pipeline use the pipeline id as their job id.
+    Other jobs get a local id, and jobs with all mutations already cached are finished
+    immediately.
+    """
+    context_hash = utils.get_context_hash(request)
+    mutations = utils.split_mutations(request.mutations)
+
+    loop = asyncio.get_running_loop()
+    cached_results = await loop.run_in_executor(
+        None, db.get_mutation_results, context_hash, mutations
+    )
+    uncached_mutations = [m for m in mutations if m not in cached_results]
+
+    if not uncached_mutations:
+        job_record = JobRecord(uuid.uuid4().hex, [], [], context_hash, mutations, utils.utc_now())
+        await loop.run_in_executor(None, get_job_store().add_job, job_record, request)
+        return job_record.job_id
+
+    mutation_batches = _make_mutation_batches(uncached_mutations)
+    if not admission_queue.has_capacity(client_id, len(mutation_batches)):
+        excess_work = admission_queue.get_excess_work(client_id, len(uncached_mutations))
+        if excess_work > 0:
+            raise AdmissionRejected(
+                "Too many mutations are waiting to be evaluated", _get_retry_after(excess_work)
+            )
+
+    if structure_store.is_enabled():
+        # Download the structure while the job waits for its turn
+        structure_store.prefetch(request.protein_structure_url)
+
+    queued_job = QueuedJob(
+        uuid.uuid4().hex,
+        client_id,
+        request,
+        context_hash,
+        mutations,
+        mutation_batches,
+        utils.utc_now(),
+    )
+    # Queued jobs are kept in the database, so that they survive restarts
+    await loop.run_in_executor(None, db.add_queued_job, queued_job)
+    _queued_jobs[queued_job.job_id] = queued_job
+    admission_queue.push(
+        queued_job.job_id, client_id, len(uncached_mutations), len(queued_job.mutation_batches)
+    )
+    if not _admit_queued_jobs(queued_job.job_id):
+        logger.info("Queued job %s of client %s", queued_job.job_id, client_id)
+        return queued_job.job_id
+    return await _start_job(queued_job, started_on_submit=True)
+
+
+def _admit_queued_jobs(job_id: Optional[str] = None) -> bool:
+    """Start the queued jobs which may now run, except `job_id`, which the caller starts itself.
+
+    Returns `True` if `job_id` was admitted.
+    """
+    admitted = False
+    for entry in admission_queue.pop_admissible():
+        if entry.job_id == job_id:
+            admitted = True
+            continue
+        task = asyncio.create_task(_start_job(_queued_jobs[entry.job_id]))
+        _starting_jobs[entry.job_id] = task
+        task.add_done_callback(lambda _, job_id=entry.job_id: _starting_jobs.pop(job_id, None))
+    return admitted
+
+
+async def _start_job(queued_job: QueuedJob, started_on_submit: bool = False) -> str:
+    """Create the pipelines of an admitted job and record the job.
+
+    Errors are raised for jobs started on submission, and are reported as the state of the job
+    for jobs which had to wait in the queue.
+    """
+    num_pipelines = len(queued_job.mutation_batches)
+    try:
+        request = await _use_stored_structure(queued_job.request)
+        pipeline_ids = await _create_pipelines(request, queued_job.mutation_batches)
+    except Exception as e:
+        _queued_jobs.pop(queued_job.job_id, None)
+        admission_queue.add_pipelines(queued_job.client_id, {}, num_pipelines)
+        _admit_queued_jobs()
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, db.delete_queued_job, queued_job.job_id)
+        if started_on_submit:
+            raise
+        logger.warning("Could not start queued job %s: %r", queued_job.job_id, e)
+        job_state = JobState(
+            id=queued_job.job_id,
+            status="failed",
+            created_at=queued_job.created_at,
+            finished_at=utils.utc_now(),
+        )
+        _failed_queued_jobs.set(queued_job.job_id, job_state)
+        _wake_up_job_watcher(queued_job.job_id)
+        return queued_job.job_id
+    pipeline_sizes = {
+        pipeline_id: mutation_batch.count(",") + 1
+        for pipeline_id, mutation_batch in zip(pipeline_ids, queued_job.mutation_batches)
+    }
+    admission_queue.add_pipelines(queued_job.client_id, pipeline_sizes, num_pipelines)
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(
+        None, db.add_pipelines_in_flight, queued_job.client_id, pipeline_sizes
+    )
+
+    if started_on_submit and len(pipeline_ids) == 1:
+        job_id = str(pipeline_ids[0])
+    else:
+        job_id = queued_job.job_id
+    job_record = JobRecord(
+        job_id,
+        pipeline_ids,
+        [mutation_batch.split(",") for mutation_batch in queued_job.mutation_batches],
+        queued_job.context_hash,
+        queued_job.mutations,
+        queued_job.created_at,
+    )
+    await loop.run_in_executor(None, get_job_store().add_job, job_record, queued_job.request)
+    await loop.run_in_executor(None, db.delete_queued_job, queued_job.job_id)
+    _queued_jobs.pop(queued_job.job_id, None)
+    _wake_up_job_watcher(job_id)
+    return job_id
+
+
+async def _use_stored_structure(request: JobRequest) -> JobRequest:
+    """Point pipelines to the copy of the structure kept in the structure store, if possible.
+
+    Structures are fetched again if they were evicted while the job was queued, whereas jobs
+    whose structural template was evicted cannot start.
+    """
+    if not structure_store.is_enabled():
+        return request
+    loop = asyncio.get_running_loop()
+    if request.structural_template is not None and not await loop.run_in_executor(
+        None, structure_store.get_object_path, request.structural_template, True
+    ):
+        raise structure_store.StructureFetchError(
+            f"Structural template {request.structural_template} is no longer available"
+        )
+    try:
+        reference = await structure_store.get_reference(request.protein_structure_url)
+    except (
+        structure_store.StructureFetchError,
+        structure_store.StructureTooLargeError,
+        aiohttp.ClientError,
+        asyncio.TimeoutError,
+    ) as e:
+        logger.warning(
+            "Could not store structure %s, leaving it to pipelines: %r",
+            request.protein_structure_url,
+            e,
+        )
+        return request
+    return request.copy(update={"protein_structure_url": reference})
+
+
+def _make_mutation_batches(mutations: List[str]) -> List[str]:
+    if len(mutations) <= config.FANOUT_MUTATIONS_PER_PIPELINE:
+        return [",".join(mutations)]
+    return batch_mutations(
+        ",".join(mutations),
+        batch_size=config.FANOUT_MUTATIONS_PER_PIPELINE,
+        max_chunks=config.FANOUT_MAX_PIPELINES,
+    )
+
+
+async def _create_pipelines(request: JobRequest, mutation_batches: List[str]) -> List[int]:
+    pipeline_ids = await asyncio.gather(
+        *[
+            get_backend().create_job(request.copy(update={"mutations": mutation_batch}))
+            for mutation_batch in mutation_batches
+        ],
+        return_exceptions=True,
+    )
+
+    errors = [e for e in pipeline_ids if isinstance(e, BaseException)]
+    if errors:
+        # Do not leave behind pipelines belonging to a job which was never created
+        await asyncio.gather(
+            *[get_backend().delete_job(p) for p in pipeline_ids if isinstance(p, int)],
+            return_exceptions=True,
+        )
+        raise errors[0]
+    return [pipeline_id for pipeline_id in pipeline_ids if isinstance(pipeline_id, int)]
+
+
+def _get_retry_after(work: int) -> int:
+    """Return the number of seconds it should take for `work` queued mutations to start."""
+    wait = admission_queue.estimate_wait(work)
+    if wait is None:
+        return config.DEFAULT_RETRY_AFTER
+    return max(1, min(config.MAX_RETRY_AFTER, round(wait)))
+
+
+def get_load() -> LoadState:
+    """Report how busy runners are and how much work is waiting for them."""
+    throughput = admission_queue.get_throughput()
+    return LoadState(
+        pipelines_in_flight=admission_queue.num_in_flight,
+        max_pipelines_in_flight=admission_queue.max_in_flight,
+        queued_jobs=len(admission_queue),
+        queued_mutations=admission_queue.queued_work,
+        max_queued_mutations=admission_queue.max_queued_work,
+        throughput=throughput * 60,
+        estimated_wait=admission_queue.estimate_wait(admission_queue.queued_work),
+    )
+
+
+async def _release_pipeline(pipeline_id: int) -> None:
+    """Let queued jobs take the place of a pipeline which is no longer running."""
+    if admission_queue.release(pipeline_id):
+        _admit_queued_jobs()
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, db.delete_pipeline_in_flight, pipeline_id)
+
+
+async def restore_admission_queue() -> None:
+    """Restore the jobs and pipelines in flight recorded before the service was last stopped.
+
+    Pipelines which finished in the meantime are released by `check_pipelines_in_flight_task`.
+    """
+    loop = asyncio.get_running_loop()
+    pipelines = await loop.run_in_executor(None, db.get_pipelines_in_flight)
+    for pipeline_id, (client_id, size) in pipelines.items():
+        admission_queue.add_pipelines(client_id, {pipeline_id: size}, 0)
+    queued_jobs = await loop.run_in_executor(None, db.get_queued_jobs)
+    for queued_job in queued_jobs:
+        _queued_jobs[queued_job.job_id] = queued_job
+        admission_queue.push(
+            queued_job.job_id,
+            queued_job.client_id,
+            sum(batch.count(",") + 1 for batch in queued_job.mutation_batches),
+            len(queued_job.mutation_batches),
+        )
+    if pipelines or queued_jobs:
+        logger.info(
+            "Restored %s pipelines in flight and %s queued jobs", len(pipelines), len(queued_jobs)
+        )
+    _admit_queued_jobs()
+
+
+async def check_pipelines_in_flight_task() -> None:
+    """Check pipelines which nobody is asking about, so that queued jobs can take their place."""
+    scheduler.request_priority.set(scheduler.BACKGROUND_PRIORITY)
+    while True:
+        for pipeline_id in admission_queue.get_pipeline_ids():
+            try:
+                await get_pipeline_state(pipeline_id)
+            except GitlabHttpError:
+                # Pipelines which no longer exist are not running either
+                await _release_pipeline(pipeline_id)
+        await asyncio.sleep(config.ADMISSION_CHECK_INTERVAL)
+
+
+async def get_job_record(job_id: str) -> JobRecord:
+    """Return the local record of a job.
+
+    Jobs created before job records were introduced are identified by their pipeline id.
+    """
+    loop = asyncio.get_running_loop()
+    job_record = await loop.run_in_executor(None, get_job_store().get_job, job_id)
+    if job_record is None:
+        if not job_id.isdigit():
+            raise GitlabHttpError(f"Job {job_id} not found", 404)
+        job_record = JobRecord(job_id, [int(job_id)], [[]], None, [], None)
+    return job_record
+
+
+async def get_job_state(job_id: str) -> JobState:
+    """Get the state of a job, consulting GitLab only if the cached state is missing or stale.
+
+    Jobs waiting for their turn to start are pending, with their position in the queue.
+    """
+    queued_job = _queued_jobs.get(job_id)
+    if queued_job is not None:
+        return JobState(
+            id=job_id,
+            status="pending",
+            created_at=queued_job.created_at,
+            queue_position=admission_queue.position(job_id),
+        )
+    job_state = _failed_queued_jobs.get(job_id)
+    if job_state is not None:
+        return job_state
+
+    job_record = await get_job_record(job_id)
+    if not job_record.pipeline_ids:
+        job_state = JobState(
+            id=job_id,
+            status="success",
+            created_at=job_record.created_at,
+            started_at=job_record.created_at,
+            finished_at=job_record.created_at,
+        )
+    else:
+        pipeline_states = await asyncio.gather(
+            *[get_pipeline_state(pipeline_id) for pipeline_id in job_record.pipeline_ids]
+        )
+        if len(pipeline_states) == 1:
+            job_state = pipeline_states[0].copy(update={"id": job_id})
+        else:
+            job_state = combine_pipeline_states(job_id, pipeline_states)
+
+    # Jobs created before job records were introduced have nowhere to keep their history
+    if job_record.created_at is not None and _recorded_statuses.get(job_id) != job_state.status:
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(
+            None, get_job_store().add_state_transition, job_id, job_state.status, utils.utc_now()
+        )
+        _recorded_statuses.set(job_id, job_state.status)
+    return job_state
+
+
+async def get_job_states(job_ids: List[str]) -> Dict[str, Union[JobState, Exception]]:
+    """Get the states of many jobs, checking up to `config.BULK_STATUS_CONCURRENCY` at a time.
+
+    Errors are returned in place of the states of the jobs which could not be checked,
+    so that a single missing job does not prevent others from being reported.
+    """
+    semaphore = asyncio.Semaphore(config.BULK_STATUS_CONCURRENCY)
+
+    async def get_job_state_(job_id: str) -> JobState:
+        async with semaphore:
+            return await get_job_state(job_id)
+
+    unique_job_ids = list(dict.fromkeys(job_ids))
+    job_states = await asyncio.gather(
+        *[get_job_state_(job_id) for job_id in unique_job_ids], return_exceptions=True
+    )
+    for job_state in job_states:
+        if isinstance(job_state, BaseException) and not isinstance(job_state, Exception):
+            raise job_state
+    return dict(zip(unique_job_ids, job_states))  # type: ignore
+
+
+async def get_pipeline_state(pipeline_id: int) -> JobState:
+    """Get the state of a pipeline, asking the executor backend only if no recent state is known.
+
+    States pushed by GitLab webhooks are trusted for up to `config.WEBHOOK_STATE_MAX_AGE`
+    seconds, so pipelines are only polled when webhooks are not set up or have been missed.
+    """
+    job_state = job_state_cache.get(pipeline_id)
+    if job_state is not None:
+        if job_state.status in TERMINAL_STATUSES:
+            await _release_pipeline(pipeline_id)
+        return job_state
+
+    loop = asyncio.get_running_loop()
+    stored_state = await loop.run_in_executor(None, db.get_pipeline_state, pipeline_id)
+    if stored_state is not None:
+        job_state, updated_at = stored_state
+        if job_state.status in TERMINAL_STATUSES:
+            job_state_cache.set(pipeline_id, job_state, ttl=None)
+            await _release_pipeline(pipeline_id)
+            return job_state
+        if time.time() - updated_at < config.WEBHOOK_STATE_MAX_AGE:
+            job_state_cache.set(pipeline_id, job_state)
+            return job_state
+
+    job_state = await get_backend().get_job_state(pipeline_id)
+    if job_state.status in TERMINAL_STATUSES:
+        job_state_cache.set(pipeline_id, job_state, ttl=None)
+        await _release_pipeline(pipeline_id)
+        await loop.run_in_executor(
+            None, db.set_pipeline_state, pipeline_id, job_state.status, job_state
+        )
+    else:
+        job_state_cache.set(pipeline_id, job_state)
+    return job_state
+
+
+async def set_pipeline_state(pipeline_id: int, pipeline_status: str, job_state: JobState) -> None:
+    """Record a pipeline state pushed by GitLab, making it visible to all workers.
+
+    Events may arrive out of order, so pipelines which finished are never made unfinished.
+    """
+    loop = asyncio.get_running_loop()
+    recorded = await loop.run_in_executor(
+        None,
+        functools.partial(
+            db.set_pipeline_state,
+            pipeline_id,
+            pipeline_status,
+            job_state,
+            final_statuses=TERMINAL_STATUSES,
+        ),
+    )
+    if not recorded:
+        logger.info("Ignoring %s state of finished pipeline %s", job_state.status, pipeline_id)
+        return
+    if job_state.status in TERMINAL_STATUSES:
+        job_state_cache.set(pipeline_id, job_state, ttl=None)
+        await _release_pipeline(pipeline_id)
+    else:
+        job_state_cache.set(pipeline_id, job_state)
+
+    if _job_watchers:
+        # Let clients waiting on the job know about the new state right away
+        job_records = await loop.run_in_executor(
+            None, get_job_store().get_jobs_by_pipeline, pipeline_id
+        )
+        for job_id in {str(pipeline_id), *(job_record.job_id for job_record in job_records)}:
+            _wake_up_job_watcher(job_id)
+
+
+def _wake_up_job_watcher(job_id: str) -> None:
+    job_watcher = _job_watchers.get(job_id)
+    if job_watcher is not None:
+        job_watcher.wake_up()
+
+
+class JobWatcher:
+    """Check the state of a job on behalf of all clients waiting for it to change.
+
+    The job is checked every `config.JOB_WATCH_INTERVAL` seconds for as long as someone is
+    waiting, no matter how many clients are waiting at the same time.
+    """
+
+    def __init__(self, job_id: str) -> None:
+        self.job_id = job_id
+        self.job_state: Optional[JobState] = None
+        self.error: Optional[Exception] = None
+        self.num_waiters = 0
+        self._changed = asyncio.Event()
+        self._wakeup = asyncio.Event()
+        self._task: Optional["asyncio.Task[None]"] = None
+
+    async def wait_for_change(self, job_state: Optional[JobState]) -> JobState:
+        """Wait until the state of the job differs from `job_state` or stops changing."""
+        self.num_waiters += 1
+        try:
+            if self._task is None or self._task.done():
+                self.error = None
+                self._task = asyncio.create_task(self._run())
+            while True:
+                if self.error is not None:
+                    raise self.error
+                if self.job_state is not None and (
+                    self.job_state != job_state or self._task.done()
+                ):
+                    return self.job_state
+                await self._changed.wait()
+        finally:
+            self.num_waiters -= 1
+
+    def wake_up(self) -> None:
+        """Check the state of the job without waiting for the end of the current interval."""
+        self._wakeup.set()
+
+    async def _run(self) -> None:
+        try:
+            while self.num_waiters:
+                self._wakeup.clear()
+                try:
+                    job_state = await get_job_state(self.job_id)
+                except Exception as e:
+                    self.error = e
+                    self._notify()
+                    return
+                if job_state != self.job_state:
+                    self.job_state = job_state
+                    self._notify()
+                if job_state.status in TERMINAL_STATUSES:
+                    self._notify()
+                    return
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), config.JOB_WATCH_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            if _job_watchers.get(self.job_id) is self:
+                del _job_watchers[self.job_id]
+
+    def _notify(self) -> None:
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+
+async def wait_for_job_state(
+    job_id: str, job_state: Optional[JobState], timeout: float
+) -> JobState:
+    """Wait up to `timeout` seconds for the state of a job to differ from `job_state`.
+
+    Returns the latest state of the job, which is the same as `job_state` on timeout.
+    """
+    job_watcher = _job_watchers.get(job_id)
+    if job_watcher is None:
+        job_watcher = _job_watchers[job_id] = JobWatcher(job_id)
+    try:
+        return await asyncio.wait_for(job_watcher.wait_for_change(job_state), timeout)
+    except asyncio.TimeoutError:
+        return job_watcher.job_state or job_state or await get_job_state(job_id)
+
+
+def combine_pipeline_states(job_id: str, pipeline_states: List[JobState]) -> JobState:
+    """Combine states of all pipelines of a job into the state of the job itself.
+
+    The job succeeds once all pipelines succeed, fails as soon as any of them fails or is
+    skipped (since some mutations are then never evaluated), and is running while some
+    pipelines are running or finished and others are not. Jobs whose pipelines have not
+    started yet are pending, or have the status of their pipelines if they all agree.
+    """
+    statuses = [s.status for s in pipeline_states]
+    if all(status == statuses[0] for status in statuses):
+        status = statuses[0]
+    elif "failed" in statuses or "skipped" in statuses:
+        status = "failed"
+    elif "canceled" in statuses:
+        status = "canceled"
+    elif "running" in statuses or "success" in statuses:
+        status = "running"
+    else:
+        status = "pending"
+
+    started_ats = [s.started_at for s in pipeline_states if s.started_at]
+    finished_ats = [s.finished_at for s in pipeline_states if s.finished_at]
+    return JobState(
+        id=job_id,
+        status=status,
+        created_at=min((s.created_at for s in pipeline_states if s.created_at), default=None),
+        started_at=min(started_ats, default=None),
+        finished_at=(max(finished_ats) if status in TERMINAL_STATUSES and finished_ats else None),
+    )
+
+
+async def get_pipeline_results_data(pipeline_id: int) -> bytes:
+    """Get the contents of the `results.jsonl` file produced by a pipeline.
+
+    Results of successful pipelines are served from the local results store, and are added to it
+    (and to the per-mutation cache) the first time they are downloaded from GitLab.
+    """
+    loop = asyncio.get_running_loop()
+    data = await loop.run_in_executor(None, results_store.get, pipeline_id)
+    if data is None:
+        job_state, data = await get_backend().get_job_data(pipeline_id, True)
+        assert data is not None
+        if job_state.status == "success":
+            job_state_cache.set(pipeline_id, job_state, ttl=None)
+            await loop.run_in_executor(None, results_store.put, pipeline_id, data)
+            await loop.run_in_executor(None, _cache_mutation_results, pipeline_id)
+    return data
+
+
+async def iter_pipeline_results_data(pipeline_id: int) -> AsyncIterator[bytes]:
+    """Stream the contents of the `results.jsonl` file produced by a pipeline.
+
+    Like `get_pipeline_results_data`, but results are never held in memory in their entirety.
+    """
+    loop = asyncio.get_running_loop()
+    fin = await loop.run_in_executor(None, results_store.open_results, pipeline_id)
+    if fin is not None:
+        try:
+            while True:
+                chunk = await loop.run_in_executor(None, fin.read, RESULTS_CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            fin.close()
+        return
+
+    if not isinstance(get_backend(), GitLabBackend):
+        # Other backends keep results in local files, which are read in one go
+        yield await get_pipeline_results_data(pipeline_id)
+        return
+
+    # Finding the GitLab job holding the results takes two requests, so it is done only once
+    job_state = job_state_cache.get(pipeline_id)
+    pipeline_job_id: Optional[int] = None
+    if job_state is not None and job_state.status == "success":
+        pipeline_job_id = await loop.run_in_executor(
+            None, get_job_store().get_result_location, pipeline_id
+        )
+    succeeded = pipeline_job_id is not None
+    if pipeline_job_id is None:
+        pipeline = await gitlab_async.get_pipeline(pipeline_id)
+        pipeline_job = await gitlab_async.get_pipeline_job(pipeline)
+        pipeline_job_id = pipeline_job["id"]
+        succeeded = pipeline["status"] == "success"
+        if succeeded:
+            await loop.run_in_executor(
+                None, get_job_store().set_result_location, pipeline_id, pipeline_job_id
+            )
+
+    writer: Optional[results_store.ResultsWriter] = None
+    if succeeded:
+        writer = await loop.run_in_executor(None, results_store.ResultsWriter, pipeline_id)
+    try:
+        async with gitlab_async.open_job_artifact(
+            pipeline_job_id, "results/results.jsonl"
+        ) as content:
+            async for chunk in content.iter_chunked(RESULTS_CHUNK_SIZE):
+                if writer is not None:
+                    await loop.run_in_executor(None, writer.write, chunk)
+                yield chunk
+    except BaseException as e:
+        if writer is not None:
+            await loop.run_in_executor(None, writer.abort)
+        if isinstance(e, GitlabGetError):
+            raise GitlabHttpError
+        raise
+
+    if writer is not None:
+        await loop.run_in_executor(None, writer.commit)
+        await loop.run_in_executor(None, _cache_mutation_results, pipeline_id)
+
+
+def _cache_mutation_results(pipeline_id: int) -> None:
+    """Add results of a pipeline, which must be in the results store, to the per-mutation cache."""
+    context_hashes = {
+        job_record.context_hash
+        for job_record in get_job_store().get_jobs_by_pipeline(pipeline_id)
+        if job_record.context_hash is not None
+    }
+    for context_hash in context_hashes:
+        fin = results_store.open_results(pipeline_id)
+        if fin is None:
+            return
+        with fin:
+            db.add_mutation_results(
+                context_hash, (orjson.loads(line) for line in fin if line.strip())
+            )
+
+
+async def get_job_results(job_id: str) -> List[Dict[str, Any]]:
+    """Get results of a job, combining cached mutation scores with those computed by GitLab.
+
+    Results are returned in the order in which mutations were submitted, regardless of
+    how mutations were split between pipelines.
+    """
+    job_record = await get_job_record(job_id)
+
+    results_data = await asyncio.gather(
+        *[get_pipeline_results_data(pipeline_id) for pipeline_id in job_record.pipeline_ids]
+    )
+    results = [result for data in results_data for result in parse_results(data)]
+    if job_record.context_hash is None:
+        return results
+
+    results_by_mutation = {result.get("mutation"): result for result in results}
+    missing_mutations = [m for m in job_record.mutations if m not in results_by_mutation]
+    if missing_mutations:
+        loop = asyncio.get_running_loop()
+        results_by_mutation.update(
+            await loop.run_in_executor(
+                None, db.get_mutation_results, job_record.context_hash, missing_mutations
+            )
+        )
+    return [results_by_mutation[m] for m in job_record.mutations if m in results_by_mutation]
+
+
+def _uses_cached_results(job_record: JobRecord) -> bool:
+    """Return `True` if some results of the job come from the per-mutation cache."""
+    if job_record.context_hash is None:
+        return False
+    num_pipeline_mutations = sum(len(mutations) for mutations in job_record.pipeline_mutations)
+    return num_pipeline_mutations < len(job_record.mutations)
+
+
+async def get_job_results_json(job_id: str) -> bytes:
+    """Get results of a job encoded as a JSON array.
+
+    Results computed by GitLab come from our own pipelines, so they are copied into the array
+    as-is, without being parsed, validated and encoded again.
+    """
+    job_record = await get_job_record(job_id)
+    if _uses_cached_results(job_record):
+        return orjson.dumps(await get_job_results(job_id))
+
+    results_data = await asyncio.gather(
+        *[get_pipeline_results_data(pipeline_id) for pipeline_id in job_record.pipeline_ids]
+    )
+    return utils.jsonl_to_json_array(results_data)
+
+
+async def iter_job_results(job_id: str) -> AsyncIterator[bytes]:
+    """Stream results of a job as newline-delimited JSON.
+
+    Results computed by GitLab are passed through chunk by chunk. Only jobs which reuse
+    cached mutation scores have to be assembled in memory, in order to preserve mutation order.
+    """
+    job_record = await get_job_record(job_id)
+    if _uses_cached_results(job_record):
+        for result in await get_job_results(job_id):
+            yield orjson.dumps(result) + b"\n"
+        return
+
+    for pipeline_id in job_record.pipeline_ids:
+        chunk = b"\n"
+        async for chunk in iter_pipeline_results_data(pipeline_id):
+            yield chunk
+        # Make sure that results of consecutive pipelines are not glued together
+        if not chunk.endswith(b"\n"):
+            yield b"\n"
+
+
+async def query_job_results(
+    job_id: str,
+    mutations: Optional[List[str]] = None,
+    positions: Optional[List[int]] = None,
+    sort_by: Optional[str] = None,
+    descending: bool = True,
+    offset: int = 0,
+    limit: Optional[int] = None,
+) -> List[bytes]:
+    """Return a page of JSON-encoded results of a job, filtered and sorted as requested.
+
+    Results of a finished job are indexed the first time they are queried, so that subsequent
+    queries only read the requested page. See `db.query_job_results` for the parameters.
+    """
+    loop = asyncio.get_running_loop()
+    if not await loop.run_in_executor(None, db.has_job_results, job_id):
+        task = _pending_indexes.get(job_id)
+        if task is None:
+            task = asyncio.create_task(_index_job_results(job_id))
+            _pending_indexes[job_id] = task
+            task.add_done_callback(lambda _: _pending_indexes.pop(job_id, None))
+        await asyncio.shield(task)
+
+    rows = await loop.run_in_executor(
+        None,
+        functools.partial(
+            db.query_job_results,
+            job_id,
+            mutations=mutations,
+            positions=positions,
+            sort_by=sort_by,
+            descending=descending,
+            offset=offset,
+            limit=limit,
+        ),
+    )
+    return [row.encode() for row in rows]
+
+
+async def _index_job_results(job_id: str) -> None:
+    job_state = await get_job_state(job_id)
+    if job_state.status != "success":
+        # Results of unfinished jobs may still change, so they cannot be indexed
+        raise GitlabHttpError(f"Job {job_id} has not finished successfully", 404)
+    results = await get_job_results(job_id)
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, db.add_job_results, job_id, results)
+
+
+async def prefetch_job_results(pipeline_id: int) -> bool:
+    """Add results of a pipeline to the results store, unless they are already there.
+
+    Returns `True` if results had to be downloaded.
+    """
+    loop = asyncio.get_running_loop()
+    if await loop.run_in_executor(None, results_store.contains, pipeline_id):
+        return False
+    await get_pipeline_results_data(pipeline_id)
+    return True
+
+
+async def delete_job(job_id: str) -> None:
+    if admission_queue.remove(job_id):
+        _queued_jobs.pop(job_id, None)
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, db.delete_queued_job, job_id)
+        return
+    starting_job = _starting_jobs.get(job_id)
+    if starting_job is not None:
+        # Wait until the job is recorded, so that its pipelines are deleted along with it
+        await asyncio.shield(starting_job)
+    if _failed_queued_jobs.pop(job_id) is not None:
+        return
+
+    job_record = await get_job_record(job_id)
+    loop = asyncio.get_running_loop()
+    await asyncio.gather(
+        *[get_backend().delete_job(pipeline_id) for pipeline_id in job_record.pipeline_ids]
+    )
+    for pipeline_id in job_record.pipeline_ids:
+        job_state_cache.pop(pipeline_id)
+        await _release_pipeline(pipeline_id)
+        await loop.run_in_executor(None, results_store.delete, pipeline_id)
+    # Otherwise, pipelines which failed prematurely would keep being retried
+    await loop.run_in_executor(None, db.delete_pipeline_states, job_record.pipeline_ids)
+    await loop.run_in_executor(None, get_job_store().delete_job, job_id)
+    await loop.run_in_executor(None, db.delete_job_results, job_id)
+    _recorded_statuses.pop(job_id)
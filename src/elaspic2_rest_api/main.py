@@ -3,21 +3,46 @@
 The architecture of the REST API was heavily inspired by:
 <http://restalk-patterns.org/long-running-operation-polling.html>.
 """
+
 import asyncio
-from typing import Any, Dict, List
+import logging
+from typing import Any, AsyncIterator, Dict, List, Optional
 
 import sentry_sdk
-from fastapi import FastAPI, HTTPException
+from fastapi import BackgroundTasks, FastAPI, HTTPException, Query
 from fastapi.middleware.cors import CORSMiddleware
 from sentry_sdk.integrations.asgi import SentryAsgiMiddleware
 from starlette import status
 from starlette.requests import Request
-from starlette.responses import RedirectResponse, Response
+from starlette.responses import RedirectResponse, Response, StreamingResponse
 
 import elaspic2_rest_api
-from elaspic2_rest_api import config, gitlab, utils
+from elaspic2_rest_api import (
+    config,
+    db,
+    gitlab,
+    gitlab_async,
+    jobs,
+    structure_store,
+    utils,
+    webhooks,
+)
+from elaspic2_rest_api.admission import AdmissionRejected
+from elaspic2_rest_api.executors import get_backend
+from elaspic2_rest_api.middleware import CompressionMiddleware, GzipRequestMiddleware
 from elaspic2_rest_api.tasks import start_and_monitor_tasks
-from elaspic2_rest_api.types import JobRequest, JobResponse, JobState, MutationResult
+from elaspic2_rest_api.types import (
+    JobBatchError,
+    JobBatchResponse,
+    JobError,
+    JobRequest,
+    JobResponse,
+    JobState,
+    JobStates,
+    LoadState,
+    MutationResult,
+    TemplateResponse,
+)
 
 description = """\
 This page lists `ELASPIC2` REST API endpoints that are available for evaluating the effect
@@ -36,8 +61,22 @@ app = FastAPI(
 
 app_data: Dict[str, Any] = {}
 
+logger = logging.getLogger(__name__)
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+EVENT_STREAM_MEDIA_TYPE = "text/event-stream"
+
+#: Number of seconds between keep-alive comments sent to clients streaming job states
+SSE_KEEPALIVE_INTERVAL = 15
+
+#: Maximum number of mutations or positions by which results can be filtered in one request
+MAX_RESULTS_FILTER_SIZE = 500
+
 
 app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"])
+app.add_middleware(GzipRequestMiddleware, max_size=config.MAX_DECOMPRESSED_BODY_SIZE)
+app.add_middleware(CompressionMiddleware, minimum_size=config.COMPRESSION_MINIMUM_SIZE)
 
 
 @app.post("/jobs/", response_model=JobResponse, status_code=status.HTTP_202_ACCEPTED, tags=["jobs"])
@@ -53,54 +92,201 @@ async def submit_job(*, input: JobRequest, request: Request, response: Response)
         Multiple mutations should be separated with a comma.
     - **ligand_sequence**: Amino acid sequence of the interacting protein.
     - **structural_template**: Structural template to be used for modelling the structure
-        of the protein or the interaction between the protein and the ligand. The template should
-        be provided as a gzip-compressed, and base64-encoded, PDB or mmCIF file.
+        of the protein or the interaction between the protein and the ligand. The template
+        should first be uploaded to the "Upload Template" endpoint, and is given by the id
+        which that endpoint returns.
+
+    Large requests may be sent gzip-compressed, with the `Content-Encoding: gzip` header.
+
+    Runners are shared fairly between clients, which are told apart by their IP address, or by
+    the `X-Client-Id` header set by a trusted proxy in front of the service. Jobs which
+    cannot start right away wait in a queue, where small jobs and jobs of clients with
+    little work in progress go first. When the queue is full, jobs are rejected with
+    `429 Too Many Requests`, and the `Retry-After` header says when to submit them again.
     """
-    if not utils.check_aa_sequence(input.protein_sequence):
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Protein sequence is malformed",
-        )
-    if input.ligand_sequence is not None and not utils.check_aa_sequence(input.ligand_sequence):
+    error = utils.check_job_request(input) or await _check_structural_template(input)
+    if error is not None:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=error)
+
+    try:
+        job_id = await jobs.submit_job(input, _get_client_id(request))
+    except AdmissionRejected as e:
         raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Ligand sequence is malformed",
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail=str(e),
+            headers={"Retry-After": str(e.retry_after)},
         )
-    if not utils.check_mutations(input.mutations):
+
+    web_url = f"{request.url}{job_id}/"
+    response.headers["LOCATION"] = web_url
+    return {"id": job_id, "web_url": web_url}
+
+
+async def _check_structural_template(input: JobRequest) -> Optional[str]:
+    """Return the reason why the structural template of `input` cannot be used, if any."""
+    if input.structural_template is None:
+        return None
+    loop = asyncio.get_running_loop()
+    # Keep the template from being evicted before pipelines download it
+    object_path = await loop.run_in_executor(
+        None, structure_store.get_object_path, input.structural_template, True
+    )
+    if object_path is None:
+        return "Structural template not found"
+    return None
+
+
+def _get_client_id(request: Request) -> str:
+    if request.client is None:
+        return jobs.DEFAULT_CLIENT_ID
+    # Clients could otherwise get around their caps by sending a different id each time
+    client_id = request.headers.get(config.CLIENT_ID_HEADER)
+    if client_id and utils.is_trusted_proxy(request.client.host):
+        return client_id
+    return request.client.host
+
+
+@app.post(
+    "/jobs/batch",
+    response_model=JobBatchResponse,
+    status_code=status.HTTP_202_ACCEPTED,
+    tags=["jobs"],
+)
+async def submit_jobs(*, inputs: List[JobRequest], request: Request, response: Response):
+    """Create many jobs at once.
+
+    Each job is specified in the same way as for the "Submit Job" endpoint. Jobs are returned
+    in the order in which they were submitted, with `null` in place of jobs which could not
+    be created, and the reason why they could not be created is listed under `errors`.
+    Identical jobs in a batch are created only once. If some jobs were rejected because the
+    queue is full, the `Retry-After` header says when to submit them again.
+    """
+    if len(inputs) > config.MAX_BATCH_JOBS:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Mutations are in an unexpected format",
+            detail=f"At most {config.MAX_BATCH_JOBS} jobs can be submitted at once.",
         )
-    if not utils.check_mutations_match_sequence(input.protein_sequence, input.mutations):
+
+    errors: List[JobBatchError] = []
+    valid_inputs: Dict[int, JobRequest] = {}
+    for index, input in enumerate(inputs):
+        error = utils.check_job_request(input) or await _check_structural_template(input)
+        if error is None:
+            valid_inputs[index] = input
+        else:
+            errors.append(
+                JobBatchError(index=index, status_code=status.HTTP_400_BAD_REQUEST, detail=error)
+            )
+
+    job_ids = await jobs.submit_jobs(list(valid_inputs.values()), _get_client_id(request))
+    job_responses: List[Optional[JobResponse]] = [None] * len(inputs)
+    retry_after = 0
+    for index, job_id in zip(valid_inputs, job_ids):
+        if isinstance(job_id, AdmissionRejected):
+            errors.append(
+                JobBatchError(
+                    index=index,
+                    status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                    detail=str(job_id),
+                )
+            )
+            retry_after = max(retry_after, job_id.retry_after)
+        elif isinstance(job_id, Exception):
+            logger.warning("Could not create job %s of batch: %r", index, job_id)
+            errors.append(
+                JobBatchError(
+                    index=index, status_code=status.HTTP_502_BAD_GATEWAY, detail="Bad Gateway"
+                )
+            )
+        else:
+            web_url = f"{request.url_for('get_job_status', job_id=job_id)}/"
+            job_responses[index] = JobResponse(id=job_id, web_url=web_url)
+    if retry_after:
+        response.headers["Retry-After"] = str(retry_after)
+    return JobBatchResponse(jobs=job_responses, errors=sorted(errors, key=lambda e: e.index))
+
+
+@app.get("/jobs/", response_model=JobStates, tags=["jobs"])
+async def get_job_statuses(ids: str):
+    """Get the status of many previously-submitted jobs at once.
+
+    Jobs which could not be found, or whose status could not be determined, are listed
+    under `errors`, while the status of all other jobs is returned under `jobs`.
+
+    **Arguments:**
+
+    - **ids**: Comma-separated identifiers of submitted jobs (up to 500 by default).
+    """
+    job_ids = [job_id.strip() for job_id in ids.split(",") if job_id.strip()]
+    if len(job_ids) > config.MAX_BULK_JOB_IDS:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Mutation(s) do not match the protein sequence",
+            detail=f"At most {config.MAX_BULK_JOB_IDS} jobs can be requested at once.",
         )
 
-    loop = asyncio.get_running_loop()
-    job_id = await loop.run_in_executor(None, gitlab.create_job, input)
-
-    web_url = f"{request.url}{job_id}/"
-    response.headers["LOCATION"] = web_url
-    return {"id": job_id, "web_url": web_url}
+    job_states = await jobs.get_job_states(job_ids)
+    job_states_list: List[JobState] = []
+    errors: List[JobError] = []
+    for job_id, job_state in job_states.items():
+        if isinstance(job_state, gitlab.GitlabHttpError):
+            errors.append(
+                JobError(id=job_id, status_code=status.HTTP_404_NOT_FOUND, detail="Not Found")
+            )
+        elif isinstance(job_state, Exception):
+            logger.warning("Could not get the state of job %s: %r", job_id, job_state)
+            errors.append(
+                JobError(id=job_id, status_code=status.HTTP_502_BAD_GATEWAY, detail="Bad Gateway")
+            )
+        else:
+            job_states_list.append(job_state)
+    return JobStates(jobs=job_states_list, errors=errors)
 
 
 @app.get("/jobs/{job_id}", response_model=JobState, tags=["jobs"])
-async def get_job_status(job_id: int, request: Request, response: Response):
+async def get_job_status(
+    job_id: str,
+    request: Request,
+    response: Response,
+    wait: Optional[float] = Query(None, ge=0),
+):
     """Get the status of a previously-submitted job.
 
+    Instead of polling, clients can wait for the status of the job to change, either by
+    long-polling with the `wait` parameter or by requesting a stream of server-sent events
+    with `Accept: text/event-stream`. The stream ends once the job finishes.
+
+    Jobs waiting in the queue for their turn to start are `pending`, and their `queue_position`
+    is the number of jobs which will start before them.
+
     **Arguments:**
 
     - **job_id**: Identifier of the submitted job, as returned by the "Submit Job" endpoint.
+    - **wait**: Number of seconds to wait for the status of an unfinished job to change
+        before responding (at most 60 by default).
     """
-    loop = asyncio.get_running_loop()
     try:
-        job_state, _ = await loop.run_in_executor(None, gitlab.get_job_state, job_id, False)
+        job_state = await jobs.get_job_state(job_id)
     except gitlab.GitlabHttpError:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
 
+    results_url = f"{request.url.replace(query='')}/results"
+    if EVENT_STREAM_MEDIA_TYPE in request.headers.get("accept", ""):
+        return StreamingResponse(
+            _iter_job_state_events(job_id, job_state, results_url),
+            media_type=EVENT_STREAM_MEDIA_TYPE,
+            headers={"Cache-Control": "no-cache"},
+        )
+
+    if wait and job_state.status not in jobs.TERMINAL_STATUSES:
+        try:
+            job_state = await jobs.wait_for_job_state(
+                job_id, job_state, min(wait, config.MAX_LONG_POLL_WAIT)
+            )
+        except gitlab.GitlabHttpError:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
+
     if job_state.status == "success":
-        job_state.web_url = f"{request.url}/results"
+        job_state.web_url = results_url
         response.headers["LOCATION"] = job_state.web_url
 
     return job_state
@@ -112,35 +298,248 @@ async def get_job_status(job_id: int, request: Request, response: Response):
         return RedirectResponse(url=job_state.web_url, status_code=status.HTTP_303_SEE_OTHER)
 
 
+async def _iter_job_state_events(
+    job_id: str, job_state: JobState, results_url: str
+) -> AsyncIterator[bytes]:
+    while True:
+        if job_state.status == "success":
+            job_state.web_url = results_url
+        yield f"event: state\ndata: {job_state.json()}\n\n".encode()
+        if job_state.status in jobs.TERMINAL_STATUSES:
+            return
+
+        previous_job_state = job_state
+        while job_state == previous_job_state:
+            try:
+                job_state = await jobs.wait_for_job_state(
+                    job_id, previous_job_state, SSE_KEEPALIVE_INTERVAL
+                )
+            except gitlab.GitlabHttpError:
+                yield b"event: error\ndata: Job not found\n\n"
+                return
+            if job_state == previous_job_state:
+                # Keep proxies from closing the connection while the job is running
+                yield b": keepalive\n\n"
+
+
 @app.delete("/jobs/{job_id}", tags=["jobs"])
-async def delete_job(job_id: int):
+async def delete_job(job_id: str):
     """Delete a previously-submitted job, including associated data.
 
     **Arguments:**
 
     - **job_id**: Identifier of the submitted job, as returned by the "Submit Job" endpoint.
     """
-    loop = asyncio.get_running_loop()
     try:
-        await loop.run_in_executor(None, gitlab.delete_job, job_id)
+        await jobs.delete_job(job_id)
     except (gitlab.GitlabHttpError, gitlab.GitlabDeleteError):
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
 
 
 @app.get("/jobs/{job_id}/results", response_model=List[MutationResult], tags=["jobs"])
-async def get_job_result(job_id: int):
+async def get_job_result(
+    job_id: str,
+    request: Request,
+    offset: int = Query(0, ge=0),
+    limit: Optional[int] = Query(None, ge=1),
+    mutations: Optional[str] = None,
+    positions: Optional[str] = None,
+    sort_by: Optional[str] = None,
+    order: str = Query("desc", regex="^(asc|desc)$"),
+):
     """Get the result of a previously-submitted job.
 
+    Results are streamed as newline-delimited JSON, one mutation per line, if the request
+    specifies `Accept: application/x-ndjson`.
+
     **Arguments:**
 
     - **job_id**: Identifier of the submitted job, as returned by the "Submit Job" endpoint.
+    - **offset**: Number of results to skip.
+    - **limit**: Maximum number of results to return.
+    - **mutations**: Comma-separated list of mutations for which to return results.
+    - **positions**: Comma-separated list of positions for which to return results.
+    - **sort_by**: Score by which to sort results (e.g. `el2core` or `el2interface`).
+      Results without this score are omitted.
+    - **order**: Sort order, either `desc` (default) or `asc`.
     """
-    loop = asyncio.get_running_loop()
+    if (
+        offset
+        or limit is not None
+        or mutations is not None
+        or positions is not None
+        or sort_by is not None
+    ):
+        return await _query_job_result(
+            job_id, request, offset, limit, mutations, positions, sort_by, order
+        )
+
+    if NDJSON_MEDIA_TYPE in request.headers.get("accept", ""):
+        chunks = jobs.iter_job_results(job_id)
+        try:
+            # Make sure that the job exists before we commit to a successful response
+            first_chunk = await chunks.__anext__()
+        except StopAsyncIteration:
+            first_chunk = b""
+        except gitlab.GitlabHttpError:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
+        return StreamingResponse(_prepend_chunk(first_chunk, chunks), media_type=NDJSON_MEDIA_TYPE)
+
+    try:
+        job_result = await jobs.get_job_results_json(job_id)
+    except gitlab.GitlabHttpError:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
+    # Results are already encoded, so they bypass validation against the response model
+    return Response(content=job_result, media_type="application/json")
+
+
+async def _query_job_result(
+    job_id: str,
+    request: Request,
+    offset: int,
+    limit: Optional[int],
+    mutations: Optional[str],
+    positions: Optional[str],
+    sort_by: Optional[str],
+    order: str,
+) -> Response:
+    mutation_list = _split_query_list(mutations)
+    try:
+        position_list = (
+            [int(p) for p in _split_query_list(positions)]  # type: ignore
+            if positions is not None
+            else None
+        )
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail="Positions must be integers."
+        )
+    if sort_by is not None and sort_by not in db.SCORE_COLUMNS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Results can only be sorted by one of: {', '.join(db.SCORE_COLUMNS)}.",
+        )
+
     try:
-        job_state, job_result = await loop.run_in_executor(None, gitlab.get_job_state, job_id, True)
+        rows = await jobs.query_job_results(
+            job_id,
+            mutations=mutation_list,
+            positions=position_list,
+            sort_by=sort_by,
+            descending=order == "desc",
+            offset=offset,
+            limit=limit,
+        )
     except gitlab.GitlabHttpError:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
-    return job_result
+
+    if NDJSON_MEDIA_TYPE in request.headers.get("accept", ""):
+        return Response(content=b"".join(row + b"\n" for row in rows), media_type=NDJSON_MEDIA_TYPE)
+    return Response(content=b"[" + b",".join(rows) + b"]", media_type="application/json")
+
+
+def _split_query_list(value: Optional[str]) -> Optional[List[str]]:
+    if value is None:
+        return None
+    items = [item.strip() for item in value.split(",") if item.strip()]
+    if len(items) > MAX_RESULTS_FILTER_SIZE:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"At most {MAX_RESULTS_FILTER_SIZE} values can be given per filter.",
+        )
+    return items
+
+
+async def _prepend_chunk(chunk: bytes, chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    yield chunk
+    async for chunk in chunks:
+        yield chunk
+
+
+@app.get("/load", response_model=LoadState, tags=["status"])
+async def get_load():
+    """Get the current load on the service.
+
+    - **pipelines_in_flight**: Number of pipelines running or waiting for a runner.
+    - **queued_jobs**, **queued_mutations**: Jobs waiting for their turn to start, and the
+        number of mutations which they evaluate.
+    - **throughput**: Number of mutations evaluated per minute, recently.
+    - **estimated_wait**: Number of seconds before queued jobs are expected to start,
+        if throughput is known.
+    """
+    return jobs.get_load()
+
+
+@app.post(
+    "/templates/",
+    response_model=TemplateResponse,
+    status_code=status.HTTP_201_CREATED,
+    tags=["templates"],
+)
+async def upload_template(request: Request):
+    """Upload a structural template, to be referenced by the id returned, when submitting jobs.
+
+    The template should be a PDB or mmCIF file, sent as the request body gzip-compressed
+    (rather than with `Content-Encoding: gzip`) and optionally base64-encoded. It is processed
+    as it is received, so large templates need not be held in memory at once. Uploading the
+    same template again returns the same id.
+    """
+    if not structure_store.is_enabled():
+        raise HTTPException(
+            status_code=status.HTTP_501_NOT_IMPLEMENTED,
+            detail="Structural templates are not supported by this server.",
+        )
+
+    loop = asyncio.get_running_loop()
+    writer = await loop.run_in_executor(None, structure_store.TemplateWriter)
+    try:
+        async for chunk in request.stream():
+            if chunk:
+                await loop.run_in_executor(None, writer.write, chunk)
+        template_id = await loop.run_in_executor(None, writer.commit)
+    except ValueError as e:
+        await loop.run_in_executor(None, writer.abort)
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    except structure_store.StructureTooLargeError as e:
+        await loop.run_in_executor(None, writer.abort)
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail=str(e))
+    except BaseException:
+        await loop.run_in_executor(None, writer.abort)
+        raise
+    return {"id": template_id}
+
+
+@app.get("/structures/{name}", include_in_schema=False)
+async def get_structure(name: str):
+    """Serve a structure from the structure store to the pipelines of jobs using it."""
+    loop = asyncio.get_running_loop()
+    # Pipelines which are retried download structures again, so they are kept a while longer
+    object_path = await loop.run_in_executor(None, structure_store.get_object_path, name, True)
+    if object_path is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
+    data = await loop.run_in_executor(None, object_path.read_bytes)
+    return Response(
+        content=data,
+        media_type="application/gzip" if name.endswith(".gz") else "application/octet-stream",
+        # Structures are identified by their contents, so they never change
+        headers={"Cache-Control": "public, max-age=31536000, immutable"},
+    )
+
+
+@app.post("/webhooks/gitlab", include_in_schema=False)
+async def receive_gitlab_event(request: Request, background_tasks: BackgroundTasks):
+    """Update job states using pipeline events sent by GitLab."""
+    if not webhooks.verify_token(request.headers.get("X-Gitlab-Token")):
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED)
+    try:
+        payload = await request.json()
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST)
+    # GitLab expects a quick response, so events are processed after responding
+    background_tasks.add_task(
+        webhooks.handle_event, request.headers.get("X-Gitlab-Event", ""), payload
+    )
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
 
 
 @app.get("/_ah/warmup", include_in_schema=False)
@@ -150,12 +549,21 @@ def warmup():
 
 @app.on_event("startup")
 async def on_startup() -> None:
+    db.acquire_lock()
+    gitlab.open_client()
+    await get_backend().recover()
+    await jobs.restore_admission_queue()
     app_data["task_monitor"] = asyncio.create_task(start_and_monitor_tasks(), name="task_monitor")
 
 
 @app.on_event("shutdown")
 async def on_shutdown() -> None:
     app_data["task_monitor"].cancel()
+    gitlab.close_client()
+    await gitlab_async.close_session()
+    await structure_store.close_session()
+    db.release_lock()
+    db.close_connection()
 
 
 if config.SENTRY_DSN:
@@ -0,0 +1,281 @@
+"""ASGI middleware compressing responses and decompressing gzip-encoded request bodies."""
+
+import zlib
+from typing import Any, List, Optional, Tuple
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.responses import PlainTextResponse
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from elaspic2_rest_api.bin_utils import is_gz_data
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+#: Content types which must reach the client as soon as they are sent
+UNBUFFERED_CONTENT_TYPES = ("text/event-stream",)
+
+
+class CompressionMiddleware:
+    """Compress responses using the best encoding accepted by the client.
+
+    Brotli is used if the `brotli` package is installed, and gzip otherwise. Responses smaller
+    than `minimum_size` bytes are sent as-is. Each chunk of a streaming response is flushed,
+    so that compression does not delay streamed results.
+    """
+
+    def __init__(self, app: ASGIApp, minimum_size: int = 1024) -> None:
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] == "http":
+            encoding = select_encoding(Headers(scope=scope).get("Accept-Encoding", ""))
+            if encoding is not None:
+                responder = CompressionResponder(self.app, encoding, self.minimum_size)
+                await responder(scope, receive, send)
+                return
+        await self.app(scope, receive, send)
+
+
+class CompressionResponder:
+    def __init__(self, app: ASGIApp, encoding: str, minimum_size: int) -> None:
+        self.app = app
+        self.encoding = encoding
+        self.minimum_size = minimum_size
+        self.send: Send
+        self.initial_message: Message = {}
+        self.started = False
+        self.compressor: Optional[Any] = None
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        self.send = send
+        await self.app(scope, receive, self.send_compressed)
+
+    async def send_compressed(self, message: Message) -> None:
+        message_type = message["type"]
+        if message_type == "http.response.start":
+            # Headers can only be modified once we know whether the response will be compressed
+            self.initial_message = message
+            return
+        if message_type != "http.response.body":
+            await self.send(message)
+            return
+
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+        if not self.started:
+            self.started = True
+            headers = MutableHeaders(raw=self.initial_message["headers"])
+            if (
+                "Content-Encoding" in headers
+                or headers.get("Content-Type", "").startswith(UNBUFFERED_CONTENT_TYPES)
+                or (len(body) < self.minimum_size and not more_body)
+            ):
+                await self.send(self.initial_message)
+                await self.send(message)
+                return
+
+            self.compressor = _make_compressor(self.encoding)
+            headers["Content-Encoding"] = self.encoding
+            headers.add_vary_header("Accept-Encoding")
+            del headers["Content-Length"]
+            if not more_body:
+                message["body"] = self.compressor.compress(body) + self.compressor.finish()
+                headers["Content-Length"] = str(len(message["body"]))
+            else:
+                message["body"] = self.compressor.compress(body) + self.compressor.flush()
+            await self.send(self.initial_message)
+            await self.send(message)
+        elif self.compressor is None:
+            await self.send(message)
+        else:
+            if more_body:
+                message["body"] = self.compressor.compress(body) + self.compressor.flush()
+            else:
+                message["body"] = self.compressor.compress(body) + self.compressor.finish()
+            await self.send(message)
+
+
+class GzipRequestMiddleware:
+    """Transparently decompress request bodies sent with `Content-Encoding: gzip`.
+
+    Bodies are decompressed chunk by chunk, as they are read by the application. Bodies which
+    are not gzip-compressed or which decompress to more than `max_size` bytes are rejected.
+    """
+
+    def __init__(self, app: ASGIApp, max_size: int) -> None:
+        self.app = app
+        self.max_size = max_size
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or Headers(scope=scope).get(
+            "Content-Encoding", ""
+        ).lower() not in ("gzip", "x-gzip"):
+            await self.app(scope, receive, send)
+            return
+
+        # The application only ever sees the decompressed body
+        scope = dict(scope)
+        scope["headers"] = [
+            (key, value)
+            for key, value in scope["headers"]
+            if key not in (b"content-encoding", b"content-length")
+        ]
+        decompressor = GzipRequestDecompressor(receive, self.max_size)
+
+        response_started = False
+        error_sent = False
+
+        async def send_error(error: MalformedBodyError) -> None:
+            nonlocal error_sent
+            if not error_sent:
+                error_sent = True
+                response = PlainTextResponse(str(error), status_code=error.status_code)
+                await response(scope, receive, send)
+
+        async def send_(message: Message) -> None:
+            nonlocal response_started
+            # Applications which catch errors raised while reading the body (such as FastAPI)
+            # respond with a generic error, which is replaced with the actual one
+            if decompressor.error is not None and not response_started:
+                await send_error(decompressor.error)
+                return
+            response_started = True
+            await send(message)
+
+        try:
+            await self.app(scope, decompressor.receive, send_)
+        except MalformedBodyError as e:
+            if response_started:
+                raise
+            await send_error(e)
+
+
+class MalformedBodyError(Exception):
+    def __init__(self, message: str, status_code: int = 400) -> None:
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class GzipRequestDecompressor:
+    def __init__(self, receive: Receive, max_size: int) -> None:
+        self._receive = receive
+        self.max_size = max_size
+        self.size = 0
+        self._decompressor = zlib.decompressobj(wbits=16 + zlib.MAX_WBITS)
+        self._header = b""
+        self._header_checked = False
+        #: Error raised when the body was found to be malformed, if any
+        self.error: Optional[MalformedBodyError] = None
+
+    async def receive(self) -> Message:
+        try:
+            return await self._receive_decompressed()
+        except MalformedBodyError as e:
+            self.error = e
+            raise
+
+    async def _receive_decompressed(self) -> Message:
+        message = await self._receive()
+        if message["type"] != "http.request":
+            return message
+
+        data = message.get("body", b"")
+        more_body = message.get("more_body", False)
+        if not self._header_checked:
+            # Buffer data until we have enough to check the gzip magic number
+            self._header += data
+            if len(self._header) < 2 and more_body:
+                return {"type": "http.request", "body": b"", "more_body": True}
+            if not is_gz_data(self._header):
+                raise MalformedBodyError("Request body is not gzip-compressed")
+            self._header_checked = True
+            data, self._header = self._header, b""
+
+        body = self._decompress(data)
+        # Only flush once all input has been consumed, since flushing is not size-limited
+        if not more_body:
+            body += self._decompress_tail()
+        if not more_body and not self._decompressor.eof:
+            raise MalformedBodyError("Request body is truncated")
+        return {"type": "http.request", "body": body, "more_body": more_body}
+
+    def _decompress(self, data: bytes) -> bytes:
+        try:
+            body = self._decompressor.decompress(data, self.max_size - self.size + 1)
+        except zlib.error as e:
+            raise MalformedBodyError(f"Request body could not be decompressed ({e})")
+        self._check_size(body)
+        return body
+
+    def _decompress_tail(self) -> bytes:
+        try:
+            body = self._decompressor.flush()
+        except zlib.error as e:
+            raise MalformedBodyError(f"Request body could not be decompressed ({e})")
+        self._check_size(body)
+        return body
+
+    def _check_size(self, body: bytes) -> None:
+        self.size += len(body)
+        # Input is left unconsumed only if more data would be produced than is allowed
+        if self.size > self.max_size or self._decompressor.unconsumed_tail:
+            raise MalformedBodyError("Decompressed request body is too large", status_code=413)
+
+
+def select_encoding(accept_encoding: str) -> Optional[str]:
+    """Return the preferred encoding supported by both the client and the server."""
+    accepted: List[Tuple[float, str]] = []
+    for item in accept_encoding.split(","):
+        encoding, _, params = item.strip().partition(";")
+        quality = 1.0
+        if params.strip().startswith("q="):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                continue
+        if quality > 0:
+            accepted.append((quality, encoding.strip().lower()))
+
+    supported = ["br", "gzip"] if brotli is not None else ["gzip"]
+    candidates = [
+        (quality, -supported.index(encoding), encoding)
+        for quality, encoding in accepted
+        if encoding in supported
+    ]
+    return max(candidates)[2] if candidates else None
+
+
+class _GzipCompressor:
+    def __init__(self) -> None:
+        self._compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.compress(data)
+
+    def flush(self) -> bytes:
+        return self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self) -> bytes:
+        return self._compressor.flush(zlib.Z_FINISH)
+
+
+class _BrotliCompressor:
+    def __init__(self) -> None:
+        self._compressor = brotli.Compressor()
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.process(data)
+
+    def flush(self) -> bytes:
+        return self._compressor.flush()
+
+    def finish(self) -> bytes:
+        return self._compressor.finish()
+
+
+def _make_compressor(encoding: str) -> Any:
+    return _BrotliCompressor() if encoding == "br" else _GzipCompressor()
@@ -0,0 +1,149 @@
+"""Local, content-addressed store for the results of finished jobs.
+
+Results are kept gzip-compressed under ``objects/<sha256>.jsonl.gz``, and ``jobs/<job_id>``
+holds the digest of the results of each job. Results are immutable once a pipeline finishes,
+so they never have to be re-downloaded from GitLab unless they get evicted.
+
+All functions perform blocking file I/O and should be run in an executor.
+"""
+
+import gzip
+import hashlib
+import logging
+import os
+import tempfile
+from pathlib import Path
+from typing import Optional, Union
+
+from elaspic2_rest_api import config, utils
+
+logger = logging.getLogger(__name__)
+
+
+class ResultsWriter:
+    """Add results of job `job_id` to the store incrementally.
+
+    Results become visible only once `commit` is called; `abort` discards them.
+    """
+
+    def __init__(self, job_id: Union[int, str]) -> None:
+        self.job_id = job_id
+        self._hash = hashlib.sha256()
+        fd, self._tmp_path = tempfile.mkstemp(dir=_objects_dir(), prefix=".tmp-")
+        self._raw_file = os.fdopen(fd, "wb")
+        self._file = gzip.GzipFile(fileobj=self._raw_file, mode="wb")
+
+    def write(self, data: bytes) -> None:
+        self._hash.update(data)
+        self._file.write(data)
+
+    def commit(self) -> str:
+        """Add the written results to the store and return their digest."""
+        self._close()
+        digest = self._hash.hexdigest()
+        object_path = _objects_dir().joinpath(f"{digest}.jsonl.gz")
+        if object_path.is_file():
+            os.unlink(self._tmp_path)
+            utils.touch(object_path)
+        else:
+            os.replace(self._tmp_path, object_path)
+        utils.write_atomic(_jobs_dir().joinpath(str(self.job_id)), digest.encode())
+        evict()
+        return digest
+
+    def abort(self) -> None:
+        self._close()
+        try:
+            os.unlink(self._tmp_path)
+        except FileNotFoundError:
+            pass
+
+    def _close(self) -> None:
+        self._file.close()
+        self._raw_file.close()
+
+
+def open_results(job_id: Union[int, str]) -> Optional[gzip.GzipFile]:
+    """Open decompressed results of job `job_id` for reading, or return `None` if missing."""
+    object_path = get_object_path(job_id)
+    if object_path is None:
+        return None
+    try:
+        fin = gzip.open(object_path, "rb")
+    except FileNotFoundError:
+        delete(job_id)
+        return None
+    # Modification time is used to find least-recently-used objects
+    utils.touch(object_path)
+    return fin
+
+
+def get(job_id: Union[int, str]) -> Optional[bytes]:
+    """Return results of job `job_id`, or `None` if they are not in the store."""
+    fin = open_results(job_id)
+    if fin is None:
+        return None
+    with fin:
+        return fin.read()
+
+
+def put(job_id: Union[int, str], data: bytes) -> str:
+    """Add results of job `job_id` to the store and return their digest."""
+    writer = ResultsWriter(job_id)
+    try:
+        writer.write(data)
+    except BaseException:
+        writer.abort()
+        raise
+    return writer.commit()
+
+
+def delete(job_id: Union[int, str]) -> None:
+    """Remove job `job_id` from the store.
+
+    Results may be shared by several jobs, so they are left for `evict` to clean up.
+    """
+    try:
+        _jobs_dir().joinpath(str(job_id)).unlink()
+    except FileNotFoundError:
+        pass
+
+
+def contains(job_id: Union[int, str]) -> bool:
+    object_path = get_object_path(job_id)
+    return object_path is not None and object_path.is_file()
+
+
+def get_object_path(job_id: Union[int, str]) -> Optional[Path]:
+    """Return the path to the compressed results of job `job_id`, if it has been stored."""
+    try:
+        digest = _jobs_dir().joinpath(str(job_id)).read_text().strip()
+    except FileNotFoundError:
+        return None
+    return _objects_dir().joinpath(f"{digest}.jsonl.gz")
+
+
+def evict(max_bytes: Optional[int] = None) -> int:
+    """Remove least-recently-used results until the store fits within `max_bytes`.
+
+    Returns the number of bytes that were freed.
+    """
+    if max_bytes is None:
+        max_bytes = config.RESULTS_STORE_MAX_BYTES
+
+    freed_bytes = utils.evict_lru(_objects_dir(), max_bytes)
+    if freed_bytes:
+        logger.info("Evicted %s bytes of results from the results store", freed_bytes)
+    return freed_bytes
+
+
+def _objects_dir() -> Path:
+    path = Path(config.RESULTS_STORE_DIR).joinpath("objects")
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def _jobs_dir() -> Path:
+    path = Path(config.RESULTS_STORE_DIR).joinpath("jobs")
+    path.mkdir(parents=True, exist_ok=True)
+    return path
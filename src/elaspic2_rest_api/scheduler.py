@@ -0,0 +1,206 @@
+"""Schedule requests to the GitLab API so that they stay within its rate limits.
+
+All requests go through a token bucket, which starts out at ``GITLAB_RATE_LIMIT`` requests per
+minute and follows the ``RateLimit-*`` and ``Retry-After`` headers returned by GitLab.
+Requests which are rejected with 429, or which fail with a transient error, are retried with
+jittered exponential backoff. When requests have to wait, those made on behalf of users go
+before those made by background tasks.
+"""
+
+import asyncio
+import contextvars
+import heapq
+import itertools
+import logging
+import random
+import sys
+import time
+from contextlib import asynccontextmanager
+from typing import Any, AsyncContextManager, AsyncIterator, Callable, List, Optional, Tuple
+
+import aiohttp
+
+from elaspic2_rest_api import config
+
+logger = logging.getLogger(__name__)
+
+USER_PRIORITY = 0
+
+BACKGROUND_PRIORITY = 1
+
+#: Priority of requests made in the current context; background tasks set it for themselves
+request_priority: contextvars.ContextVar[int] = contextvars.ContextVar(
+    "request_priority", default=USER_PRIORITY
+)
+
+#: Statuses of responses to requests which should be tried again
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+_scheduler: Optional["RequestScheduler"] = None
+
+
+class RequestScheduler:
+    def __init__(
+        self,
+        rate_limit: float,
+        burst: int,
+        max_retries: int,
+        backoff_base: float,
+        backoff_max: float,
+    ) -> None:
+        self.loop = asyncio.get_running_loop()
+        #: Number of requests allowed per second
+        self.rate = rate_limit / 60
+        self.burst = burst
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._tokens = float(burst)
+        self._updated_at = time.monotonic()
+        self._paused_until = 0.0
+        self._waiters: List[Tuple[int, int, "asyncio.Future[None]"]] = []
+        self._counter = itertools.count()
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    async def acquire(self, priority: Optional[int] = None) -> None:
+        """Wait until a request with the given priority may be sent."""
+        if priority is None:
+            priority = request_priority.get()
+        future = self.loop.create_future()
+        heapq.heappush(self._waiters, (priority, next(self._counter), future))
+        self._dispatch()
+        await future
+
+    @asynccontextmanager
+    async def request(
+        self,
+        make_request: Callable[[], AsyncContextManager[aiohttp.ClientResponse]],
+        priority: Optional[int] = None,
+        idempotent: bool = True,
+    ) -> AsyncIterator[aiohttp.ClientResponse]:
+        """Send the request made by `make_request`, retrying it if necessary.
+
+        Requests which are not `idempotent` are only retried if GitLab did not process them,
+        i.e. if they were rejected with 429.
+        """
+        for attempt in itertools.count():
+            await self.acquire(priority)
+            request_context = make_request()
+            try:
+                response = await request_context.__aenter__()
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                if not idempotent or attempt >= self.max_retries:
+                    raise
+                delay = self._get_backoff(attempt)
+                logger.info("Retrying GitLab request in %.1f s after error %r", delay, e)
+                await asyncio.sleep(delay)
+                continue
+
+            self.update(response)
+            if attempt < self.max_retries and (
+                response.status == 429 or (idempotent and response.status in RETRY_STATUSES)
+            ):
+                delay = _get_retry_after(response) or self._get_backoff(attempt)
+                await request_context.__aexit__(None, None, None)
+                logger.info(
+                    "Retrying GitLab request in %.1f s after status %s", delay, response.status
+                )
+                await asyncio.sleep(delay)
+                continue
+
+            try:
+                yield response
+            except BaseException:
+                if not await request_context.__aexit__(*sys.exc_info()):
+                    raise
+            else:
+                await request_context.__aexit__(None, None, None)
+            return
+
+    def update(self, response: aiohttp.ClientResponse) -> None:
+        """Adjust the rate of requests according to the rate limits reported by GitLab."""
+        now = time.monotonic()
+        limit = _get_header_number(response, "RateLimit-Limit")
+        if limit:
+            self.rate = limit / 60
+        remaining = _get_header_number(response, "RateLimit-Remaining")
+        if remaining is not None:
+            self._refill(now)
+            self._tokens = min(self._tokens, remaining)
+            reset = _get_header_number(response, "RateLimit-Reset")
+            if remaining < 1 and reset is not None:
+                self._pause(now + reset - time.time())
+        retry_after = _get_retry_after(response)
+        if retry_after is not None:
+            self._pause(now + retry_after)
+
+    def _pause(self, until: float) -> None:
+        if until > self._paused_until:
+            self._paused_until = until
+            logger.warning("Pausing GitLab requests for %.1f s", until - time.monotonic())
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.burst, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    def _dispatch(self) -> None:
+        """Let waiting requests through, in order of priority, for as long as tokens remain."""
+        now = time.monotonic()
+        self._refill(now)
+        while self._waiters and now >= self._paused_until and self._tokens >= 1:
+            _, _, future = heapq.heappop(self._waiters)
+            if future.done():
+                continue
+            self._tokens -= 1
+            future.set_result(None)
+
+        if self._waiters and self._timer is None:
+            delay = max(self._paused_until - now, (1 - self._tokens) / self.rate, 0)
+            self._timer = self.loop.call_later(delay, self._on_timer)
+
+    def _on_timer(self) -> None:
+        self._timer = None
+        self._dispatch()
+
+    def _get_backoff(self, attempt: int) -> float:
+        return min(self.backoff_max, self.backoff_base * 2**attempt) * random.uniform(0.5, 1)
+
+
+def get_scheduler() -> RequestScheduler:
+    """Return the process-wide request scheduler, creating it on first use.
+
+    Must be called from within a running event loop.
+    """
+    global _scheduler
+
+    if _scheduler is None or _scheduler.loop is not asyncio.get_running_loop():
+        _scheduler = RequestScheduler(
+            rate_limit=config.GITLAB_RATE_LIMIT,
+            burst=config.GITLAB_RATE_LIMIT_BURST,
+            max_retries=config.GITLAB_MAX_RETRIES,
+            backoff_base=config.GITLAB_BACKOFF_BASE,
+            backoff_max=config.GITLAB_BACKOFF_MAX,
+        )
+    return _scheduler
+
+
+def request(
+    make_request: Callable[[], AsyncContextManager[aiohttp.ClientResponse]], **kwargs: Any
+) -> AsyncContextManager[aiohttp.ClientResponse]:
+    """Send a request through the process-wide scheduler; see `RequestScheduler.request`."""
+    return get_scheduler().request(make_request, **kwargs)
+
+
+def _get_header_number(response: aiohttp.ClientResponse, name: str) -> Optional[float]:
+    value = response.headers.get(name)
+    if not isinstance(value, str):
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+def _get_retry_after(response: aiohttp.ClientResponse) -> Optional[float]:
+    retry_after = _get_header_number(response, "Retry-After")
+    return max(retry_after, 0) if retry_after is not None else None
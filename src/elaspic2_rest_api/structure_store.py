@@ -0,0 +1,316 @@
+"""Local, content-addressed store for the protein structures used by jobs.
+
+Structures are downloaded from ``protein_structure_url`` once, when a job is submitted, and are
+kept under ``objects/<sha256>`` (or ``objects/<sha256>.gz`` if they are gzip-compressed), while
+``urls/<sha256 of url>`` holds the digest of the structure found at each URL. Pipelines are then
+given the URL at which this service serves the stored structure, so that jobs referencing the
+same structure do not each download it from its source.
+
+Structural templates uploaded by users are kept in the same store, decompressed, and are
+identified by the name of the stored file.
+
+The store is only used if ``STRUCTURE_STORE_URL`` is set to the URL at which pipelines can
+reach this service. Since downloads are made from the host of the service, they are limited to
+``STRUCTURE_FETCH_ALLOWED_HOSTS`` and to public addresses; pipelines download other structures
+from their source themselves.
+"""
+
+import asyncio
+import hashlib
+import ipaddress
+import logging
+import os
+import re
+import socket
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+import aiohttp
+from aiohttp.abc import AbstractResolver
+
+from elaspic2_rest_api import config, utils
+from elaspic2_rest_api.bin_utils import GzipStreamDecoder, is_gz_file
+
+logger = logging.getLogger(__name__)
+
+#: Names of stored structures: their digest, followed by ".gz" if they are gzip-compressed
+OBJECT_NAME_PATTERN = re.compile(r"^[0-9a-f]{64}(\.gz)?$")
+
+#: Number of bytes read at a time when downloading structures
+CHUNK_SIZE = 64 * 1024
+
+_session: Optional[aiohttp.ClientSession] = None
+
+_semaphore: Optional[Tuple[asyncio.AbstractEventLoop, asyncio.Semaphore]] = None
+
+#: Structures which are currently being downloaded, keyed by URL
+_pending_fetches: Dict[str, "asyncio.Task[str]"] = {}
+
+
+class StructureFetchError(Exception):
+    pass
+
+
+class StructureTooLargeError(Exception):
+    pass
+
+
+def is_enabled() -> bool:
+    return bool(config.STRUCTURE_STORE_URL)
+
+
+def prefetch(url: str) -> None:
+    """Start downloading the structure at `url` in the background, unless it is stored."""
+    task = _start_fetch(url)
+    # Errors are reported to whoever asks for the reference to the structure
+    task.add_done_callback(lambda t: t.cancelled() or t.exception())
+
+
+async def get_reference(url: str) -> str:
+    """Return the URL at which pipelines can download the structure found at `url`."""
+    name = await asyncio.shield(_start_fetch(url))
+    return get_url(name)
+
+
+def get_url(name: str) -> str:
+    """Return the URL at which pipelines can download the stored structure `name`."""
+    return f"{(config.STRUCTURE_STORE_URL or '').rstrip('/')}/structures/{name}"
+
+
+async def close_session() -> None:
+    global _session
+
+    if _session is not None:
+        await _session.close()
+        _session = None
+
+
+def _start_fetch(url: str) -> "asyncio.Task[str]":
+    # Concurrent requests for the same structure share a single download
+    task = _pending_fetches.get(url)
+    if task is None:
+        task = asyncio.create_task(_fetch(url))
+        _pending_fetches[url] = task
+        task.add_done_callback(lambda _: _pending_fetches.pop(url, None))
+    return task
+
+
+async def _fetch(url: str) -> str:
+    loop = asyncio.get_running_loop()
+    name = await loop.run_in_executor(None, get_object_name, url)
+    if name is not None:
+        return name
+
+    _check_url(url)
+    async with _get_semaphore():
+        writer = await loop.run_in_executor(None, StructureWriter, url)
+        try:
+            # Redirects could lead to hosts which are not allowed
+            async with _get_session().get(url, allow_redirects=False) as response:
+                if response.status != 200:
+                    raise StructureFetchError(
+                        f"Could not download structure from {url} ({response.status})"
+                    )
+                async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                    await loop.run_in_executor(None, writer.write, chunk)
+        except BaseException:
+            await loop.run_in_executor(None, writer.abort)
+            raise
+    return await loop.run_in_executor(None, writer.commit)
+
+
+def _check_url(url: str) -> None:
+    """Raise `StructureFetchError` unless structures may be downloaded from `url`."""
+    parts = urlsplit(url)
+    host = parts.hostname or ""
+    if parts.scheme not in ("http", "https") or not host:
+        raise StructureFetchError(f"Structures cannot be downloaded from {url}")
+    allowed_hosts = config.STRUCTURE_FETCH_ALLOWED_HOSTS
+    if "*" not in allowed_hosts and host.lower() not in allowed_hosts:
+        raise StructureFetchError(f"Structures cannot be downloaded from {host}")
+    # Host names are checked once resolved, by `_PublicResolver`
+    try:
+        address = ipaddress.ip_address(host)
+    except ValueError:
+        return
+    if not _is_public_address(str(address)):
+        raise StructureFetchError(f"Structures cannot be downloaded from {host}")
+
+
+def _is_public_address(host: str) -> bool:
+    address = ipaddress.ip_address(host)
+    if isinstance(address, ipaddress.IPv6Address) and address.ipv4_mapped is not None:
+        address = address.ipv4_mapped
+    return address.is_global
+
+
+class _PublicResolver(AbstractResolver):
+    """Resolve host names, refusing those with loopback, link-local or private addresses."""
+
+    def __init__(self) -> None:
+        self._resolver = aiohttp.DefaultResolver()
+
+    async def resolve(
+        self, host: str, port: int = 0, family: int = socket.AF_INET
+    ) -> List[Dict[str, Any]]:
+        hosts = await self._resolver.resolve(host, port, family)
+        if not all(_is_public_address(h["host"]) for h in hosts):
+            raise StructureFetchError(f"Structures cannot be downloaded from {host}")
+        return hosts
+
+    async def close(self) -> None:
+        await self._resolver.close()
+
+
+def _get_session() -> aiohttp.ClientSession:
+    global _session
+
+    # Not the GitLab session, which would send the GitLab token to other hosts
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(resolver=_PublicResolver()),
+            timeout=aiohttp.ClientTimeout(total=config.STRUCTURE_FETCH_TIMEOUT),
+        )
+    return _session
+
+
+def _get_semaphore() -> asyncio.Semaphore:
+    global _semaphore
+
+    loop = asyncio.get_running_loop()
+    if _semaphore is None or _semaphore[0] is not loop:
+        _semaphore = (loop, asyncio.Semaphore(config.STRUCTURE_FETCH_CONCURRENCY))
+    return _semaphore[1]
+
+
+class StructureWriter:
+    """Add the structure downloaded from `url`, if any, to the store incrementally.
+
+    The structure becomes visible only once `commit` is called; `abort` discards it.
+    All methods perform blocking file I/O and should be run in an executor.
+    """
+
+    def __init__(self, url: Optional[str] = None) -> None:
+        self.url = url
+        self.size = 0
+        self._hash = hashlib.sha256()
+        fd, self._tmp_path = tempfile.mkstemp(dir=_objects_dir(), prefix=".tmp-")
+        self._file = os.fdopen(fd, "wb")
+
+    def write(self, data: bytes) -> None:
+        self.size += len(data)
+        if self.size > config.MAX_STRUCTURE_SIZE:
+            raise StructureTooLargeError(f"Structure at {self.url or 'upload'} is too large")
+        self._hash.update(data)
+        self._file.write(data)
+
+    def commit(self) -> str:
+        """Add the written structure to the store and return its name."""
+        self._file.close()
+        name = self._hash.hexdigest()
+        if is_gz_file(self._tmp_path):
+            name += ".gz"
+        object_path = _objects_dir().joinpath(name)
+        if object_path.is_file():
+            os.unlink(self._tmp_path)
+            utils.touch(object_path)
+        else:
+            os.replace(self._tmp_path, object_path)
+        if self.url is not None:
+            utils.write_atomic(_urls_dir().joinpath(_get_url_digest(self.url)), name.encode())
+        evict()
+        return name
+
+    def abort(self) -> None:
+        self._file.close()
+        try:
+            os.unlink(self._tmp_path)
+        except FileNotFoundError:
+            pass
+
+
+class TemplateWriter(StructureWriter):
+    """Add an uploaded structural template to the store incrementally.
+
+    Templates are uploaded gzip-compressed, and possibly base64-encoded, and are stored
+    decompressed. `ValueError` is raised if the upload is malformed.
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.upload_size = 0
+        self._decoder = GzipStreamDecoder()
+
+    def write(self, data: bytes) -> None:
+        self.upload_size += len(data)
+        if self.upload_size > config.MAX_STRUCTURE_SIZE:
+            raise StructureTooLargeError("Uploaded template is too large")
+        for chunk in self._decoder.decode(data):
+            super().write(chunk)
+
+    def commit(self) -> str:
+        super().write(self._decoder.flush())
+        return super().commit()
+
+
+def get_object_name(url: str) -> Optional[str]:
+    """Return the name of the structure downloaded from `url`, if it is stored and recent."""
+    url_path = _urls_dir().joinpath(_get_url_digest(url))
+    try:
+        if time.time() - url_path.stat().st_mtime > config.STRUCTURE_URL_MAX_AGE:
+            return None
+        name = url_path.read_text().strip()
+    except FileNotFoundError:
+        return None
+    object_path = _objects_dir().joinpath(name)
+    if not object_path.is_file():
+        return None
+    utils.touch(object_path)
+    return name
+
+
+def get_object_path(name: str, touch: bool = False) -> Optional[Path]:
+    """Return the path to the stored structure `name`, or `None` if it is not stored.
+
+    If `touch` is set, the structure is marked as used, which keeps it from being evicted.
+    """
+    if not OBJECT_NAME_PATTERN.match(name):
+        return None
+    object_path = _objects_dir().joinpath(name)
+    if touch:
+        utils.touch(object_path)
+    return object_path if object_path.is_file() else None
+
+
+def evict(max_bytes: Optional[int] = None) -> int:
+    """Remove least-recently-used structures until the store fits within `max_bytes`.
+
+    Structures used recently are kept, since pipelines may still have to download them.
+    Returns the number of bytes that were freed.
+    """
+    if max_bytes is None:
+        max_bytes = config.STRUCTURE_STORE_MAX_BYTES
+
+    freed_bytes = utils.evict_lru(_objects_dir(), max_bytes, config.STRUCTURE_EVICT_MIN_AGE)
+    if freed_bytes:
+        logger.info("Evicted %s bytes of structures from the structure store", freed_bytes)
+    return freed_bytes
+
+
+def _get_url_digest(url: str) -> str:
+    return hashlib.sha256(url.encode()).hexdigest()
+
+
+def _objects_dir() -> Path:
+    path = Path(config.STRUCTURE_STORE_DIR).joinpath("objects")
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def _urls_dir() -> Path:
+    path = Path(config.STRUCTURE_STORE_DIR).joinpath("urls")
+    path.mkdir(parents=True, exist_ok=True)
+    return path
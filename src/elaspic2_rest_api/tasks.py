@@ -1,14 +1,22 @@
 import asyncio
 import logging
 
-from elaspic2_rest_api.gitlab_monitor import retry_failed_jobs_task
+from elaspic2_rest_api import config
+from elaspic2_rest_api.gitlab_monitor import prefetch_results_task, retry_failed_jobs_task
+from elaspic2_rest_api.jobs import check_pipelines_in_flight_task
 
 logger = logging.getLogger(__name__)
 
 task_coros = {
-    "retry_failed_jobs": retry_failed_jobs_task,
+    "check_pipelines_in_flight": check_pipelines_in_flight_task,
 }
 
+# These tasks watch GitLab pipelines, which are only used by the GitLab executor backend
+if config.EXECUTOR_BACKEND == "gitlab":
+    task_coros.update(
+        retry_failed_jobs=retry_failed_jobs_task, prefetch_results=prefetch_results_task
+    )
+
 
 async def start_and_monitor_tasks():
     tasks = {
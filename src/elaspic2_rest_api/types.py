@@ -1,4 +1,4 @@
-from typing import Optional
+from typing import List, Optional
 
 from pydantic import BaseModel
 
@@ -8,6 +8,7 @@ class JobRequest(BaseModel):
     protein_sequence: str
     mutations: str
     ligand_sequence: Optional[str]
+    structural_template: Optional[str]
 
     class Config:
         schema_extra = {
@@ -23,18 +24,23 @@ class JobRequest(BaseModel):
         }
 
 
+class TemplateResponse(BaseModel):
+    id: str
+
+
 class JobResponse(BaseModel):
     id: str
     web_url: str
 
 
 class JobState(BaseModel):
-    id: int
+    id: str
     status: str
     created_at: Optional[str]
     started_at: Optional[str]
     finished_at: Optional[str]
     web_url: Optional[str]
+    queue_position: Optional[int]
 
 
 class MutationResult(BaseModel):
@@ -46,3 +52,35 @@ class MutationResult(BaseModel):
     proteinsolver_interface: Optional[float]
     el2interface: Optional[float]
     error_message: Optional[str]
+
+
+class JobError(BaseModel):
+    id: str
+    status_code: int
+    detail: str
+
+
+class JobStates(BaseModel):
+    jobs: List[JobState]
+    errors: List[JobError]
+
+
+class JobBatchError(BaseModel):
+    index: int
+    status_code: int
+    detail: str
+
+
+class JobBatchResponse(BaseModel):
+    jobs: List[Optional[JobResponse]]
+    errors: List[JobBatchError]
+
+
+class LoadState(BaseModel):
+    pipelines_in_flight: int
+    max_pipelines_in_flight: int
+    queued_jobs: int
+    queued_mutations: int
+    max_queued_mutations: Optional[int]
+    throughput: float
+    estimated_wait: Optional[float]
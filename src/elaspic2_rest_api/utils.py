@@ -1,6 +1,18 @@
 import functools
+import hashlib
+import ipaddress
+import json
+import os
 import re
+import tempfile
+import time
 import uuid
+from datetime import datetime
+from pathlib import Path
+from typing import Iterable, List, Optional
+
+from elaspic2_rest_api import config
+from elaspic2_rest_api.types import JobRequest
 
 
 @functools.lru_cache(maxsize=128, typed=False)
@@ -11,6 +23,117 @@ def get_job_id(protein_sequence, ligand_sequence, mutations):
     return defaults.get((protein_sequence, ligand_sequence, mutations), str(uuid.uuid4()))
 
 
+def split_mutations(mutations: str) -> List[str]:
+    """Split a comma-separated list of mutations, dropping duplicates but preserving order."""
+    return list(dict.fromkeys(mutations.split(",")))
+
+
+def get_context_hash(request: JobRequest) -> str:
+    """Return a digest of everything in `request` which affects the score of each mutation."""
+    data = [request.protein_sequence, request.ligand_sequence or "", request.protein_structure_url]
+    # Appended only when set, so that digests of jobs without a template do not change
+    if request.structural_template is not None:
+        data.append(request.structural_template)
+    return hashlib.sha256(json.dumps(data, separators=(",", ":")).encode()).hexdigest()
+
+
+def get_request_hash(request: JobRequest) -> str:
+    """Return a digest which is identical for all requests describing the same work.
+
+    The order of mutations, as well as duplicate mutations, do not affect the digest.
+    """
+    data = [get_context_hash(request), sorted(set(request.mutations.split(",")))]
+    return hashlib.sha256(json.dumps(data, separators=(",", ":")).encode()).hexdigest()
+
+
+def jsonl_to_json_array(chunks: Iterable[bytes]) -> bytes:
+    """Combine newline-delimited JSON documents into a JSON array, without parsing them."""
+    return (
+        b"["
+        + b",".join(line for data in chunks for line in data.split(b"\n") if line.strip())
+        + b"]"
+    )
+
+
+def utc_now() -> str:
+    """Return the current time in the ISO 8601 format used by GitLab."""
+    return datetime.utcnow().isoformat(timespec="milliseconds") + "Z"
+
+
+def touch(path: Path) -> None:
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        pass
+
+
+def write_atomic(path: Path, data: bytes) -> None:
+    """Write `data` to `path` so that concurrent readers never see a partially-written file."""
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as fout:
+            fout.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def evict_lru(directory: Path, max_bytes: int, min_age: float = 0) -> int:
+    """Remove least-recently-modified files from `directory` until it fits within `max_bytes`.
+
+    Hidden files, such as those still being written, and files modified within the last
+    `min_age` seconds are left alone, even if `directory` does not fit as a result. Returns the
+    number of bytes that were freed.
+    """
+    files = []
+    for entry in os.scandir(directory):
+        if entry.name.startswith("."):
+            continue
+        try:
+            stat = entry.stat()
+        except FileNotFoundError:
+            continue
+        files.append((stat.st_mtime, stat.st_size, entry.path))
+
+    total_bytes = sum(size for _, size, _ in files)
+    freed_bytes = 0
+    cutoff = time.time() - min_age
+    for mtime, size, path in sorted(files):
+        if total_bytes - freed_bytes <= max_bytes or mtime > cutoff:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            continue
+        freed_bytes += size
+    return freed_bytes
+
+
+def is_trusted_proxy(host: str) -> bool:
+    """Return `True` if `host` is one of ``config.TRUSTED_PROXIES``."""
+    try:
+        address = ipaddress.ip_address(host)
+    except ValueError:
+        return False
+    return any(
+        address in ipaddress.ip_network(proxy, strict=False) for proxy in config.TRUSTED_PROXIES
+    )
+
+
+def check_job_request(request: JobRequest) -> Optional[str]:
+    """Return the reason why `request` is invalid, or `None` if it is valid."""
+    if not check_aa_sequence(request.protein_sequence):
+        return "Protein sequence is malformed"
+    if request.ligand_sequence is not None and not check_aa_sequence(request.ligand_sequence):
+        return "Ligand sequence is malformed"
+    if not check_mutations(request.mutations):
+        return "Mutations are in an unexpected format"
+    if not check_mutations_match_sequence(request.protein_sequence, request.mutations):
+        return "Mutation(s) do not match the protein sequence"
+    return None
+
+
 def check_aa_sequence(aa_sequence: str) -> bool:
     return re.match("^[GVALICMFWPDESTYQNKRH]+$", aa_sequence) is not None
 
@@ -25,6 +148,6 @@ def check_mutations(mutations: str) -> bool:
 def check_mutations_match_sequence(aa_sequence: str, mutations: str) -> bool:
     for mutation in mutations.split(","):
         wt, pos, _ = mutation[0], int(mutation[1:-1]), mutation[-1]
-        if aa_sequence[pos - 1] != wt:
+        if not 1 <= pos <= len(aa_sequence) or aa_sequence[pos - 1] != wt:
             return False
     return True
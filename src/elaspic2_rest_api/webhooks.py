@@ -0,0 +1,76 @@
+"""Receive GitLab pipeline events, so that job states are pushed to us instead of being polled.
+
+GitLab should be configured to send pipeline events to the ``/webhooks/gitlab`` endpoint, with
+the secret token set to ``GITLAB_WEBHOOK_TOKEN``. Pipeline events are sent whenever the status of
+a pipeline changes, including when it is caused by one of its jobs, so job events carry no extra
+information and are only acknowledged.
+"""
+
+import hmac
+import logging
+from datetime import datetime
+from typing import Any, Dict, Mapping, Optional
+
+from elaspic2_rest_api import config, gitlab_async, jobs
+from elaspic2_rest_api.gitlab import GitlabHttpError, make_job_state
+
+logger = logging.getLogger(__name__)
+
+PIPELINE_EVENT = "Pipeline Hook"
+
+JOB_EVENT = "Job Hook"
+
+
+def verify_token(token: Optional[str]) -> bool:
+    """Return `True` if `token` matches the secret token configured for webhooks."""
+    if not config.GITLAB_WEBHOOK_TOKEN or token is None:
+        return False
+    return hmac.compare_digest(token.encode(), config.GITLAB_WEBHOOK_TOKEN.encode())
+
+
+async def handle_event(event_type: str, payload: Mapping[str, Any]) -> None:
+    if event_type == PIPELINE_EVENT:
+        await handle_pipeline_event(payload)
+    elif event_type != JOB_EVENT:
+        logger.info("Ignoring unexpected GitLab event %r", event_type)
+
+
+async def handle_pipeline_event(payload: Mapping[str, Any]) -> None:
+    if payload.get("project", {}).get("id") != config.GITLAB_PROJECT_ID:
+        logger.info("Ignoring pipeline event for another project")
+        return
+
+    pipeline = make_pipeline(payload)
+    if pipeline["status"] == "failed":
+        # Only the job artifacts tell real failures apart from premature ones, which get retried
+        try:
+            job_state, _ = await gitlab_async.get_job_state(pipeline["id"], False)
+        except GitlabHttpError:
+            job_state = make_job_state(pipeline, None)
+    else:
+        job_state = make_job_state(pipeline, None)
+    await jobs.set_pipeline_state(pipeline["id"], pipeline["status"], job_state)
+
+
+def make_pipeline(payload: Mapping[str, Any]) -> Dict[str, Any]:
+    """Convert a pipeline event into a pipeline, as it would be returned by the GitLab API."""
+    attributes = payload["object_attributes"]
+    started_ats = [b["started_at"] for b in payload.get("builds", []) if b.get("started_at")]
+    return {
+        "id": attributes["id"],
+        "status": attributes["status"],
+        "created_at": _to_iso_time(attributes.get("created_at")),
+        "started_at": _to_iso_time(min(started_ats, default=None)),
+        "finished_at": _to_iso_time(attributes.get("finished_at")),
+    }
+
+
+def _to_iso_time(value: Optional[str]) -> Optional[str]:
+    """Convert a webhook timestamp (e.g. "2021-01-01 00:00:00 UTC") into the API format."""
+    if value is None:
+        return None
+    try:
+        timestamp = datetime.strptime(value, "%Y-%m-%d %H:%M:%S UTC")
+    except ValueError:
+        return value
+    return timestamp.isoformat(timespec="milliseconds") + "Z"
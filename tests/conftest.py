@@ -1,5 +1,19 @@
 import os
 
+import pytest
 from dotenv import load_dotenv
 
 load_dotenv(dotenv_path=os.getenv("ENV_FILE", ".env"), override=True)
+
+
+def pytest_addoption(parser):
+    parser.addoption("--benchmark", action="store_true", help="Run benchmark tests.")
+
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption("--benchmark"):
+        return
+    skip_benchmark = pytest.mark.skip(reason="Benchmarks only run with --benchmark")
+    for item in items:
+        if "benchmark" in item.keywords:
+            item.add_marker(skip_benchmark)
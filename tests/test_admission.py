@@ -0,0 +1,106 @@
+from unittest.mock import patch
+
+from elaspic2_rest_api.admission import AdmissionQueue
+
+
+def test_admission_queue_fair_share():
+    queue = AdmissionQueue(max_in_flight=2, max_per_client=2)
+    queue.push("scan-1", "a", size=5000, num_pipelines=1)
+    queue.push("scan-2", "a", size=5000, num_pipelines=1)
+    assert [entry.job_id for entry in queue.pop_admissible()] == ["scan-1", "scan-2"]
+    queue.add_pipelines("a", {1: 5000, 2: 5000}, 2)
+
+    # Runners are busy, so later jobs wait, with small jobs of other clients going first
+    queue.push("scan-3", "a", size=5000, num_pipelines=1)
+    queue.push("small-1", "b", size=5, num_pipelines=1)
+    queue.push("small-2", "c", size=5, num_pipelines=1)
+    assert queue.pop_admissible() == []
+    assert [queue.position(job_id) for job_id in ["scan-3", "small-1", "small-2"]] == [2, 0, 1]
+
+    assert queue.release(1)
+    assert not queue.release(1)
+    assert [entry.job_id for entry in queue.pop_admissible()] == ["small-1"]
+    queue.add_pipelines("b", {3: 5}, 1)
+    assert queue.position("small-2") == 0
+
+    assert queue.remove("small-2")
+    assert queue.position("small-2") is None
+    queue.release(2)
+    queue.release(3)
+    assert [entry.job_id for entry in queue.pop_admissible()] == ["scan-3"]
+    assert len(queue) == 0
+
+
+def test_admission_queue_per_client_cap():
+    queue = AdmissionQueue(max_in_flight=10, max_per_client=2)
+    queue.push("a-1", "a", size=10, num_pipelines=2)
+    queue.push("a-2", "a", size=10, num_pipelines=1)
+    queue.push("b-1", "b", size=100, num_pipelines=1)
+    # The second job of client "a" would go over its cap, so it waits even though there is room
+    assert [entry.job_id for entry in queue.pop_admissible()] == ["a-1", "b-1"]
+    assert queue.num_in_flight == 3
+    assert "a-2" in queue
+
+    # Pipelines which could not be created no longer count as in flight
+    queue.add_pipelines("a", {1: 10}, 2)
+    assert [entry.job_id for entry in queue.pop_admissible()] == ["a-2"]
+
+    # Jobs larger than the cap start once the client has nothing else in flight
+    queue.push("a-3", "a", size=10, num_pipelines=5)
+    assert queue.pop_admissible() == []
+    queue.add_pipelines("a", {2: 10}, 1)
+    queue.release(1)
+    queue.release(2)
+    assert [entry.job_id for entry in queue.pop_admissible()] == ["a-3"]
+
+
+def test_admission_queue_budget():
+    queue = AdmissionQueue(
+        max_in_flight=1, max_per_client=1, max_queued_work=100, max_queued_work_per_client=60
+    )
+    queue.push("a-1", "a", size=10, num_pipelines=1)
+    queue.pop_admissible()
+    queue.add_pipelines("a", {1: 10}, 1)
+
+    queue.push("a-2", "a", size=50, num_pipelines=1)
+    assert queue.get_excess_work("a", 10) == 0
+    assert queue.get_excess_work("a", 20) == 10
+    queue.push("b-1", "b", size=30, num_pipelines=1)
+    assert queue.get_excess_work("c", 30) == 10
+    assert queue.queued_work == 80
+
+    # Nothing finished yet, so there is no telling how long queued work takes
+    assert queue.estimate_wait(80) is None
+    queue.release(1)
+    assert queue.get_throughput() == 10 / queue.throughput_window
+    assert queue.estimate_wait(10) == queue.throughput_window
+
+    assert queue.remove("b-1")
+    assert [entry.job_id for entry in queue.pop_admissible()] == ["a-2"]
+    assert queue.queued_work == 0
+
+
+def test_admission_queue_no_starvation():
+    queue = AdmissionQueue(max_in_flight=10, max_per_client=10, max_wait=60)
+    with patch("elaspic2_rest_api.admission.time.monotonic", return_value=0):
+        for i in range(10):
+            queue.push(f"small-{i}", f"client-{i}", size=5, num_pipelines=1)
+            queue.pop_admissible()
+            queue.add_pipelines(f"client-{i}", {i: 5}, 1)
+        queue.push("scan", "a", size=500, num_pipelines=10)
+
+    # Small jobs of new clients overtake the scan, taking each runner which frees up
+    with patch("elaspic2_rest_api.admission.time.monotonic", return_value=30):
+        queue.push("small-10", "client-10", size=5, num_pipelines=1)
+        queue.release(0)
+        assert [entry.job_id for entry in queue.pop_admissible()] == ["small-10"]
+        queue.add_pipelines("client-10", {10: 5}, 1)
+
+    # Once the scan waited for too long, runners which free up are kept for it
+    with patch("elaspic2_rest_api.admission.time.monotonic", return_value=90):
+        for i in range(1, 11):
+            queue.push(f"small-{10 + i}", f"client-{10 + i}", size=5, num_pipelines=1)
+            queue.release(i)
+            admitted = [entry.job_id for entry in queue.pop_admissible()]
+            assert admitted == (["scan"] if i == 10 else [])
+    assert len(queue) == 10
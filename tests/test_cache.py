@@ -0,0 +1,25 @@
+from unittest.mock import patch
+
+from elaspic2_rest_api.cache import TTLCache
+
+
+def test_ttl_cache_expiry():
+    cache = TTLCache(maxsize=10, ttl=5)
+    with patch("elaspic2_rest_api.cache.time.monotonic", return_value=0):
+        cache.set("running", 1)
+        cache.set("finished", 2, ttl=None)
+    with patch("elaspic2_rest_api.cache.time.monotonic", return_value=10):
+        assert cache.get("running") is None
+        assert cache.get("finished") == 2
+    assert cache.info() == (1, 1, 10, 1)
+
+
+def test_ttl_cache_lru_eviction():
+    cache = TTLCache(maxsize=2, ttl=None)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+    assert "a" in cache
+    assert "b" not in cache
+    assert "c" in cache
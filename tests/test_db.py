@@ -0,0 +1,63 @@
+import threading
+from unittest.mock import patch
+
+import pytest
+
+from elaspic2_rest_api import db
+
+
+@pytest.fixture
+def local_db(tmp_path):
+    with patch("elaspic2_rest_api.config.DB_PATH", str(tmp_path.joinpath("db.sqlite"))):
+        db.close_connection()
+        yield
+        db.close_connection()
+
+
+def test_transaction_isolated_between_threads(local_db):
+    transaction_started = threading.Event()
+    may_roll_back = threading.Event()
+
+    def fail_transaction():
+        connection = db.get_connection()
+        with pytest.raises(ValueError):
+            with db._transaction(connection):
+                connection.execute(
+                    "INSERT INTO watermarks (name, value) VALUES ('rolled-back', '1')"
+                )
+                transaction_started.set()
+                may_roll_back.wait(5)
+                raise ValueError
+
+    thread = threading.Thread(target=fail_transaction)
+    thread.start()
+    assert transaction_started.wait(5)
+    # Writes of other threads wait for the transaction, rather than becoming part of it
+    setter = threading.Thread(target=db.set_watermark, args=("other", "2"))
+    setter.start()
+    setter.join(0.5)
+    may_roll_back.set()
+    thread.join()
+    setter.join()
+
+    assert db.get_watermark("rolled-back") is None
+    assert db.get_watermark("other") == "2"
+
+
+def test_job_results_eviction(local_db):
+    results = [{"mutation": "G1A", "el2core": 1.0}, {"mutation": "S2A", "el2core": 2.0}]
+    with patch("elaspic2_rest_api.config.RESULTS_INDEX_MAX_ROWS", 4):
+        db.add_job_results("job-1", results)
+        db.add_job_results("job-2", results)
+        # Queried results are kept in favour of those which were not queried since
+        assert len(db.query_job_results("job-1")) == 2
+        db.add_job_results("job-3", results)
+        assert db.has_job_results("job-1")
+        assert not db.has_job_results("job-2")
+        assert db.query_job_results("job-2") == []
+        assert db.has_job_results("job-3")
+
+        # Results are indexed even if they do not fit
+        db.add_job_results("job-4", results * 3)
+        assert len(db.query_job_results("job-4")) == 6
+        assert not db.has_job_results("job-1")
@@ -0,0 +1,183 @@
+import asyncio
+import itertools
+import sys
+from pathlib import Path
+from unittest.mock import patch
+
+import orjson
+import pytest
+
+from elaspic2_rest_api import db, executors, state
+from elaspic2_rest_api.gitlab import GitlabHttpError
+from elaspic2_rest_api.types import JobRequest
+
+#: Writes one result per mutation, like the pipeline job does
+COMMAND = (
+    f'{sys.executable} -c "'
+    "import json, os; "
+    "f = open('results/results.jsonl', 'w'); "
+    "[f.write(json.dumps({'mutation': m}) + '\\\\n') for m in os.environ['MUTATIONS'].split(',')]"
+    '"'
+)
+
+
+@pytest.fixture
+def local_backend(tmp_path):
+    with patch("elaspic2_rest_api.config.DB_PATH", str(tmp_path.joinpath("db.sqlite"))), patch(
+        "elaspic2_rest_api.config.EXECUTOR_WORK_DIR", str(tmp_path.joinpath("runs"))
+    ), patch("elaspic2_rest_api.config.LOCAL_EXECUTOR_WORKERS", 1):
+        db.close_connection()
+        yield executors.LocalBackend()
+        db.close_connection()
+
+
+async def wait_until_finished(backend, job_id, timeout=30):
+    for _ in range(int(timeout / 0.1)):
+        job_state = await backend.get_job_state(job_id)
+        if job_state.status in ("success", "failed", "canceled"):
+            return job_state
+        await asyncio.sleep(0.1)
+    raise AssertionError(f"Job {job_id} did not finish")
+
+
+def make_request(mutations: str) -> JobRequest:
+    return JobRequest(
+        protein_structure_url="https://files.rcsb.org/download/1MFG.pdb",
+        protein_sequence="GSMEIRVRVEKDPELGFSISGG",
+        mutations=mutations,
+        ligand_sequence="EYLGLDVPV",
+    )
+
+
+@pytest.mark.asyncio
+async def test_local_backend(local_backend):
+    with patch("elaspic2_rest_api.config.LOCAL_EXECUTOR_COMMAND", COMMAND):
+        job_ids = [
+            await local_backend.create_job(make_request("G1A,S2A")),
+            await local_backend.create_job(make_request("M3A")),
+        ]
+        # Only one job runs at a time
+        assert len(state.queues["working"]) == 1
+        assert str(job_ids[1]) in state.queues["pending"]
+
+        for job_id in job_ids:
+            job_state = await wait_until_finished(local_backend, job_id)
+            assert job_state.status == "success"
+            assert job_state.started_at is not None and job_state.finished_at is not None
+
+        _, data = await local_backend.get_job_data(job_ids[0], True)
+        assert [orjson.loads(line)["mutation"] for line in data.splitlines()] == ["G1A", "S2A"]
+
+        await local_backend.delete_job(job_ids[0])
+        assert (await local_backend.get_job_state(job_ids[0])).status == "success"
+        with pytest.raises(GitlabHttpError):
+            await local_backend.get_job_data(job_ids[0], True)
+
+    with pytest.raises(GitlabHttpError):
+        await local_backend.get_job_state(12345)
+
+
+@pytest.mark.asyncio
+async def test_local_backend_failure(local_backend):
+    with patch("elaspic2_rest_api.config.LOCAL_EXECUTOR_COMMAND", f"{sys.executable} -c pass"):
+        job_id = await local_backend.create_job(make_request("G1A"))
+        assert (await wait_until_finished(local_backend, job_id)).status == "failed"
+
+
+@pytest.mark.asyncio
+async def test_local_backend_cancel(local_backend):
+    command = f'{sys.executable} -c "import time; time.sleep(60)"'
+    with patch("elaspic2_rest_api.config.LOCAL_EXECUTOR_COMMAND", command):
+        job_ids = [
+            await local_backend.create_job(make_request("G1A")),
+            await local_backend.create_job(make_request("S2A")),
+        ]
+        for job_id in job_ids:
+            await local_backend.delete_job(job_id)
+            assert (await local_backend.get_job_state(job_id)).status == "canceled"
+        await asyncio.sleep(0.5)
+        assert not state.queues["pending"] and not state.queues["working"]
+
+
+@pytest.mark.asyncio
+async def test_local_backend_recover(local_backend, tmp_path):
+    # Runs left behind by a worker which was stopped
+    work_dir = tmp_path.joinpath("runs", "interrupted")
+    work_dir.mkdir(parents=True)
+    running_id = db.add_executor_run("local", str(work_dir), "2021-01-01T00:00:00Z")
+    db.update_executor_run(running_id, "running", started_at="2021-01-01T00:00:00Z")
+
+    work_dir = tmp_path.joinpath("runs", "pending")
+    work_dir.joinpath("results").mkdir(parents=True)
+    work_dir.joinpath("request.json").write_text(make_request("G1A").json())
+    pending_id = db.add_executor_run("local", str(work_dir), "2021-01-01T00:00:00Z")
+
+    with patch("elaspic2_rest_api.config.LOCAL_EXECUTOR_COMMAND", COMMAND):
+        await executors.LocalBackend().recover()
+        assert (await local_backend.get_job_state(running_id)).status == "failed"
+        assert (await wait_until_finished(local_backend, pending_id)).status == "success"
+        _, data = await local_backend.get_job_data(pending_id, True)
+        assert orjson.loads(data)["mutation"] == "G1A"
+
+
+@pytest.fixture
+def slurm_backend(tmp_path):
+    with patch("elaspic2_rest_api.config.DB_PATH", str(tmp_path.joinpath("db.sqlite"))), patch(
+        "elaspic2_rest_api.config.EXECUTOR_WORK_DIR", str(tmp_path.joinpath("runs"))
+    ), patch("elaspic2_rest_api.config.SLURM_BATCH_SCRIPT", "run.sh"):
+        db.close_connection()
+        yield executors.SlurmBackend()
+        db.close_connection()
+
+
+_slurm_job_ids = itertools.count(42)
+
+
+def mock_slurm(squeue, sacct=""):
+    """Mock Slurm commands, with `squeue` returning (or raising) the given result."""
+
+    async def run_command(args, env=None):
+        if args[0] == "sbatch":
+            return f"{next(_slurm_job_ids)};cluster\n"
+        result = {"squeue": squeue, "sacct": sacct}[args[0]]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    return patch("elaspic2_rest_api.executors._run_command", run_command)
+
+
+@pytest.mark.asyncio
+async def test_slurm_backend(slurm_backend):
+    with mock_slurm("PENDING\n"):
+        job_id = await slurm_backend.create_job(make_request("G1A"))
+        assert (await slurm_backend.get_job_state(job_id)).status == "pending"
+
+    with mock_slurm("RUNNING\n"):
+        job_state = await slurm_backend.get_job_state(job_id)
+        assert job_state.status == "running" and job_state.started_at is not None
+
+    # Jobs whose state cannot be told, or which are requeued, keep their last known status
+    for squeue in [RuntimeError("squeue failed: Socket timed out"), "REQUEUED\n", "PREEMPTED\n"]:
+        with mock_slurm(squeue):
+            assert (await slurm_backend.get_job_state(job_id)).status == "running"
+
+    # Jobs which completed succeeded if they wrote their results
+    run = db.get_executor_run(job_id)
+    Path(run.work_dir, executors.RESULTS_PATH).write_text('{"mutation": "G1A"}\n')
+    with mock_slurm(RuntimeError("squeue failed: Invalid job id specified"), "COMPLETED\n"):
+        assert (await slurm_backend.get_job_state(job_id)).status == "success"
+
+
+@pytest.mark.asyncio
+async def test_slurm_backend_failure(slurm_backend):
+    with mock_slurm("RUNNING\n"):
+        job_ids = [await slurm_backend.create_job(make_request("G1A")) for _ in range(3)]
+
+    with mock_slurm("", "CANCELLED by 1000\n"):
+        assert (await slurm_backend.get_job_state(job_ids[0])).status == "canceled"
+    with mock_slurm("TIMEOUT\n"):
+        assert (await slurm_backend.get_job_state(job_ids[1])).status == "failed"
+    # Without accounting, jobs which left the queue without results failed
+    with mock_slurm("", RuntimeError("sacct failed: accounting storage is disabled")):
+        assert (await slurm_backend.get_job_state(job_ids[2])).status == "failed"
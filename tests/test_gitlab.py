@@ -0,0 +1,36 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import MagicMock, patch
+
+from elaspic2_rest_api import gitlab
+
+
+def test_shared_client():
+    try:
+        client = gitlab.open_client()
+        assert gitlab.open_client() is client
+        # Lazy project handles must not make any requests to the server
+        project = gitlab.get_project()
+        assert gitlab.get_project() is project
+    finally:
+        gitlab.close_client()
+    assert gitlab.open_client() is not client
+    gitlab.close_client()
+
+
+def test_shared_project_concurrent():
+    def get_project(project_id, lazy):
+        time.sleep(0.05)
+        return MagicMock()
+
+    client = MagicMock()
+    client.projects.get.side_effect = get_project
+    with patch("elaspic2_rest_api.gitlab.gitlab.Gitlab", return_value=client):
+        try:
+            with ThreadPoolExecutor(4) as executor:
+                projects = list(executor.map(lambda _: gitlab.get_project(), range(4)))
+        finally:
+            gitlab.close_client()
+    # Concurrent first calls share a single project handle
+    assert all(project is projects[0] for project in projects)
+    assert client.projects.get.call_count == 1
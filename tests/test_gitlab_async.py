@@ -0,0 +1,85 @@
+from contextlib import asynccontextmanager
+from unittest.mock import patch
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from elaspic2_rest_api import gitlab_async
+
+PIPELINE = {
+    "id": 1,
+    "status": "success",
+    "created_at": "2021-01-01T00:00:00Z",
+    "started_at": "2021-01-01T00:01:00Z",
+    "finished_at": "2021-01-01T00:02:00Z",
+}
+
+
+@asynccontextmanager
+async def gitlab_server():
+    routes = web.RouteTableDef()
+
+    @routes.get("/pipelines/1")
+    async def get_pipeline(request):
+        return web.json_response(PIPELINE)
+
+    @routes.get("/pipelines/1/jobs")
+    async def get_pipeline_jobs(request):
+        pipeline_job = {"id": 11, "name": "predict-mutation-effect", "status": "success"}
+        return web.json_response([pipeline_job])
+
+    @routes.get("/pipelines/3")
+    async def get_parent_pipeline(request):
+        return web.json_response({**PIPELINE, "id": 3})
+
+    @routes.get("/pipelines/3/jobs")
+    async def get_parent_pipeline_jobs(request):
+        return web.json_response([{"id": 31, "name": "trigger", "status": "success"}])
+
+    @routes.get("/pipelines/3/bridges")
+    async def get_parent_pipeline_bridges(request):
+        return web.json_response([{"id": 32, "downstream_pipeline": PIPELINE}])
+
+    @routes.get("/jobs/11/artifacts/results/input.json")
+    async def get_input(request):
+        return web.Response(body=b"{}")
+
+    @routes.get("/jobs/11/artifacts/results/results.jsonl")
+    async def get_results(request):
+        return web.Response(body=b'{"mutation": "G1A"}\n{"mutation": "G1C"}\n')
+
+    app = web.Application()
+    app.add_routes(routes)
+    server = TestServer(app)
+    await server.start_server()
+    with patch.object(gitlab_async, "GITLAB_PROJECT_ENDPOINT", str(server.make_url(""))):
+        try:
+            yield server
+        finally:
+            await gitlab_async.close_session()
+            await server.close()
+
+
+@pytest.mark.asyncio
+async def test_get_job_state():
+    async with gitlab_server():
+        job_state, job_result = await gitlab_async.get_job_state(1, collect_results=True)
+    assert job_state.id == "1"
+    assert job_state.status == "success"
+    assert [r["mutation"] for r in job_result] == ["G1A", "G1C"]
+
+
+@pytest.mark.asyncio
+async def test_get_job_state_missing():
+    async with gitlab_server():
+        with pytest.raises(gitlab_async.GitlabHttpError):
+            await gitlab_async.get_job_state(2)
+
+
+@pytest.mark.asyncio
+async def test_get_job_state_child_pipeline():
+    async with gitlab_server():
+        job_state, job_result = await gitlab_async.get_job_state(3, collect_results=True)
+    assert job_state.id == "3"
+    assert [r["mutation"] for r in job_result] == ["G1A", "G1C"]
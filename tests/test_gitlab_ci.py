@@ -0,0 +1,40 @@
+import pytest
+
+from elaspic2_rest_api import gitlab_ci
+from elaspic2_rest_api.gitlab import PIPELINE_JOB_NAME
+from elaspic2_rest_api.types import JobRequest
+
+yaml = pytest.importorskip("yaml")
+
+
+def test_render_template():
+    request = JobRequest(
+        protein_structure_url="https://files.rcsb.org/download/1MFG.pdb",
+        protein_sequence="GSMEIRVRVEK",
+        mutations="G1A,G1C,S2A,M3A,E4A",
+        ligand_sequence="EYLGLDVPV",
+    )
+    gitlab_ci_config = yaml.safe_load(gitlab_ci.render_template(request, mutations_per_worker=2))
+
+    assert gitlab_ci_config["variables"]["PROTEIN_SEQUENCE"] == "GSMEIRVRVEK"
+    assert gitlab_ci_config["variables"]["LIGAND_SEQUENCE"] == "EYLGLDVPV"
+    assert gitlab_ci_config["variables"]["STRUCTURAL_TEMPLATE_URL"] == ""
+    # One parallel job per batch of mutations
+    assert gitlab_ci_config["evaluate-mutations"]["parallel"]["matrix"] == [
+        {"MUTATIONS": ["G1A,G1C", "S2A,M3A", "E4A"]}
+    ]
+    assert gitlab_ci_config[PIPELINE_JOB_NAME]["needs"] == ["evaluate-mutations"]
+    # Each batch uploads its results from a directory of its own
+    evaluate_mutations = gitlab_ci_config["evaluate-mutations"]
+    assert "RESULTS_DIR" not in evaluate_mutations.get("variables", {})
+    assert evaluate_mutations["artifacts"]["paths"] == ["results/batch-${CI_NODE_INDEX}/"]
+    assert any(
+        "results/batch-${CI_NODE_INDEX}/" in line for line in evaluate_mutations["after_script"]
+    )
+
+    # Jobs with many mutations are split into at most `MAX_PARALLEL_JOBS` batches
+    request = request.copy(update={"mutations": ",".join(["G1A"] * 1000), "ligand_sequence": None})
+    gitlab_ci_config = yaml.safe_load(gitlab_ci.render_template(request, mutations_per_worker=1))
+    assert gitlab_ci_config["variables"]["LIGAND_SEQUENCE"] == ""
+    matrix = gitlab_ci_config["evaluate-mutations"]["parallel"]["matrix"]
+    assert len(matrix[0]["MUTATIONS"]) == gitlab_ci.MAX_PARALLEL_JOBS
@@ -1,10 +1,13 @@
-from unittest.mock import MagicMock
+from unittest.mock import AsyncMock, MagicMock, patch
 
 import aiohttp
 import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
 
-from elaspic2_rest_api import gitlab_monitor
+from elaspic2_rest_api import db, gitlab_monitor
 from elaspic2_rest_api.ci_utils import return_on_call
+from elaspic2_rest_api.types import JobState
 
 
 @pytest.mark.asyncio
@@ -13,6 +16,38 @@ async def test_retry_failed_jobs_task():
         await gitlab_monitor.retry_failed_jobs_task()
 
 
+@pytest.mark.asyncio
+async def test_retry_failed_jobs_capped(tmp_path):
+    pipelines = [
+        {"id": i, "status": "failed", "updated_at": f"2021-01-01T00:{i // 60:02}:{i % 60:02}.000Z"}
+        for i in range(150)
+    ]
+    list_updated = AsyncMock(return_value=pipelines)
+    select_premature_failures = AsyncMock(side_effect=lambda pipelines, limit: pipelines[:1])
+    retry_pipelines = AsyncMock()
+    with patch("elaspic2_rest_api.config.DB_PATH", str(tmp_path.joinpath("db.sqlite"))), patch(
+        "elaspic2_rest_api.config.GITLAB_WEBHOOK_TOKEN", ""
+    ), patch("elaspic2_rest_api.config.MAX_FAILURE_CHECKS", 100), patch.object(
+        gitlab_monitor.failed_pipelines, "list_updated", list_updated
+    ), patch(
+        "elaspic2_rest_api.gitlab_monitor.select_premature_failures", select_premature_failures
+    ), patch(
+        "elaspic2_rest_api.gitlab_monitor.retry_pipelines", retry_pipelines
+    ), patch(
+        "elaspic2_rest_api.gitlab_monitor.get_session", MagicMock()
+    ):
+        db.close_connection()
+        try:
+            with return_on_call("elaspic2_rest_api.gitlab_monitor.asyncio.sleep"):
+                await gitlab_monitor.retry_failed_jobs_task()
+            # Pipelines which were not checked are left for the next cycle
+            assert select_premature_failures.call_args[0][0] == pipelines[:100]
+            assert retry_pipelines.call_args[0][1] == pipelines[:1]
+            assert db.get_watermark("failed_pipelines") == pipelines[99]["updated_at"]
+        finally:
+            db.close_connection()
+
+
 @pytest.mark.asyncio
 async def test_get_pipeline_infos():
     async with aiohttp.ClientSession() as session:
@@ -35,3 +70,104 @@ async def test_delete_pipelines():
     pipelines = [{"id": 0}, {"id": 1}]
     await gitlab_monitor.delete_pipelines(mock_session, pipelines)
     mock_session.delete.assert_called()
+
+
+@pytest.mark.asyncio
+async def test_pipeline_lister(tmp_path):
+    requests = []
+
+    async def get_pipelines(request):
+        requests.append(request)
+        if request.headers.get("If-None-Match") == '"1"':
+            return web.Response(status=304)
+        pipelines = [{"id": 1, "status": "failed", "updated_at": "2021-01-01T00:10:00.000Z"}]
+        return web.json_response(pipelines, headers={"ETag": '"1"'})
+
+    app = web.Application()
+    app.router.add_get("/", get_pipelines)
+    server = TestServer(app)
+    await server.start_server()
+    lister = gitlab_monitor.PipelineLister("test", [("status", "failed")])
+    with patch("elaspic2_rest_api.config.DB_PATH", str(tmp_path.joinpath("db.sqlite"))), patch(
+        "elaspic2_rest_api.gitlab_monitor.GITLAB_PIPELINES_ENDPOINT", str(server.make_url("/"))
+    ):
+        db.close_connection()
+        try:
+            async with aiohttp.ClientSession() as session:
+                pipeline_infos = await lister.list_updated(session)
+                assert len(pipeline_infos) == 1
+                assert "updated_after" not in requests[0].query
+                assert requests[0].query["sort"] == "asc"
+                await lister.advance(pipeline_infos)
+                # Only pipelines updated since the previous listing are requested
+                assert len(await lister.list_updated(session)) == 1
+                assert requests[1].query["updated_after"] == "2021-01-01T00:09:00.000Z"
+                # Unchanged listings are not fetched again
+                assert await lister.list_updated(session) == []
+                assert lister.num_pages == 0
+        finally:
+            db.close_connection()
+            await server.close()
+
+
+@pytest.mark.asyncio
+async def test_pipeline_lister_pages(tmp_path):
+    async def get_pipelines(request):
+        page = int(request.query.get("page", "1"))
+        pipelines = [
+            {"id": page, "status": "success", "updated_at": f"2021-01-01T00:0{page}:00.000Z"}
+        ]
+        headers = {"Link": f'<{request.url.update_query(page=page + 1)}>; rel="next"'}
+        return web.json_response(pipelines, headers=headers if page < 3 else {})
+
+    app = web.Application()
+    app.router.add_get("/", get_pipelines)
+    server = TestServer(app)
+    await server.start_server()
+    lister = gitlab_monitor.PipelineLister("test", [("status", "success")])
+    with patch("elaspic2_rest_api.config.DB_PATH", str(tmp_path.joinpath("db.sqlite"))), patch(
+        "elaspic2_rest_api.gitlab_monitor.GITLAB_PIPELINES_ENDPOINT", str(server.make_url("/"))
+    ):
+        db.close_connection()
+        try:
+            async with aiohttp.ClientSession() as session:
+                # The watermark stays put until listed pipelines have been handled
+                assert [p["id"] for p in await lister.list_updated(session, max_pages=1)] == [1]
+                assert db.get_watermark("test") is None
+                pipeline_infos = await lister.list_updated(session, max_pages=2)
+                assert [p["id"] for p in pipeline_infos] == [1, 2]
+                # Pipelines on pages which were not fetched are not skipped
+                await lister.advance(pipeline_infos)
+                assert db.get_watermark("test") == "2021-01-01T00:02:00.000Z"
+                # Pages of pipelines seen before do not count towards the limit
+                pipeline_infos = await lister.list_updated(session, max_pages=1)
+                assert [p["id"] for p in pipeline_infos] == [1, 2, 3]
+        finally:
+            db.close_connection()
+            await server.close()
+
+
+@pytest.mark.asyncio
+async def test_select_premature_failures(tmp_path):
+    async def get_job_state(pipeline_id, collect_results):
+        status = "failed" if pipeline_id % 2 else "pending"
+        return JobState(id=pipeline_id, status=status), None
+
+    get_job_state = AsyncMock(side_effect=get_job_state)
+    pipelines = [{"id": i, "status": "failed"} for i in range(10)]
+    pipelines.append({"id": 10, "status": "success"})
+    with patch("elaspic2_rest_api.config.DB_PATH", str(tmp_path.joinpath("db.sqlite"))), patch(
+        "elaspic2_rest_api.gitlab_monitor.get_job_state", get_job_state
+    ):
+        db.close_connection()
+        try:
+            selected = await gitlab_monitor.select_premature_failures(pipelines, limit=3)
+            assert [p["id"] for p in selected] == [0, 2, 4]
+            assert get_job_state.call_count == 10
+
+            # Real failures are remembered and not checked again
+            selected = await gitlab_monitor.select_premature_failures(pipelines, limit=None)
+            assert [p["id"] for p in selected] == [0, 2, 4, 6, 8]
+            assert get_job_state.call_count == 15
+        finally:
+            db.close_connection()
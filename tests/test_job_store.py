@@ -0,0 +1,45 @@
+from unittest.mock import patch
+
+import pytest
+
+from elaspic2_rest_api import db
+from elaspic2_rest_api.db import JobRecord
+from elaspic2_rest_api.job_store import SQLiteJobStore
+from elaspic2_rest_api.types import JobRequest
+
+
+@pytest.fixture
+def job_store(tmp_path):
+    with patch("elaspic2_rest_api.config.DB_PATH", str(tmp_path.joinpath("db.sqlite"))):
+        db.close_connection()
+        yield SQLiteJobStore()
+        db.close_connection()
+
+
+def test_sqlite_job_store(job_store):
+    request = JobRequest(
+        protein_structure_url="https://files.rcsb.org/download/1MFG.pdb",
+        protein_sequence="GSMEIRVRVEKDPELGFSISGG",
+        mutations="G1A,S2A",
+    )
+    job_record = JobRecord("job", [101, 102], [["G1A"], ["S2A"]], "context", ["G1A", "S2A"], "t0")
+    job_store.add_job(job_record, request)
+    job_store.add_submission("hash", "job")
+    assert job_store.get_job("job") == job_record
+    assert job_store.get_job_request("job") == request
+    assert job_store.get_jobs_by_pipeline(102) == [job_record]
+    assert job_store.get_submission("hash") == "job"
+
+    assert job_store.add_state_transition("job", "pending", "t1")
+    assert not job_store.add_state_transition("job", "pending", "t2")
+    assert job_store.add_state_transition("job", "success", "t3")
+    assert job_store.get_state_transitions("job") == [("pending", "t1"), ("success", "t3")]
+
+    job_store.set_result_location(101, 1001)
+    assert job_store.get_result_location(101) == 1001
+
+    job_store.delete_job("job")
+    assert job_store.get_job("job") is None
+    assert job_store.get_job_request("job") is None
+    assert job_store.get_submission("hash") is None
+    assert job_store.get_state_transitions("job") == []
@@ -0,0 +1,303 @@
+import asyncio
+from unittest.mock import AsyncMock, patch
+
+import orjson
+import pytest
+
+from elaspic2_rest_api import db, jobs, results_store
+from elaspic2_rest_api.admission import AdmissionQueue
+from elaspic2_rest_api.types import JobRequest, JobState
+
+
+@pytest.fixture
+def local_data(tmp_path):
+    with patch("elaspic2_rest_api.config.DB_PATH", str(tmp_path.joinpath("db.sqlite"))), patch(
+        "elaspic2_rest_api.config.RESULTS_STORE_DIR", str(tmp_path.joinpath("results"))
+    ), patch("elaspic2_rest_api.jobs.admission_queue", AdmissionQueue(100, 20)):
+        db.close_connection()
+        jobs.job_state_cache.clear()
+        yield tmp_path
+        db.close_connection()
+        jobs.job_state_cache.clear()
+
+
+def make_request(mutations: str) -> JobRequest:
+    return JobRequest(
+        protein_structure_url="https://files.rcsb.org/download/1MFG.pdb",
+        protein_sequence="GSMEIRVRVEKDPELGFSISGG",
+        mutations=mutations,
+        ligand_sequence="EYLGLDVPV",
+    )
+
+
+@pytest.mark.asyncio
+async def test_submit_job_deduplication(local_data):
+    create_job = AsyncMock(side_effect=[101, 102])
+    get_job_state = AsyncMock(return_value=(JobState(id=101, status="running"), None))
+    with patch("elaspic2_rest_api.gitlab_async.create_job", create_job), patch(
+        "elaspic2_rest_api.gitlab_async.get_job_state", get_job_state
+    ):
+        assert await jobs.submit_job(make_request("G1A,S2A")) == "101"
+        assert await jobs.submit_job(make_request("S2A,G1A")) == "101"
+        assert create_job.call_count == 1
+
+        # Failed jobs are not reused
+        jobs.job_state_cache.clear()
+        get_job_state.return_value = (JobState(id=101, status="failed"), None)
+        assert await jobs.submit_job(make_request("G1A,S2A")) == "102"
+        assert create_job.call_count == 2
+
+
+@pytest.mark.asyncio
+async def test_mutation_results_cache(local_data):
+    create_job = AsyncMock(side_effect=[101, 102])
+    job_data = (
+        JobState(id=101, status="success"),
+        b'{"mutation": "G1A", "el2core": 1.0}\n{"mutation": "S2A", "el2core": 2.0}\n',
+    )
+    with patch("elaspic2_rest_api.gitlab_async.create_job", create_job), patch(
+        "elaspic2_rest_api.gitlab_async.get_job_data", AsyncMock(return_value=job_data)
+    ):
+        job_id = await jobs.submit_job(make_request("G1A,S2A"))
+        assert len(await jobs.get_job_results(job_id)) == 2
+
+        # Mutations which were evaluated before are not sent to GitLab again
+        job_id = await jobs.submit_job(make_request("S2A"))
+        assert create_job.call_count == 1
+        assert (await jobs.get_job_state(job_id)).status == "success"
+        assert await jobs.get_job_results(job_id) == [{"mutation": "S2A", "el2core": 2.0}]
+
+        await jobs.submit_job(make_request("S2A,E4A"))
+        assert create_job.call_args[0][0].mutations == "E4A"
+
+
+@pytest.mark.asyncio
+async def test_fanout(local_data):
+    async def get_job_data(pipeline_id, collect_results):
+        mutation = {201: "G1A", 202: "S2A"}[pipeline_id]
+        data = f'{{"mutation": "{mutation}"}}\n'.encode()
+        return JobState(id=pipeline_id, status="success"), data
+
+    create_job = AsyncMock(side_effect=[201, 202])
+    with patch("elaspic2_rest_api.config.FANOUT_MUTATIONS_PER_PIPELINE", 1), patch(
+        "elaspic2_rest_api.gitlab_async.create_job", create_job
+    ), patch("elaspic2_rest_api.gitlab_async.get_job_data", get_job_data):
+        job_id = await jobs.submit_job(make_request("G1A,S2A"))
+        assert create_job.call_count == 2
+        results = await jobs.get_job_results(job_id)
+        assert [r["mutation"] for r in results] == ["G1A", "S2A"]
+
+
+def test_combine_pipeline_states():
+    def combine(*statuses):
+        pipeline_states = [JobState(id=i, status=s) for i, s in enumerate(statuses)]
+        return jobs.combine_pipeline_states("job", pipeline_states).status
+
+    assert combine("success", "success") == "success"
+    assert combine("success", "pending") == "running"
+    assert combine("running", "failed") == "failed"
+    assert combine("pending", "created") == "pending"
+    assert combine("created", "scheduled", "manual") == "pending"
+    assert combine("skipped") == "skipped"
+    # Jobs with pipelines which finished without results are finished as well
+    assert combine("success", "skipped") == "failed"
+    assert combine("success", "canceled") == "canceled"
+    assert combine("skipped", "canceled") == "failed"
+    assert combine("success", "manual") == "running"
+    for statuses in [("success", "skipped"), ("canceled", "success"), ("failed", "skipped")]:
+        assert combine(*statuses) in jobs.TERMINAL_STATUSES
+
+
+@pytest.mark.asyncio
+async def test_iter_job_results(local_data):
+    with patch("elaspic2_rest_api.jobs.RESULTS_CHUNK_SIZE", 4):
+        results_store.put(301, b'{"mutation": "G1A"}')
+        results_store.put(302, b'{"mutation": "S2A"}\n')
+        db.add_job(
+            db.JobRecord(
+                "job", [301, 302], [["G1A"], ["S2A"]], "context", ["G1A", "S2A"], "2021-01-01"
+            )
+        )
+        chunks = [chunk async for chunk in jobs.iter_job_results("job")]
+        assert len(chunks) > 2
+        assert b"".join(chunks) == b'{"mutation": "G1A"}\n{"mutation": "S2A"}\n'
+
+
+@pytest.mark.asyncio
+async def test_query_job_results(local_data):
+    job_data = (
+        JobState(id=401, status="success"),
+        b'{"mutation": "G1A", "el2core": 1.0}\n'
+        b'{"mutation": "S2A", "el2core": 3.0}\n'
+        b'{"mutation": "M3A", "el2core": 2.0}\n'
+        b'{"mutation": "E4A", "error_message": "Failed"}\n',
+    )
+    get_job_data = AsyncMock(return_value=job_data)
+    with patch("elaspic2_rest_api.gitlab_async.get_job_data", get_job_data):
+        jobs.job_state_cache.set(401, job_data[0])
+
+        rows = await jobs.query_job_results("401", sort_by="el2core", limit=2)
+        assert [orjson.loads(row)["mutation"] for row in rows] == ["S2A", "M3A"]
+
+        rows = await jobs.query_job_results("401", sort_by="el2core", descending=False)
+        assert [orjson.loads(row)["mutation"] for row in rows] == ["G1A", "M3A", "S2A"]
+
+        rows = await jobs.query_job_results("401", positions=[1, 4], offset=1)
+        assert [orjson.loads(row)["mutation"] for row in rows] == ["E4A"]
+
+        rows = await jobs.query_job_results("401", mutations=["M3A"])
+        assert [orjson.loads(row)["mutation"] for row in rows] == ["M3A"]
+
+        # Results are indexed once, when they are first queried
+        assert get_job_data.call_count == 1
+
+
+@pytest.mark.asyncio
+async def test_wait_for_job_state(local_data):
+    states = iter(["running", "running", "success"])
+
+    async def get_job_state(pipeline_id, collect_results):
+        return JobState(id=pipeline_id, status=next(states)), None
+
+    get_job_state = AsyncMock(side_effect=get_job_state)
+    with patch("elaspic2_rest_api.config.JOB_WATCH_INTERVAL", 0.01), patch.object(
+        jobs.job_state_cache, "ttl", 0
+    ), patch("elaspic2_rest_api.gitlab_async.get_job_state", get_job_state):
+        job_state = JobState(id="501", status="running")
+        # All waiters share the same upstream checks
+        results = await asyncio.gather(
+            *[jobs.wait_for_job_state("501", job_state, 5) for _ in range(100)]
+        )
+        assert {r.status for r in results} == {"success"}
+        assert get_job_state.call_count == 3
+        assert not jobs._job_watchers
+
+
+@pytest.mark.asyncio
+async def test_get_job_states(local_data):
+    async def get_job_state(pipeline_id, collect_results):
+        if pipeline_id == 602:
+            raise jobs.GitlabHttpError("Not found", 404)
+        return JobState(id=pipeline_id, status="running"), None
+
+    with patch("elaspic2_rest_api.gitlab_async.get_job_state", get_job_state):
+        job_states = await jobs.get_job_states(["601", "602", "missing", "601"])
+    assert list(job_states) == ["601", "602", "missing"]
+    assert job_states["601"].status == "running"
+    assert isinstance(job_states["602"], jobs.GitlabHttpError)
+    assert isinstance(job_states["missing"], jobs.GitlabHttpError)
+
+
+@pytest.mark.asyncio
+async def test_submit_jobs(local_data):
+    async def create_job(request):
+        if request.mutations == "E4A":
+            raise jobs.GitlabHttpError("Failed", 500)
+        return {"G1A": 701, "S2A": 702}[request.mutations]
+
+    create_job = AsyncMock(side_effect=create_job)
+    with patch("elaspic2_rest_api.gitlab_async.create_job", create_job):
+        job_ids = await jobs.submit_jobs(
+            [make_request("G1A"), make_request("S2A"), make_request("G1A"), make_request("E4A")]
+        )
+    assert job_ids[:3] == ["701", "702", "701"]
+    assert isinstance(job_ids[3], jobs.GitlabHttpError)
+    assert create_job.call_count == 3
+
+
+@pytest.mark.asyncio
+async def test_queued_jobs(local_data):
+    pipeline_ids = iter([801, 802, 803])
+    create_job = AsyncMock(side_effect=lambda request: next(pipeline_ids))
+    pipeline_statuses = {801: "running", 802: "running", 803: "running"}
+
+    async def get_job_state(pipeline_id, collect_input_data):
+        return JobState(id=pipeline_id, status=pipeline_statuses[pipeline_id]), None
+
+    with patch("elaspic2_rest_api.jobs.admission_queue", AdmissionQueue(2, 1)), patch(
+        "elaspic2_rest_api.gitlab_async.create_job", create_job
+    ), patch("elaspic2_rest_api.gitlab_async.get_job_state", get_job_state):
+        # The second job of a client waits until its first job is done, while other clients
+        # get their share
+        assert await jobs.submit_job(make_request("G1A"), "a") == "801"
+        queued_job_id = await jobs.submit_job(make_request("S2A"), "a")
+        assert await jobs.submit_job(make_request("M3A"), "b") == "802"
+        job_state = await jobs.get_job_state(queued_job_id)
+        assert (job_state.status, job_state.queue_position) == ("pending", 0)
+        assert create_job.call_count == 2
+
+        pipeline_statuses[801] = "success"
+        jobs.job_state_cache.clear()
+        assert (await jobs.get_job_state("801")).status == "success"
+        await asyncio.sleep(0.1)
+        assert create_job.call_count == 3
+        job_state = await jobs.get_job_state(queued_job_id)
+        assert (job_state.status, job_state.queue_position) == ("running", None)
+        assert (await jobs.get_job_record(queued_job_id)).pipeline_ids == [803]
+
+
+@pytest.mark.asyncio
+async def test_submit_job_rejected(local_data):
+    queue = AdmissionQueue(1, 1, max_queued_work=1)
+    create_job = AsyncMock(side_effect=[901, 902])
+    with patch("elaspic2_rest_api.jobs.admission_queue", queue), patch(
+        "elaspic2_rest_api.gitlab_async.create_job", create_job
+    ):
+        assert await jobs.submit_job(make_request("G1A")) == "901"
+        queued_job_id = await jobs.submit_job(make_request("S2A"))
+        with pytest.raises(jobs.AdmissionRejected) as exc_info:
+            await jobs.submit_job(make_request("M3A"))
+        assert exc_info.value.retry_after == jobs.config.DEFAULT_RETRY_AFTER
+
+        load = jobs.get_load()
+        assert (load.pipelines_in_flight, load.queued_jobs, load.queued_mutations) == (1, 1, 1)
+
+        # Deleting queued jobs makes room for others
+        await jobs.delete_job(queued_job_id)
+        assert await jobs.submit_job(make_request("M3A")) != queued_job_id
+        assert jobs.get_load().queued_jobs == 1
+
+
+@pytest.mark.asyncio
+async def test_restore_admission_queue(local_data):
+    create_job = AsyncMock(side_effect=[1001, 1002])
+    with patch("elaspic2_rest_api.jobs.admission_queue", AdmissionQueue(1, 1)), patch(
+        "elaspic2_rest_api.gitlab_async.create_job", create_job
+    ):
+        assert await jobs.submit_job(make_request("G1A"), "a") == "1001"
+        queued_job_id = await jobs.submit_job(make_request("S2A"), "b")
+
+    # After a restart, the pipeline still counts as in flight and the job is still queued
+    jobs._queued_jobs.clear()
+    pipeline_states = {1001: "running", 1002: "running"}
+
+    async def get_job_state(pipeline_id, collect_input_data):
+        return JobState(id=pipeline_id, status=pipeline_states[pipeline_id]), None
+
+    queue = AdmissionQueue(1, 1)
+    with patch("elaspic2_rest_api.jobs.admission_queue", queue), patch(
+        "elaspic2_rest_api.gitlab_async.create_job", create_job
+    ), patch("elaspic2_rest_api.gitlab_async.get_job_state", get_job_state):
+        await jobs.restore_admission_queue()
+        assert queue.get_pipeline_ids() == [1001]
+        job_state = await jobs.get_job_state(queued_job_id)
+        assert (job_state.status, job_state.queue_position) == ("pending", 0)
+
+        pipeline_states[1001] = "success"
+        assert (await jobs.get_job_state("1001")).status == "success"
+        await asyncio.sleep(0.1)
+        assert (await jobs.get_job_record(queued_job_id)).pipeline_ids == [1002]
+        assert db.get_queued_jobs() == []
+        assert list(db.get_pipelines_in_flight()) == [1002]
+
+
+def test_acquire_lock(local_data):
+    db.acquire_lock()
+    try:
+        # Another worker using the same database would not know about queued jobs
+        with pytest.raises(RuntimeError):
+            db.acquire_lock()
+    finally:
+        db.release_lock()
+    db.acquire_lock()
+    db.release_lock()
@@ -0,0 +1,75 @@
+import gzip
+import json
+from unittest.mock import AsyncMock, patch
+
+from starlette.requests import Request
+from starlette.testclient import TestClient
+
+from elaspic2_rest_api import main
+from elaspic2_rest_api.middleware import GzipRequestMiddleware
+
+JOB_REQUEST = {
+    "protein_structure_url": "https://files.rcsb.org/download/1MFG.pdb",
+    "protein_sequence": "GSMEIRVRVEK",
+    "mutations": "G1A,G1C",
+}
+
+
+def _get_middleware(middleware_class):
+    app = main.app.middleware_stack
+    while not isinstance(app, middleware_class):
+        app = app.app
+    return app
+
+
+def test_submit_jobs_out_of_range_mutations():
+    client = TestClient(main.app)
+    inputs = [
+        JOB_REQUEST,
+        {**JOB_REQUEST, "protein_sequence": "AAA", "mutations": "A9G"},
+        {**JOB_REQUEST, "protein_sequence": "AAA", "mutations": "A3G,A4G"},
+    ]
+    with patch("elaspic2_rest_api.jobs.submit_jobs", AsyncMock(return_value=["1"])):
+        response = client.post("/jobs/batch", json=inputs)
+    assert response.status_code == 202
+    data = response.json()
+    assert data["jobs"][0]["id"] == "1"
+    assert data["jobs"][1:] == [None, None]
+    assert [(e["index"], e["status_code"]) for e in data["errors"]] == [(1, 400), (2, 400)]
+    assert data["errors"][0]["detail"] == "Mutation(s) do not match the protein sequence"
+
+
+def test_submit_job_malformed_compressed_body():
+    client = TestClient(main.app)
+    headers = {"Content-Encoding": "gzip", "Content-Type": "application/json"}
+    response = client.post("/jobs/", data=json.dumps(JOB_REQUEST).encode(), headers=headers)
+    assert response.status_code == 400
+    assert response.text == "Request body is not gzip-compressed"
+
+    data = gzip.compress(json.dumps({**JOB_REQUEST, "mutations": "G1A," * 100_000}).encode())
+    with patch.object(_get_middleware(GzipRequestMiddleware), "max_size", 1000):
+        response = client.post("/jobs/", data=data, headers=headers)
+    assert response.status_code == 413
+    assert response.text == "Decompressed request body is too large"
+
+
+def test_get_client_id():
+    request = Request(
+        {
+            "type": "http",
+            "headers": [(b"x-client-id", b"client-1")],
+            "client": ("10.0.0.5", 12345),
+        }
+    )
+    # The header is only honoured from trusted proxies
+    assert main._get_client_id(request) == "10.0.0.5"
+    with patch("elaspic2_rest_api.config.TRUSTED_PROXIES", ["10.0.0.0/8"]):
+        assert main._get_client_id(request) == "client-1"
+    with patch("elaspic2_rest_api.config.TRUSTED_PROXIES", ["10.0.0.1"]):
+        assert main._get_client_id(request) == "10.0.0.5"
+
+
+def test_get_job_statuses_requires_ids():
+    client = TestClient(main.app)
+    response = client.get("/jobs/")
+    assert response.status_code == 422
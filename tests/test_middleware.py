@@ -0,0 +1,77 @@
+import gzip
+import zlib
+
+import pytest
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import Response
+from starlette.testclient import TestClient
+
+from elaspic2_rest_api.middleware import (
+    CompressionMiddleware,
+    GzipRequestDecompressor,
+    GzipRequestMiddleware,
+    MalformedBodyError,
+    select_encoding,
+)
+
+
+def make_client() -> TestClient:
+    app = Starlette()
+    app.add_middleware(GzipRequestMiddleware, max_size=1000)
+    app.add_middleware(CompressionMiddleware, minimum_size=100)
+
+    @app.route("/echo", methods=["POST"])
+    async def echo(request: Request):
+        return Response(await request.body(), media_type="text/plain")
+
+    return TestClient(app)
+
+
+def test_compressed_response():
+    client = make_client()
+    response = client.post("/echo", data=b"x" * 200, headers={"Accept-Encoding": "gzip"})
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert response.content == b"x" * 200
+
+    response = client.post("/echo", data=b"x" * 10, headers={"Accept-Encoding": "gzip"})
+    assert "Content-Encoding" not in response.headers
+
+
+def test_compressed_request():
+    client = make_client()
+    headers = {"Content-Encoding": "gzip", "Accept-Encoding": "identity"}
+    response = client.post("/echo", data=gzip.compress(b"x" * 200), headers=headers)
+    assert response.status_code == 200
+    assert response.content == b"x" * 200
+
+    response = client.post("/echo", data=b"x" * 200, headers=headers)
+    assert response.status_code == 400
+
+    response = client.post("/echo", data=gzip.compress(b"x" * 2000), headers=headers)
+    assert response.status_code == 413
+
+
+@pytest.mark.asyncio
+async def test_compressed_request_gzip_bomb():
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+    chunk = b"\0" * (1024 * 1024)
+    data = b"".join(compressor.compress(chunk) for _ in range(32)) + compressor.flush()
+    assert len(data) < 64 * 1024
+
+    async def receive():
+        # The whole bomb arrives in a single message
+        return {"type": "http.request", "body": data, "more_body": False}
+
+    decompressor = GzipRequestDecompressor(receive, max_size=64 * 1024)
+    with pytest.raises(MalformedBodyError) as exc_info:
+        await decompressor.receive()
+    assert exc_info.value.status_code == 413
+    # Decompression stops as soon as the limit is passed
+    assert decompressor.size <= 64 * 1024 + 1
+
+
+def test_select_encoding():
+    assert select_encoding("") is None
+    assert select_encoding("gzip, deflate") == "gzip"
+    assert select_encoding("gzip;q=0, identity") is None
@@ -0,0 +1,30 @@
+import os
+from unittest.mock import patch
+
+from elaspic2_rest_api import results_store
+
+
+def test_results_store(tmp_path):
+    with patch("elaspic2_rest_api.config.RESULTS_STORE_DIR", str(tmp_path)):
+        assert results_store.get(1) is None
+        digest_1 = results_store.put(1, b'{"mutation": "G1A"}\n')
+        digest_2 = results_store.put(2, b'{"mutation": "G1A"}\n')
+        assert digest_1 == digest_2
+        assert results_store.get(1) == results_store.get(2) == b'{"mutation": "G1A"}\n'
+
+        results_store.delete(1)
+        assert results_store.get(1) is None
+        assert results_store.contains(2)
+
+
+def test_results_store_eviction(tmp_path):
+    with patch("elaspic2_rest_api.config.RESULTS_STORE_DIR", str(tmp_path)):
+        results_store.put(1, b"1" * 1000)
+        results_store.put(2, b"2" * 1000)
+        # Make job 1 the least-recently-used one
+        object_path = results_store.get_object_path(1)
+        os.utime(object_path, (0, 0))
+
+        results_store.evict(max_bytes=os.path.getsize(object_path))
+        assert results_store.get(1) is None
+        assert results_store.get(2) == b"2" * 1000
@@ -0,0 +1,62 @@
+import asyncio
+
+import aiohttp
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from elaspic2_rest_api.scheduler import BACKGROUND_PRIORITY, USER_PRIORITY, RequestScheduler
+
+
+def make_scheduler(**kwargs) -> RequestScheduler:
+    options = dict(rate_limit=6000, burst=1, max_retries=3, backoff_base=0.01, backoff_max=0.1)
+    options.update(kwargs)
+    return RequestScheduler(**options)
+
+
+@pytest.mark.asyncio
+async def test_priority():
+    scheduler = make_scheduler()
+    await scheduler.acquire()
+
+    # Once the burst is used up, user requests go before background requests
+    order = []
+
+    async def acquire(name, priority):
+        await scheduler.acquire(priority)
+        order.append(name)
+
+    await asyncio.gather(
+        acquire("background", BACKGROUND_PRIORITY),
+        acquire("user", USER_PRIORITY),
+    )
+    assert order == ["user", "background"]
+
+
+@pytest.mark.asyncio
+async def test_retry():
+    statuses = [429, 503, 200]
+
+    async def handler(request):
+        status = statuses.pop(0)
+        headers = {"Retry-After": "0", "RateLimit-Limit": "600"} if status == 429 else {}
+        return web.Response(status=status, headers=headers)
+
+    app = web.Application()
+    app.router.add_get("/", handler)
+    server = TestServer(app)
+    await server.start_server()
+    scheduler = make_scheduler(burst=10)
+    try:
+        async with aiohttp.ClientSession() as session:
+            url = server.make_url("/")
+            async with scheduler.request(lambda: session.get(url)) as response:
+                assert response.status == 200
+            assert scheduler.rate == 10
+
+            # Requests which may have been processed are not retried
+            statuses[:] = [503, 200]
+            async with scheduler.request(lambda: session.get(url), idempotent=False) as response:
+                assert response.status == 503
+    finally:
+        await server.close()
@@ -0,0 +1,73 @@
+import json
+import time
+
+import orjson
+import pytest
+
+from elaspic2_rest_api import utils
+from elaspic2_rest_api.types import MutationResult
+
+
+def test_jsonl_to_json_array():
+    rows = [
+        {
+            "mutation": mutation,
+            "protbert_core": 0.1,
+            "proteinsolver_core": 0.2,
+            "el2core": 0.3,
+            "protbert_interface": None,
+            "proteinsolver_interface": None,
+            "el2interface": None,
+            "error_message": None,
+        }
+        for mutation in ["G1A", "S2A", "M3A"]
+    ]
+    data = b"".join(orjson.dumps(row) + b"\n" for row in rows)
+
+    # Same output as encoding the results with the response model
+    expected = [MutationResult(**json.loads(line)).dict() for line in data.splitlines()]
+    assert orjson.loads(utils.jsonl_to_json_array([data])) == expected
+    # Results of several pipelines are combined into one array
+    chunks = [orjson.dumps(row) + b"\n" for row in rows]
+    assert orjson.loads(utils.jsonl_to_json_array(chunks)) == expected
+    assert orjson.loads(utils.jsonl_to_json_array([])) == []
+
+
+def make_results_data(num_rows: int) -> bytes:
+    row = {
+        "mutation": "G1A",
+        "protbert_core": 0.1,
+        "proteinsolver_core": 0.2,
+        "el2core": 0.3,
+        "protbert_interface": 0.4,
+        "proteinsolver_interface": 0.5,
+        "el2interface": 0.6,
+        "error_message": None,
+    }
+    return b"".join(orjson.dumps(row) + b"\n" for _ in range(num_rows))
+
+
+def encode_with_response_model(data: bytes) -> bytes:
+    """Encode results the way FastAPI does when a `List[MutationResult]` is returned."""
+    rows = [json.loads(line) for line in data.split(b"\n") if line.strip()]
+    return json.dumps([MutationResult(**row).dict() for row in rows]).encode()
+
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize("num_rows", [1_000, 10_000, 100_000])
+def test_jsonl_to_json_array_benchmark(num_rows):
+    data = make_results_data(num_rows)
+
+    start = time.perf_counter()
+    fast_json = utils.jsonl_to_json_array([data])
+    fast_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    slow_json = encode_with_response_model(data)
+    slow_time = time.perf_counter() - start
+
+    print(
+        f"{num_rows} rows: {num_rows / fast_time:.0f} rows/s (as-is), "
+        f"{num_rows / slow_time:.0f} rows/s (response model)"
+    )
+    assert orjson.loads(fast_json) == orjson.loads(slow_json)
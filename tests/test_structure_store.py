@@ -0,0 +1,155 @@
+import asyncio
+import base64
+import gzip
+import hashlib
+import os
+import time
+from unittest.mock import patch
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from elaspic2_rest_api import config, structure_store
+from elaspic2_rest_api.bin_utils import GzipStreamDecoder
+
+STRUCTURE = b"ATOM      1  N   GLY A   1      -6.778  11.032  23.436  1.00 40.47           N\n"
+
+
+@pytest.mark.asyncio
+async def test_structure_store(tmp_path):
+    requests = []
+
+    async def get_structure(request):
+        requests.append(request)
+        await asyncio.sleep(0.1)
+        if request.match_info["name"] == "missing.pdb":
+            raise web.HTTPNotFound()
+        data = STRUCTURE
+        if request.match_info["name"].endswith(".gz"):
+            data = gzip.compress(data)
+        return web.Response(body=data)
+
+    app = web.Application()
+    app.router.add_get("/{name}", get_structure)
+    server = TestServer(app)
+    await server.start_server()
+    with patch(
+        "elaspic2_rest_api.config.STRUCTURE_STORE_DIR", str(tmp_path.joinpath("structures"))
+    ), patch("elaspic2_rest_api.config.STRUCTURE_STORE_URL", "http://api.test/"), patch(
+        "elaspic2_rest_api.config.STRUCTURE_FETCH_ALLOWED_HOSTS", ["127.0.0.1"]
+    ), patch(
+        "elaspic2_rest_api.structure_store._is_public_address", return_value=True
+    ):
+        try:
+            url = str(server.make_url("/1MFG.pdb"))
+            structure_store.prefetch(url)
+            # Jobs using the same structure share a single download
+            references = await asyncio.gather(
+                *[structure_store.get_reference(url) for _ in range(3)]
+            )
+            assert len(requests) == 1
+            assert len(set(references)) == 1
+            name = references[0].rsplit("/", 1)[1]
+            assert references[0] == f"http://api.test/structures/{name}"
+            assert structure_store.get_object_path(name).read_bytes() == STRUCTURE
+
+            assert await structure_store.get_reference(url) == references[0]
+            assert len(requests) == 1
+
+            # Compressed structures are stored as-is
+            reference = await structure_store.get_reference(str(server.make_url("/1MFG.pdb.gz")))
+            assert reference.endswith(".gz")
+
+            with pytest.raises(structure_store.StructureFetchError):
+                await structure_store.get_reference(str(server.make_url("/missing.pdb")))
+
+            assert structure_store.get_object_path("../urls") is None
+        finally:
+            await structure_store.close_session()
+            await server.close()
+
+
+@pytest.mark.parametrize("encode", [lambda data: data, base64.encodebytes])
+def test_template_writer(tmp_path, encode):
+    data = encode(gzip.compress(STRUCTURE * 100))
+    with patch(
+        "elaspic2_rest_api.config.STRUCTURE_STORE_DIR", str(tmp_path.joinpath("structures"))
+    ):
+        writer = structure_store.TemplateWriter()
+        for i in range(0, len(data), 7):
+            writer.write(data[i : i + 7])
+        template_id = writer.commit()
+        # Templates are stored decompressed, and identified by their contents
+        assert template_id == hashlib.sha256(STRUCTURE * 100).hexdigest()
+        assert structure_store.get_object_path(template_id).read_bytes() == STRUCTURE * 100
+
+        for malformed_data in [STRUCTURE, data[: len(data) // 2], b"!" + data]:
+            writer = structure_store.TemplateWriter()
+            with pytest.raises(ValueError):
+                writer.write(malformed_data)
+                writer.commit()
+            writer.abort()
+        assert len(list(tmp_path.joinpath("structures", "objects").iterdir())) == 1
+
+
+@pytest.mark.asyncio
+async def test_structure_store_forbidden_urls(tmp_path):
+    urls = [
+        "file:///etc/passwd",
+        "http://127.0.0.1/1MFG.pdb",
+        "http://[::ffff:169.254.169.254]/latest/meta-data",
+        "http://10.0.0.1/1MFG.pdb",
+    ]
+    with patch(
+        "elaspic2_rest_api.config.STRUCTURE_STORE_DIR", str(tmp_path.joinpath("structures"))
+    ), patch("elaspic2_rest_api.config.STRUCTURE_FETCH_ALLOWED_HOSTS", ["*"]):
+        try:
+            with patch(
+                "elaspic2_rest_api.config.STRUCTURE_FETCH_ALLOWED_HOSTS", ["files.rcsb.org"]
+            ):
+                with pytest.raises(structure_store.StructureFetchError):
+                    await structure_store.get_reference("http://internal.example.com/1MFG.pdb")
+            for url in urls:
+                with pytest.raises(structure_store.StructureFetchError):
+                    await structure_store.get_reference(url)
+            # Host names are checked once they are resolved
+            with patch("elaspic2_rest_api.config.STRUCTURE_FETCH_ALLOWED_HOSTS", ["localhost"]):
+                with pytest.raises(structure_store.StructureFetchError):
+                    await structure_store.get_reference("http://localhost/1MFG.pdb")
+        finally:
+            await structure_store.close_session()
+
+
+def test_evict_recently_used(tmp_path):
+    with patch(
+        "elaspic2_rest_api.config.STRUCTURE_STORE_DIR", str(tmp_path.joinpath("structures"))
+    ), patch("elaspic2_rest_api.config.MAX_STRUCTURE_SIZE", 10_000):
+        names = []
+        for i in range(2):
+            writer = structure_store.StructureWriter(f"https://files.rcsb.org/{i}.pdb")
+            writer.write(STRUCTURE * (i + 1))
+            names.append(writer.commit())
+        # The store is over its size limit, but both structures may still be downloaded
+        assert structure_store.evict(0) == 0
+        old_time = time.time() - config.STRUCTURE_EVICT_MIN_AGE - 1
+        os.utime(structure_store.get_object_path(names[0]), (old_time, old_time))
+        assert structure_store.evict(0) == len(STRUCTURE)
+        assert structure_store.get_object_path(names[0]) is None
+        assert structure_store.get_object_path(names[1], touch=True) is not None
+
+
+def test_template_writer_gzip_bomb(tmp_path):
+    data = gzip.compress(b"\0" * 20 * 1024**2)
+    # Highly compressed data is decompressed a bounded chunk at a time
+    decoder = GzipStreamDecoder(max_chunk_size=1024)
+    assert max(len(chunk) for chunk in decoder.decode(data[: 64 * 1024])) == 1024
+
+    with patch(
+        "elaspic2_rest_api.config.STRUCTURE_STORE_DIR", str(tmp_path.joinpath("structures"))
+    ), patch("elaspic2_rest_api.config.MAX_STRUCTURE_SIZE", 1024**2):
+        writer = structure_store.TemplateWriter()
+        with pytest.raises(structure_store.StructureTooLargeError):
+            writer.write(data)
+        assert writer.size <= 1024**2 + writer._decoder.max_chunk_size
+        writer.abort()
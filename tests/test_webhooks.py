@@ -0,0 +1,99 @@
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import pytest
+
+from elaspic2_rest_api import db, gitlab_monitor, jobs, webhooks
+from elaspic2_rest_api.types import JobState
+
+
+@pytest.fixture
+def local_data(tmp_path):
+    with patch("elaspic2_rest_api.config.DB_PATH", str(tmp_path.joinpath("db.sqlite"))):
+        db.close_connection()
+        jobs.job_state_cache.clear()
+        yield tmp_path
+        db.close_connection()
+        jobs.job_state_cache.clear()
+
+
+def make_payload(pipeline_id: int, status: str) -> dict:
+    return {
+        "object_kind": "pipeline",
+        "object_attributes": {
+            "id": pipeline_id,
+            "status": status,
+            "created_at": "2021-01-01 00:00:00 UTC",
+            "finished_at": None,
+        },
+        "project": {"id": 21481523},
+        "builds": [{"id": 1, "started_at": "2021-01-01 00:01:00 UTC"}],
+    }
+
+
+def test_verify_token():
+    with patch("elaspic2_rest_api.config.GITLAB_WEBHOOK_TOKEN", "secret"):
+        assert webhooks.verify_token("secret")
+        assert not webhooks.verify_token("wrong")
+        assert not webhooks.verify_token(None)
+    with patch("elaspic2_rest_api.config.GITLAB_WEBHOOK_TOKEN", None):
+        assert not webhooks.verify_token("secret")
+
+
+def test_make_pipeline():
+    pipeline = webhooks.make_pipeline(make_payload(101, "running"))
+    assert pipeline["created_at"] == "2021-01-01T00:00:00.000Z"
+    assert pipeline["started_at"] == "2021-01-01T00:01:00.000Z"
+    assert pipeline["finished_at"] is None
+
+
+@pytest.mark.asyncio
+async def test_pipeline_event(local_data):
+    get_job_state = AsyncMock(return_value=(JobState(id=101, status="pending"), None))
+    with patch("elaspic2_rest_api.config.GITLAB_PROJECT_ID", 21481523), patch(
+        "elaspic2_rest_api.gitlab_async.get_job_state", get_job_state
+    ):
+        await webhooks.handle_event("Pipeline Hook", make_payload(101, "running"))
+        jobs.job_state_cache.clear()
+        # States pushed by GitLab are served without polling
+        assert (await jobs.get_job_state("101")).status == "running"
+        assert get_job_state.call_count == 0
+
+        # Failures are checked once, so that premature failures can be retried
+        await webhooks.handle_event("Pipeline Hook", make_payload(101, "failed"))
+        assert get_job_state.call_count == 1
+        assert db.get_premature_failures() == [101]
+        assert (await jobs.get_job_state("101")).status == "pending"
+
+
+@pytest.mark.asyncio
+async def test_pipeline_event_out_of_order(local_data):
+    with patch("elaspic2_rest_api.config.GITLAB_PROJECT_ID", 21481523):
+        await webhooks.handle_event("Pipeline Hook", make_payload(102, "success"))
+        # A late event must not make a finished pipeline look unfinished again
+        await webhooks.handle_event("Pipeline Hook", make_payload(102, "running"))
+        jobs.job_state_cache.clear()
+        assert (await jobs.get_job_state("102")).status == "success"
+        await webhooks.handle_event("Pipeline Hook", make_payload(102, "canceled"))
+        assert (await jobs.get_job_state("102")).status == "canceled"
+
+
+@pytest.mark.asyncio
+async def test_delete_premature_failure(local_data):
+    get_job_state = AsyncMock(return_value=(JobState(id=103, status="pending"), None))
+    with patch("elaspic2_rest_api.config.GITLAB_PROJECT_ID", 21481523), patch(
+        "elaspic2_rest_api.gitlab_async.get_job_state", get_job_state
+    ), patch("elaspic2_rest_api.gitlab_async.delete_job", AsyncMock()):
+        await webhooks.handle_event("Pipeline Hook", make_payload(103, "failed"))
+        await webhooks.handle_event("Pipeline Hook", make_payload(104, "failed"))
+        assert db.get_premature_failures() == [103, 104]
+
+        # Deleted pipelines are not retried any more
+        await jobs.delete_job("103")
+        assert db.get_premature_failures() == [104]
+
+        # Neither are pipelines which GitLab no longer knows about
+        with patch(
+            "elaspic2_rest_api.gitlab_monitor._send_pipeline_request", AsyncMock(return_value=404)
+        ):
+            await gitlab_monitor.retry_pipelines(MagicMock(), [{"id": 104}])
+        assert db.get_premature_failures() == []